@@ -24,10 +24,8 @@ from pox.datapaths import do_launch
 from pox.datapaths.switch import SoftwareSwitchBase, OFConnection
 from pox.datapaths.switch import ExpireMixin
 import pox.lib.pxpcap as pxpcap
-from Queue import Queue
-from threading import Thread
+from collections import deque
 import pox.openflow.libopenflow_01 as of
-from pox.lib.packet import ethernet
 import logging
 
 log = core.getLogger()
@@ -131,6 +129,9 @@ class PCapSwitch (ExpireMixin, SoftwareSwitchBase):
   # Default level for loggers of this class
   default_log_level = logging.INFO
 
+  # Most received packets to switch in one go
+  rx_batch_size = 256
+
   def __init__ (self, **kw):
     """
     Create a switch instance
@@ -141,9 +142,12 @@ class PCapSwitch (ExpireMixin, SoftwareSwitchBase):
     """
     log_level = kw.pop('log_level', self.default_log_level)
 
-    self.q = Queue()
-    self.t = Thread(target=self._consumer_threadproc)
-    core.addListeners(self)
+    # Received (port_no, data), appended to by the pcap threads
+    self._rx_queue = deque()
+    self._rx_scheduled = False
+
+    # Maps port_no -> list of frames to inject, while switching a batch
+    self._tx_batch = None
 
     ports = kw.pop('ports', [])
     kw['ports'] = []
@@ -162,8 +166,6 @@ class PCapSwitch (ExpireMixin, SoftwareSwitchBase):
     for px in self.px.itervalues():
       px.start()
 
-    self.t.start()
-
   def add_interface (self, name, port_no=-1, on_error=None, start=False):
     if on_error is None:
       on_error = log.error
@@ -227,38 +229,44 @@ class PCapSwitch (ExpireMixin, SoftwareSwitchBase):
     px.port_no = None
     self.delete_port(name_or_num)
 
-  def _handle_GoingDownEvent (self, event):
-    self.q.put(None)
-
-  def _consumer_threadproc (self):
-    timeout = 3
-    while core.running:
-      try:
-        data = self.q.get(timeout=timeout)
-      except:
-        continue
-      if data is None:
-        # Signal to quit
-        break
-      batch = []
-      while True:
-        self.q.task_done()
-        port_no,data = data
-        data = ethernet(data)
-        batch.append((data,port_no))
-        try:
-          data = self.q.get(block=False)
-        except:
-          break
-      core.callLater(self.rx_batch, batch)
-
-  def rx_batch (self, batch):
-    for data,port_no in batch:
-      self.rx_packet(data, port_no)
-
   def _pcap_rx (self, px, data, sec, usec, length):
     if px.port_no is None: return
-    self.q.put((px.port_no, data))
+    self._rx_queue.append((px.port_no, data))
+    # The flag is cleared before the queue is drained, so whatever we just
+    # appended is either drained by a pending call or schedules a new one.
+    if not self._rx_scheduled:
+      self._rx_scheduled = True
+      core.callLater(self._rx_pending)
+
+  def _rx_pending (self):
+    """
+    Switches what the pcap threads have received (in the recoco thread)
+    """
+    self._rx_scheduled = False
+    q = self._rx_queue
+    batch = []
+    while q and len(batch) < self.rx_batch_size:
+      batch.append(q.popleft())
+    if q and not self._rx_scheduled:
+      # Let other tasks in before doing the rest (a callLater() would run
+      # before the call later task yields)
+      self._rx_scheduled = True
+      core.call_delayed(0, self._rx_pending)
+    if batch:
+      self.rx_batch(batch)
+
+  def rx_batch (self, batch):
+    """
+    process a batch of raw packets, sending the results in batches
+    """
+    self._tx_batch = {}
+    try:
+      super(PCapSwitch,self).rx_batch(batch)
+    finally:
+      tx_batch,self._tx_batch = self._tx_batch,None
+      for port_no,frames in tx_batch.iteritems():
+        px = self.px.get(port_no)
+        if px: px.inject_many(frames)
 
   def _output_packet_physical (self, packet, port_no):
     """
@@ -269,3 +277,14 @@ class PCapSwitch (ExpireMixin, SoftwareSwitchBase):
     px = self.px.get(port_no)
     if not px: return
     px.inject(packet)
+
+  def _output_frame_physical (self, frame, port_no):
+    """
+    send a frame out a single physical port (without parsing it)
+    """
+    if self._tx_batch is not None:
+      self._tx_batch.setdefault(port_no, []).append(frame.data)
+      return
+    px = self.px.get(port_no)
+    if not px: return
+    px.inject(frame.data)
@@ -43,11 +43,224 @@ from pox.lib.packet import *
 import logging
 import struct
 import time
+from collections import OrderedDict
 
 
 # Multicast address used for STP 802.1D
 _STP_MAC = EthAddr('01:80:c2:00:00:00')
 
+# Port config bits which affect which packets are received
+_NO_RECV = OFPPC_NO_RECV | OFPPC_NO_RECV_STP
+
+
+def _microflow_key (packet, in_port):
+  """
+  Returns a hashable key for the microflow a packet belongs to
+
+  The key captures exactly the header fields ofp_match.from_packet() looks
+  at (with spec_frags=True), so two packets with the same key always match
+  the same flow table entry.
+  """
+  dl_type = packet.type
+  p = packet.next
+  if dl_type < 1536:
+    dl_type = OFP_DL_TYPE_NOT_ETH_TYPE
+  if isinstance(p, llc):
+    if p.has_snap and p.oui == '\0\0\0':
+      dl_type = p.eth_type
+      p = p.next
+  if isinstance(p, vlan):
+    dl_type = p.eth_type
+    vl = (p.id, p.pcp)
+    p = p.next
+  else:
+    vl = None
+
+  if isinstance(p, ipv4):
+    if (p.flags & p.MF_FLAG) or p.frag != 0:
+      nw = (p.srcip, p.dstip, p.protocol, p.tos, None)
+    else:
+      tp = p.next
+      if isinstance(tp, udp) or isinstance(tp, tcp):
+        tp = (tp.srcport, tp.dstport)
+      elif isinstance(tp, icmp):
+        tp = (tp.type, tp.code)
+      else:
+        tp = None
+      nw = (p.srcip, p.dstip, p.protocol, p.tos, tp)
+  elif isinstance(p, arp):
+    nw = (p.protosrc, p.protodst, p.opcode) if p.opcode <= 255 else None
+  else:
+    nw = None
+
+  return (in_port, packet.src, packet.dst, dl_type, vl, nw)
+
+
+class _Frame (object):
+  """
+  A frame being switched, as a parsed packet and/or raw bytes
+
+  Whichever form isn't given is only made (and then kept) if it's used,
+  so a frame sent out several ports is packed at most once.
+  """
+  __slots__ = ('_packet', '_data')
+
+  def __init__ (self, packet = None, data = None):
+    self._packet = packet
+    self._data = data
+
+  @property
+  def packet (self):
+    if self._packet is None:
+      self._packet = ethernet(self._data)
+    return self._packet
+
+  @property
+  def data (self):
+    if self._data is None:
+      self._data = self._packet.pack()
+    return self._data
+
+
+def _csum_update (buf, offset, old, new, udp = False):
+  """
+  Fixes the checksum at offset after a 16 bit word changed from old to new
+
+  This is the incremental update from RFC 1624.  A UDP checksum of zero
+  means there isn't one, so it's left alone (and never becomes zero).
+  """
+  csum = (buf[offset] << 8) | buf[offset+1]
+  if udp and csum == 0: return
+  c = (~csum & 0xffff) + (~old & 0xffff) + new
+  c = (c & 0xffff) + (c >> 16)
+  c = (c & 0xffff) + (c >> 16)
+  c = ~c & 0xffff
+  if udp and c == 0: c = 0xffff
+  buf[offset] = c >> 8
+  buf[offset+1] = c & 0xff
+
+
+def _raw_ipv4 (buf):
+  """
+  Finds the IPv4 header in a raw frame
+
+  Like the _action_set_nw_* handlers, this looks inside at most one VLAN
+  tag.  Returns the header's offset, or None if there isn't a valid one.
+  """
+  if len(buf) < 14: return None
+  offset = 14
+  if buf[12] == 0x81 and buf[13] == 0x00:
+    offset = 18
+  if len(buf) < offset + 20: return None
+  if buf[offset-2] != 0x08 or buf[offset-1] != 0x00: return None
+  hl = (buf[offset] & 0x0f) * 4
+  iplen = (buf[offset+2] << 8) | buf[offset+3]
+  if buf[offset] >> 4 != 4 or hl < 20 or hl > iplen: return None
+  if offset + hl > len(buf): return None
+  return offset
+
+
+def _raw_l4 (buf, ip):
+  """
+  Finds the TCP or UDP header after the IPv4 header at offset ip
+
+  Returns (offset, checksum offset, is_udp), or None.  Only the first
+  fragment of a datagram has an L4 header.
+  """
+  if (buf[ip+6] & 0x1f) or buf[ip+7]: return None
+  proto = buf[ip+9]
+  if proto == ipv4.TCP_PROTOCOL:
+    size,csum = 20,16
+  elif proto == ipv4.UDP_PROTOCOL:
+    size,csum = 8,6
+  else:
+    return None
+  l4 = ip + (buf[ip] & 0x0f) * 4
+  end = min(len(buf), ip + ((buf[ip+2] << 8) | buf[ip+3]))
+  if l4 + size > end: return None
+  return l4, l4 + csum, proto == ipv4.UDP_PROTOCOL
+
+
+def _raw_set_dl_addr (offset):
+  def compile (action):
+    addr = action.dl_addr.toRaw()
+    def rewrite (buf):
+      buf[offset:offset+6] = addr
+    return rewrite
+  return compile
+
+
+def _raw_set_vlan (mask, shift, attr):
+  vlan_type = ethernet.VLAN_TYPE
+  def compile (action):
+    value = (getattr(action, attr) << shift) & mask
+    def rewrite (buf):
+      if buf[12] == 0x81 and buf[13] == 0x00:
+        tci = ((buf[14] << 8) | buf[15]) & ~mask | value
+        buf[14] = tci >> 8
+        buf[15] = tci & 0xff
+      else:
+        # Add a tag (the rest of which is zero)
+        buf[12:12] = struct.pack("!HH", vlan_type, value)
+    return rewrite
+  return compile
+
+
+def _raw_strip_vlan (action):
+  def rewrite (buf):
+    if buf[12] == 0x81 and buf[13] == 0x00:
+      del buf[12:16]
+  return rewrite
+
+
+def _raw_set_nw_addr (field):
+  def compile (action):
+    new = action.nw_addr.toUnsigned()
+    new_hi,new_lo = new >> 16, new & 0xffff
+    def rewrite (buf):
+      ip = _raw_ipv4(buf)
+      if ip is None: return
+      old = struct.unpack_from("!L", buf, ip + field)[0]
+      struct.pack_into("!L", buf, ip + field, new)
+      old_hi,old_lo = old >> 16, old & 0xffff
+      _csum_update(buf, ip + 10, old_hi, new_hi)
+      _csum_update(buf, ip + 10, old_lo, new_lo)
+      l4 = _raw_l4(buf, ip)
+      if l4 is not None:
+        # The address is part of the pseudo-header
+        _csum_update(buf, l4[1], old_hi, new_hi, l4[2])
+        _csum_update(buf, l4[1], old_lo, new_lo, l4[2])
+    return rewrite
+  return compile
+
+
+def _raw_set_nw_tos (action):
+  tos = action.nw_tos
+  def rewrite (buf):
+    ip = _raw_ipv4(buf)
+    if ip is None: return
+    old = (buf[ip] << 8) | buf[ip+1]
+    buf[ip+1] = tos
+    _csum_update(buf, ip + 10, old, (buf[ip] << 8) | tos)
+  return rewrite
+
+
+def _raw_set_tp_port (field):
+  def compile (action):
+    new = action.tp_port
+    def rewrite (buf):
+      ip = _raw_ipv4(buf)
+      if ip is None: return
+      l4 = _raw_l4(buf, ip)
+      if l4 is None: return
+      offset = l4[0] + field
+      old = (buf[offset] << 8) | buf[offset+1]
+      buf[offset] = new >> 8
+      buf[offset+1] = new & 0xff
+      _csum_update(buf, l4[1], old, new, l4[2])
+    return rewrite
+  return compile
+
 
 class DpPacketOut (Event):
   """
@@ -63,13 +276,18 @@ class DpPacketOut (Event):
 
 class SoftwareSwitchBase (object):
   def __init__ (self, dpid, name=None, ports=4, miss_send_len=128,
-                max_buffers=100, max_entries=0x7fFFffFF, features=None):
+                max_buffers=100, max_entries=0x7fFFffFF, features=None,
+                indexed_table=False, microflow_cache_size=1024,
+                batch_classifier=False):
     """
     Initialize switch
      - ports is a list of ofp_phy_ports or a number of ports
      - miss_send_len is number of bytes to send to controller on table miss
      - max_buffers is number of buffered packets to store
      - max_entries is max flows entries per table
+     - indexed_table uses an indexed classifier for flow table lookups
+     - microflow_cache_size is max exact-match flows to cache (0 disables)
+     - batch_classifier classifies rx_batch()es with NumPy
     """
     if name is None: name = dpid_to_str(dpid)
     self.name = name
@@ -85,12 +303,25 @@ class SoftwareSwitchBase (object):
     self.config_flags = 0
     self._has_sent_hello = False
 
-    self.table = FlowTable()
+    self.table = FlowTable(indexed=indexed_table)
     self.table.addListeners(self)
 
     self._lookup_count = 0
     self._matched_count = 0
 
+    # Compiled actions for each table entry.
+    # Maps entry -> (entry.actions, pipeline from _compile_actions()).
+    self._pipelines = {}
+
+    # Exact-match cache in front of the flow table.
+    # Maps _microflow_key() -> (entry, pipeline).
+    # entry is None for table misses.  Kept in LRU order.
+    self.microflow_cache_size = microflow_cache_size
+    self._microflow_cache = OrderedDict()
+
+    self.batch_classifier = batch_classifier
+    self._batch_classifier = None
+
     self.log = logging.getLogger(self.name)
     self._connection = None
 
@@ -215,7 +446,19 @@ class SoftwareSwitchBase (object):
     """
     Handle flow table modification events
     """
-    # Currently, we only use this for sending flow_removed messages
+    if event.added:
+      # New entries may shadow anything that's cached
+      self._microflow_cache.clear()
+    elif event.removed:
+      for entry in event.removed:
+        self._pipelines.pop(entry, None)
+      if self._microflow_cache:
+        removed = set(event.removed)
+        cache = self._microflow_cache
+        for key in [k for k,v in cache.iteritems() if v[0] in removed]:
+          del cache[key]
+
+    # Otherwise, we only use this for sending flow_removed messages
     if not event.removed: return
 
     if event.reason in (OFPRR_IDLE_TIMEOUT,OFPRR_HARD_TIMEOUT,OFPRR_DELETE):
@@ -510,11 +753,20 @@ class SoftwareSwitchBase (object):
       self.port_stats[in_port].rx_bytes += len(packet.pack()) # Expensive
 
     self._lookup_count += 1
-    entry = self.table.entry_for_packet(packet, in_port)
+    if self.microflow_cache_size:
+      entry,pipeline = self._microflow_lookup(packet, in_port, packet_data)
+    else:
+      entry = self.table.entry_for_packet(
+          packet if packet_data is None else packet_data, in_port)
+      pipeline = None if entry is None else self._entry_pipeline(entry)
     if entry is not None:
       self._matched_count += 1
-      entry.touch_packet(len(packet))
-      self._process_actions_for_packet(entry.actions, packet, in_port)
+      entry.touch_packet(len(packet) if packet_data is None
+                         else len(packet_data))
+      if pipeline is not None:
+        pipeline(packet, packet_data, in_port)
+      else:
+        self._process_actions_for_packet(entry.actions, packet, in_port)
     else:
       # no matching entry
       if port.config & OFPPC_NO_PACKET_IN:
@@ -525,6 +777,153 @@ class SoftwareSwitchBase (object):
       self.send_packet_in(in_port, buffer_id, packet_data,
                           reason=OFPR_NO_MATCH, data_length=self.miss_send_len)
 
+  def rx_batch (self, batch):
+    """
+    process a batch of raw dataplane packets
+
+    batch is a list of (in_port, packet_data) pairs.  This has the same
+    effect as calling rx_packet() on each, but packets of flows which are
+    already in the microflow cache are switched without being parsed.
+
+    With batch_classifier set, the whole batch is instead looked up in the
+    flow table at once by a BatchClassifier (which needs NumPy).
+    """
+    cache = self._microflow_cache
+    if not self.microflow_cache_size: cache = None
+    found = None
+    if self.config_flags & OFPC_FRAG_MASK:
+      cache = None
+    elif self.batch_classifier:
+      classifier = self._batch_classifier
+      if classifier is None or classifier.table is not self.table:
+        from pox.openflow.batch_classifier import BatchClassifier
+        classifier = self._batch_classifier = BatchClassifier(self.table)
+      found = classifier.classify([d for p,d in batch],
+                                  [p for p,d in batch]).tolist()
+      entries = classifier.entries
+    ports = self.ports
+    port_stats = self.port_stats
+    match_fields = of._match_fields_from_raw
+    now = time.time()
+    for i,(in_port,data) in enumerate(batch):
+      entry = None
+      port = ports.get(in_port)
+      if port is not None and not port.config & _NO_RECV:
+        if found is not None:
+          if found[i] >= 0: entry = entries[found[i]]
+        elif cache is not None:
+          key = match_fields(data, True)
+          if key is not None:
+            key = (in_port,) + key
+            cached = cache.pop(key, None)
+            if cached is not None:
+              cache[key] = cached
+              entry = cached[0]
+      pipeline = None if entry is None else self._entry_pipeline(entry)
+      if pipeline is None:
+        # Take the slow path (misses, port config, unusual packets...)
+        self.rx_packet(ethernet(data), in_port, data)
+        continue
+      stats = port_stats[in_port]
+      stats.rx_packets += 1
+      stats.rx_bytes += len(data)
+      self._lookup_count += 1
+      self._matched_count += 1
+      entry.touch_packet(len(data), now)
+      pipeline(None, data, in_port)
+
+  def _microflow_lookup (self, packet, in_port, packet_data = None):
+    """
+    Finds the table entry for a packet using the microflow cache
+
+    Returns (entry, pipeline).  pipeline is from _entry_pipeline(), and
+    is None if the actions can't be compiled (in which case use
+    _process_actions_for_packet(), which reports errors).
+    """
+    cache = self._microflow_cache
+    key = None
+    if packet_data is not None:
+      key = of._match_fields_from_raw(packet_data, True)
+    if key is None:
+      key = _microflow_key(packet, in_port)
+    else:
+      key = (in_port,) + key
+      packet = packet_data
+    cached = cache.pop(key, None)
+    if cached is None:
+      entry = self.table.entry_for_packet(packet, in_port)
+      if entry is None:
+        cached = (None, None)
+      else:
+        cached = (entry, self._entry_pipeline(entry))
+      while len(cache) >= self.microflow_cache_size:
+        cache.popitem(last=False)
+    elif cached[0] is not None:
+      # Pick up modified actions
+      cached = (cached[0], self._entry_pipeline(cached[0]))
+    cache[key] = cached
+    return cached
+
+  def _entry_pipeline (self, entry):
+    """
+    Returns the compiled actions for a table entry
+
+    These are normally compiled when the flow_mod is processed, but are
+    recompiled here if the entry's actions have been replaced since.
+    """
+    compiled = self._pipelines.get(entry)
+    if compiled is None or compiled[0] is not entry.actions:
+      compiled = (entry.actions, self._compile_actions(entry.actions))
+      self._pipelines[entry] = compiled
+    return compiled[1]
+
+  def _compile_actions (self, actions):
+    """
+    Compiles a list of actions into a function which applies them
+
+    Returns pipeline(packet, data, in_port), where packet is an ethernet
+    instance and data is its packed form (or None).  Returns None if there's
+    an action we don't have a handler for.
+
+    The standard header rewrites are done in place on the raw frame (with
+    incremental checksum fixes), and outputs are passed a _Frame, so the
+    frame is packed at most once no matter how many ports it goes out.
+    Handlers which have been overridden are called as usual.
+    """
+    steps = []
+    for action in actions:
+      h = self.action_handlers.get(action.type)
+      if h is None: return None
+      func = getattr(h, "__func__", None)
+      if func is _output_handler:
+        steps.append((_STEP_OUTPUT, action))
+      elif func in _raw_rewriters:
+        steps.append((_STEP_REWRITE, _raw_rewriters[func](action)))
+      else:
+        steps.append((_STEP_HANDLER, (h, action)))
+    output_frame = self._output_frame
+
+    def pipeline (packet, data, in_port):
+      frame = _Frame(packet, data)
+      buf = None
+      for kind,step in steps:
+        if kind == _STEP_REWRITE:
+          if buf is None:
+            buf = bytearray(frame.data)
+          step(buf)
+        elif kind == _STEP_OUTPUT:
+          if buf is not None:
+            frame = _Frame(data = bytes(buf))
+            buf = None
+          output_frame(frame, step.port, in_port, step.max_len)
+        else:
+          if buf is not None:
+            frame = _Frame(data = bytes(buf))
+            buf = None
+          h,action = step
+          frame = _Frame(h(action, frame.packet, in_port))
+    return pipeline
+
   def delete_port (self, port):
     """
     Removes a port
@@ -616,10 +1015,18 @@ class SoftwareSwitchBase (object):
 
     This is called by the more general _output_packet().
 
-    Override this.
+    Override this (or _output_frame_physical()).
     """
     self.log.info("Sending packet %s out port %s", str(packet), port_no)
 
+  def _output_frame_physical (self, frame, port_no):
+    """
+    send a _Frame out a single physical port
+
+    Override this instead of _output_packet_physical() if raw bytes will do.
+    """
+    self._output_packet_physical(frame.packet, port_no)
+
   def _output_packet (self, packet, out_port, in_port, max_len=None):
     """
     send a packet out some port
@@ -631,7 +1038,15 @@ class SoftwareSwitchBase (object):
     max_len: maximum packet payload length to send to controller
     """
     assert assert_type("packet", packet, ethernet, none_ok=False)
+    self._output_frame(_Frame(packet), out_port, in_port, max_len)
+
+  def _output_frame (self, frame, out_port, in_port, max_len=None):
+    """
+    send a _Frame out some port
 
+    Like _output_packet(), but the frame is only packed (or parsed) once,
+    however many ports it's sent out.
+    """
     def real_send (port_no, allow_in_port=False):
       if type(port_no) == ofp_phy_port:
         port_no = port_no.port_no
@@ -652,8 +1067,8 @@ class SoftwareSwitchBase (object):
         self.log.debug("Dropping packet sent on port %i: Link down", port_no)
         return
       self.port_stats[port_no].tx_packets += 1
-      self.port_stats[port_no].tx_bytes += len(packet.pack()) #FIXME: Expensive
-      self._output_packet_physical(packet, port_no)
+      self.port_stats[port_no].tx_bytes += len(frame.data)
+      self._output_frame_physical(frame, port_no)
 
     if out_port < OFPP_MAX:
       real_send(out_port)
@@ -669,15 +1084,15 @@ class SoftwareSwitchBase (object):
         if no == in_port: continue
         real_send(port)
     elif out_port == OFPP_CONTROLLER:
-      buffer_id = self._buffer_packet(packet, in_port)
+      buffer_id = self._buffer_packet(frame.packet, in_port)
       # Should we honor OFPPC_NO_PACKET_IN here?
-      self.send_packet_in(in_port, buffer_id, packet, reason=OFPR_ACTION,
+      self.send_packet_in(in_port, buffer_id, frame.data, reason=OFPR_ACTION,
                           data_length=max_len)
     elif out_port == OFPP_TABLE:
       # Do we disable send-to-controller when performing this?
       # (Currently, there's the possibility that a table miss from this
       # will result in a send-to-controller which may send back to table...)
-      self.rx_packet(packet, in_port)
+      self.rx_packet(frame.packet, in_port, frame.data)
     else:
       self.log.warn("Unsupported virtual output port: %d", out_port)
 
@@ -727,9 +1142,17 @@ class SoftwareSwitchBase (object):
     generation)
     """
     assert assert_type("packet", packet, (ethernet, bytes), none_ok=False)
+    data = None
     if not isinstance(packet, ethernet):
+      data = packet
       packet = ethernet.unpack(packet)
 
+    pipeline = self._compile_actions(actions)
+    if pipeline is not None:
+      pipeline(packet, data, in_port)
+      return
+
+    # Find the action we can't handle and report it
     for action in actions:
       #if action.type is ofp_action_resubmit:
       #  self.rx_packet(packet, in_port)
@@ -794,6 +1217,8 @@ class SoftwareSwitchBase (object):
                       ofp=flow_mod, connection=connection)
       return
 
+    self._pipelines[new_entry] = (new_entry.actions,
+                                  self._compile_actions(new_entry.actions))
     table.add_entry(new_entry)
 
   def _flow_mod_modify (self, flow_mod, connection, table, strict=False):
@@ -804,11 +1229,12 @@ class SoftwareSwitchBase (object):
     priority = flow_mod.priority
 
     modified = False
-    for entry in table.entries:
+    for entry in table.matching_entries(match, priority, strict):
       # update the actions field in the matching flows
-      if entry.is_matched_by(match, priority=priority, strict=strict):
-        entry.actions = flow_mod.actions
-        modified = True
+      entry.actions = flow_mod.actions
+      self._pipelines[entry] = (entry.actions,
+                                self._compile_actions(entry.actions))
+      modified = True
 
     if not modified:
       # if no matching entry is found, modify acts as add
@@ -1026,6 +1452,27 @@ class SoftwareSwitchBase (object):
                                           len(self.ports))
 
 
+# Handlers with equivalents in _compile_actions() pipelines
+_output_handler = SoftwareSwitchBase._action_output.__func__
+_raw_rewriters = {
+  SoftwareSwitchBase._action_set_dl_src.__func__: _raw_set_dl_addr(6),
+  SoftwareSwitchBase._action_set_dl_dst.__func__: _raw_set_dl_addr(0),
+  SoftwareSwitchBase._action_set_vlan_vid.__func__:
+      _raw_set_vlan(0x0fff, 0, "vlan_vid"),
+  SoftwareSwitchBase._action_set_vlan_pcp.__func__:
+      _raw_set_vlan(0xe000, 13, "vlan_pcp"),
+  SoftwareSwitchBase._action_strip_vlan.__func__: _raw_strip_vlan,
+  SoftwareSwitchBase._action_set_nw_src.__func__: _raw_set_nw_addr(12),
+  SoftwareSwitchBase._action_set_nw_dst.__func__: _raw_set_nw_addr(16),
+  SoftwareSwitchBase._action_set_nw_tos.__func__: _raw_set_nw_tos,
+  SoftwareSwitchBase._action_set_tp_src.__func__: _raw_set_tp_port(0),
+  SoftwareSwitchBase._action_set_tp_dst.__func__: _raw_set_tp_port(2),
+}
+_STEP_REWRITE = 1
+_STEP_OUTPUT = 2
+_STEP_HANDLER = 3
+
+
 class SoftwareSwitch (SoftwareSwitchBase, EventMixin):
   _eventMixin_events = set([DpPacketOut])
 
@@ -0,0 +1,131 @@
+# Copyright 2013 James McCauley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Replays a pcap trace through a software switch
+
+The switch connects to the controller like datapaths:softwareswitch.
+Once it has been connected for --delay seconds (so the controller can set
+things up), the frames in the trace are fed to it with rx_batch() as if
+they all arrived on --in_port.  Frames the switch sends out are counted
+and dropped.  A summary is logged when it's done, and POX exits if --quit
+is given.
+
+With --vectorized, batches are classified with NumPy.
+
+Example:
+./pox.py forwarding.l2_learning datapaths.trace_replay --infile=foo.pcap
+"""
+
+from pox.core import core
+from pox.datapaths import do_launch
+from pox.datapaths.switch import SoftwareSwitch, ExpireMixin
+import pox.lib.pxpcap.parser as pxparse
+from pox.lib.util import str_to_bool
+import time
+
+log = core.getLogger()
+
+
+def read_trace (filename):
+  """
+  Returns a list of the frames in a pcap file
+  """
+  frames = []
+  p = pxparse.PCapParser(callback=lambda data, parser: frames.append(data))
+  with open(filename, "rb") as f:
+    while True:
+      # The parser copies its buffer a lot, so keep it small
+      data = f.read(65536)
+      if not data: break
+      p.feed(data)
+  return frames
+
+
+class TraceReplayer (object):
+  """
+  Feeds frames to a switch a batch at a time
+
+  Other tasks get to run between batches.  done is called with this
+  object at the end.
+  """
+  def __init__ (self, switch, frames, in_port = 1, batch_size = 256,
+                passes = 1, done = None):
+    self.switch = switch
+    self.frames = frames
+    self.in_port = in_port
+    self.batch_size = batch_size
+    self.passes = passes
+    self.done = done
+    self.replayed = 0
+    self.start_time = None
+    self.end_time = None
+    self._pass = 0
+    self._offset = 0
+
+  def start (self):
+    if self.start_time is not None: return
+    self.start_time = time.time()
+    core.call_later(self._next)
+
+  def _next (self):
+    if self._offset >= len(self.frames):
+      self._pass += 1
+      self._offset = 0
+      if self._pass >= self.passes or not self.frames:
+        self._finish()
+        return
+    batch = self.frames[self._offset:self._offset+self.batch_size]
+    self._offset += len(batch)
+    in_port = self.in_port
+    self.switch.rx_batch([(in_port, data) for data in batch])
+    self.replayed += len(batch)
+    core.call_delayed(0, self._next)
+
+  def _finish (self):
+    self.end_time = time.time()
+    elapsed = max(self.end_time - self.start_time, 1e-6)
+    sw = self.switch
+    log.info("Replayed %s frames in %0.3f seconds (%0.1f frames/s)",
+             self.replayed, elapsed, self.replayed / elapsed)
+    log.info("%s of %s lookups matched a flow", sw._matched_count,
+             sw._lookup_count)
+    for port_no,stats in sorted(sw.port_stats.iteritems()):
+      if stats.tx_packets:
+        log.info("Port %s sent %s frames", port_no, stats.tx_packets)
+    if self.done: self.done(self)
+
+
+def launch (infile, in_port = 1, batch_size = 256, passes = 1, delay = 1,
+            vectorized = False, quit = False, ports = 4,
+            address = '127.0.0.1', port = 6633, dpid = None):
+  frames = read_trace(infile)
+  log.info("Read %s frames from %s", len(frames), infile)
+
+  class ReplaySwitch (ExpireMixin, SoftwareSwitch):
+    def set_connection (self, connection):
+      super(ReplaySwitch, self).set_connection(connection)
+      core.call_delayed(float(delay), replayer.start)
+
+    def _output_frame_physical (self, frame, port_no):
+      pass
+
+  def done (replayer):
+    if str_to_bool(quit): core.quit()
+
+  switch = do_launch(ReplaySwitch, address, port, dpid=dpid,
+                     ports=int(ports),
+                     batch_classifier=str_to_bool(vectorized))
+  replayer = TraceReplayer(switch, frames, int(in_port), int(batch_size),
+                           int(passes), done)
@@ -31,9 +31,9 @@ from pox.core import core
 import pox.openflow.libopenflow_01 as of
 from pox.lib.revent import *
 from pox.lib.recoco import Timer
-from collections import defaultdict
+from collections import defaultdict, deque
 from pox.openflow.discovery import Discovery
-from pox.lib.util import dpid_to_str
+from pox.lib.util import dpid_to_str, str_to_bool
 import time
 
 log = core.getLogger()
@@ -48,11 +48,26 @@ switches = {}
 mac_map = {}
 
 # [sw1][sw2] -> (distance, intermediate)
-path_map = defaultdict(lambda:defaultdict(lambda:(None,None)))
+# The intermediate is the switch just before sw2 on a shortest path from
+# sw1 (None if they're directly connected).  Rows are computed per source
+# switch when first needed and are updated as links come and go.
+path_map = {}
 
-# Waiting path.  (dpid,xid)->WaitingPath
+# (sw1,sw2) -> hops of the path between them (see _get_hops())
+path_cache = {}
+
+# (sw1,sw2) -> neighbors of sw1 on shortest paths to sw2 (for ECMP)
+next_hop_cache = {}
+
+# (dpid,port_no) -> (tx_bytes, time, Mbit/s) from port stats (for ECMP)
+port_load = {}
+
+# Waiting paths.  (dpid,xid)->[WaitingPath]
 waiting_paths = {}
 
+# Times taken to set up recent paths, in seconds
+path_setup_times = deque(maxlen=1000)
+
 # Time to not flood in seconds
 FLOOD_HOLDDOWN = 5
 
@@ -63,62 +78,99 @@ FLOW_HARD_TIMEOUT = 30
 # How long is allowable to set up a path?
 PATH_SETUP_TIME = 4
 
+# If True, rows of path_map affected by a link change are just dropped and
+# recomputed when next needed instead of being recomputed right away.
+# Good for very large topologies where most sources are rarely used.
+LAZY_PATHS = False
 
-def _calc_paths ():
-  """
-  Essentially Floyd-Warshall algorithm
-  """
+# If True, flows are spread over all equal-cost paths by hashing them
+ECMP = False
 
-  def dump ():
-    for i in sws:
-      for j in sws:
-        a = path_map[i][j][0]
-        #a = adjacency[i][j]
-        if a is None: a = "*"
-        print a,
-      print
+# If set, port stats are polled this often (in seconds) and ECMP prefers
+# lightly loaded links
+ECMP_STATS_INTERVAL = None
 
-  sws = switches.values()
-  path_map.clear()
-  for k in sws:
-    for j,port in adjacency[k].iteritems():
-      if port is None: continue
-      path_map[k][j] = (1,None)
-    path_map[k][k] = (0,None) # distance, intermediate
 
-  #dump()
+def _calc_paths_from (src):
+  """
+  Breadth-first search for shortest paths from a single switch
 
-  for k in sws:
-    for i in sws:
-      for j in sws:
-        if path_map[i][k][0] is not None:
-          if path_map[k][j][0] is not None:
-            # i -> k -> j exists
-            ikj_dist = path_map[i][k][0]+path_map[k][j][0]
-            if path_map[i][j][0] is None or ikj_dist < path_map[i][j][0]:
-              # i -> k -> j is better than existing
-              path_map[i][j] = (ikj_dist, k)
+  Stores the result as path_map[src] and returns it.
+  """
+  row = {src:(0,None)} # distance, intermediate
+  frontier = [src]
+  distance = 0
+  while frontier:
+    distance += 1
+    next_frontier = []
+    for sw in frontier:
+      via = None if sw is src else sw
+      for other,port in adjacency[sw].iteritems():
+        if port is None or other in row: continue
+        row[other] = (distance, via)
+        next_frontier.append(other)
+    frontier = next_frontier
+  path_map[src] = row
+  return row
+
+
+def _uses_link (src, row, sw1, sw2):
+  """
+  Does the shortest path tree in row use the link between sw1 and sw2?
+  """
+  for a,b in ((sw1,sw2),(sw2,sw1)):
+    d = row.get(b)
+    if d is not None and d[0] > 0 and (d[1] or src) is a:
+      return True
+  return False
 
-  #print "--------------------"
-  #dump()
+
+def _update_paths (sw1, sw2, added):
+  """
+  Updates path_map after sw1 and sw2 became connected or disconnected
+
+  Only the sources whose shortest paths may have changed are recomputed
+  (or dropped, with LAZY_PATHS).
+  """
+  stale = []
+  for src,row in path_map.iteritems():
+    if added:
+      # A new link only matters if it shortens the way to one of its ends
+      d1 = row.get(sw1)
+      d2 = row.get(sw2)
+      if d1 is None and d2 is None: continue
+      if d1 is not None and d2 is not None and abs(d1[0] - d2[0]) <= 1:
+        continue
+    elif not _uses_link(src, row, sw1, sw2):
+      # A lost link only matters if we were using it
+      continue
+    stale.append(src)
+
+  for src in stale:
+    if LAZY_PATHS:
+      del path_map[src]
+    else:
+      _calc_paths_from(src)
 
 
 def _get_raw_path (src, dst):
   """
   Get a raw path (just a list of nodes to traverse)
   """
-  if len(path_map) == 0: _calc_paths()
   if src is dst:
     # We're here!
     return []
-  if path_map[src][dst][0] is None:
+  row = path_map.get(src)
+  if row is None: row = _calc_paths_from(src)
+  if dst not in row:
     return None
-  intermediate = path_map[src][dst][1]
-  if intermediate is None:
-    # Directly connected
-    return []
-  return _get_raw_path(src, intermediate) + [intermediate] + \
-         _get_raw_path(intermediate, dst)
+  path = []
+  intermediate = row[dst][1]
+  while intermediate is not None:
+    path.append(intermediate)
+    intermediate = row[intermediate][1]
+  path.reverse()
+  return path
 
 
 def _check_path (p):
@@ -135,26 +187,137 @@ def _check_path (p):
   return True
 
 
-def _get_path (src, dst, first_port, final_port):
+def _get_hops (src, dst):
   """
-  Gets a cooked path -- a list of (node,in_port,out_port)
+  Gets the hops of a path as a tuple of (node,in_port,out_port)
+
+  The first hop's in_port and the last hop's out_port are None.  Results
+  (including None when there's no path) are kept in path_cache until the
+  topology changes.
   """
-  # Start with a raw path...
-  if src == dst:
-    path = [src]
+  key = (src,dst)
+  try:
+    return path_cache[key]
+  except KeyError:
+    pass
+
+  if src is dst:
+    hops = ((src,None,None),)
   else:
     path = _get_raw_path(src, dst)
-    if path is None: return None
-    path = [src] + path + [dst]
+    if path is None:
+      hops = None
+    else:
+      hops = _add_ports([src] + path + [dst])
+
+  path_cache[key] = hops
+  return hops
 
-  # Now add the ports
-  r = []
-  in_port = first_port
+
+def _add_ports (path):
+  """
+  Turns a list of nodes into a tuple of (node,in_port,out_port)
+  """
+  hops = []
+  in_port = None
   for s1,s2 in zip(path[:-1],path[1:]):
     out_port = adjacency[s1][s2]
-    r.append((s1,in_port,out_port))
+    hops.append((s1,in_port,out_port))
     in_port = adjacency[s2][s1]
-  r.append((dst,in_port,final_port))
+  hops.append((path[-1],in_port,None))
+  return tuple(hops)
+
+
+def _get_next_hops (sw, dst):
+  """
+  Gets the neighbors of sw which are on some shortest path to dst
+  """
+  key = (sw,dst)
+  try:
+    return next_hop_cache[key]
+  except KeyError:
+    pass
+
+  # Links go both ways, so dst's row also has distances *to* dst
+  row = path_map.get(dst)
+  if row is None: row = _calc_paths_from(dst)
+  d = row.get(sw)
+  if d is None:
+    hops = ()
+  else:
+    hops = [n for n,port in adjacency[sw].iteritems()
+            if port is not None and row.get(n,(None,))[0] == d[0] - 1]
+    hops = tuple(sorted(hops, key=lambda n: n.dpid))
+
+  next_hop_cache[key] = hops
+  return hops
+
+
+def _flow_hash (match):
+  """
+  Hashes the parts of a match which identify a flow
+
+  That's the 5-tuple for IP, and the addresses and type otherwise.
+  """
+  if match.nw_src is None and match.nw_dst is None:
+    return hash((match.dl_src, match.dl_dst, match.dl_type))
+  return hash((match.nw_src, match.nw_dst, match.nw_proto,
+               match.tp_src, match.tp_dst))
+
+
+def _choose_next_hop (sw, hops, flow_hash):
+  """
+  Picks one of the equal-cost next hops from sw for a flow
+  """
+  if len(hops) == 1: return hops[0]
+  # Mix in the switch so choices at successive hops are independent
+  h = hash((flow_hash, sw.dpid)) & 0x7fffFFFF
+  if ECMP_STATS_INTERVAL is None:
+    return hops[h % len(hops)]
+
+  # Weight each link inversely to its load
+  weights = []
+  for n in hops:
+    load = port_load.get((sw.dpid, adjacency[sw][n]))
+    weights.append(1.0 / (1.0 + (load[2] if load else 0.0)))
+  point = (h % 10000) / 10000.0 * sum(weights)
+  for n,w in zip(hops, weights):
+    point -= w
+    if point < 0: return n
+  return hops[-1]
+
+
+def _get_ecmp_hops (src, dst, match):
+  """
+  Like _get_hops(), but picks among equal-cost paths based on the match
+  """
+  flow_hash = _flow_hash(match)
+  path = [src]
+  sw = src
+  while sw is not dst:
+    hops = _get_next_hops(sw, dst)
+    if not hops: return None
+    sw = _choose_next_hop(sw, hops, flow_hash)
+    path.append(sw)
+  return _add_ports(path)
+
+
+def _get_path (src, dst, first_port, final_port, match = None):
+  """
+  Gets a cooked path -- a list of (node,in_port,out_port)
+
+  With ECMP, the match is used to pick among equal-cost paths.
+  """
+  if ECMP and match is not None and src is not dst:
+    hops = _get_ecmp_hops(src, dst, match)
+  else:
+    hops = _get_hops(src, dst)
+  if hops is None: return None
+
+  # Fill in the ports at the ends
+  r = list(hops)
+  r[0] = (src,first_port,r[0][2])
+  r[-1] = (dst,r[-1][1],final_port)
 
   assert _check_path(r), "Illegal path!"
 
@@ -171,7 +334,8 @@ class WaitingPath (object):
     first_switch is the DPID where the packet came from
     packet is something that can be sent in a packet_out
     """
-    self.expires_at = time.time() + PATH_SETUP_TIME
+    self.started_at = time.time()
+    self.expires_at = self.started_at + PATH_SETUP_TIME
     self.path = path
     self.first_switch = path[0][0].dpid
     self.xids = set()
@@ -182,7 +346,7 @@ class WaitingPath (object):
 
   def add_xid (self, dpid, xid):
     self.xids.add((dpid,xid))
-    waiting_paths[(dpid,xid)] = self
+    waiting_paths.setdefault((dpid,xid), []).append(self)
 
   @property
   def is_expired (self):
@@ -195,6 +359,7 @@ class WaitingPath (object):
     self.xids.discard((event.dpid,event.xid))
     if len(self.xids) == 0:
       # Done!
+      path_setup_times.append(time.time() - self.started_at)
       if self.packet:
         log.debug("Sending delayed packet out %s"
                   % (dpid_to_str(self.first_switch),))
@@ -207,15 +372,73 @@ class WaitingPath (object):
 
   @staticmethod
   def expire_waiting_paths ():
-    packets = set(waiting_paths.values())
-    killed = 0
-    for p in packets:
-      if p.is_expired:
-        killed += 1
-        for entry in p.xids:
-          waiting_paths.pop(entry, None)
+    killed = set()
+    for entry,wps in waiting_paths.items():
+      live = []
+      for p in wps:
+        if p.is_expired:
+          killed.add(p)
+        else:
+          live.append(p)
+      if not live:
+        del waiting_paths[entry]
+      elif len(live) != len(wps):
+        waiting_paths[entry] = live
     if killed:
-      log.error("%i paths failed to install" % (killed,))
+      log.error("%i paths failed to install" % (len(killed),))
+
+
+class PathInstaller (object):
+  """
+  Batches up the flow_mods for setting up paths
+
+  Flow_mods are collected per switch and sent together once per
+  scheduler tick, followed by a single barrier which all the paths
+  waiting on that switch share.
+  """
+  def __init__ (self):
+    self._pending = {} # Switch -> ([packed flow_mod], [WaitingPath])
+    self._scheduled = False
+
+  def _get (self, sw):
+    p = self._pending.get(sw)
+    if p is None:
+      p = self._pending[sw] = ([],[])
+      if not self._scheduled:
+        self._scheduled = True
+        core.call_later(self.flush)
+    return p
+
+  def send (self, sw, msg):
+    """
+    Queues a message to a switch
+
+    It's packed right away, so the caller is free to change it.
+    """
+    self._get(sw)[0].append(msg.pack())
+
+  def wait (self, sw, wp):
+    """
+    Has a WaitingPath wait on the next barrier to a switch
+    """
+    self._get(sw)[1].append(wp)
+
+  def flush (self):
+    self._scheduled = False
+    pending = self._pending
+    self._pending = {}
+    for sw,(msgs,wps) in pending.iteritems():
+      if sw.connection is None:
+        # These paths can't be installed; wait on a barrier that never
+        # comes so that they expire (and are reported) as usual
+        for wp in wps: wp.add_xid(sw.dpid, None)
+        continue
+      barrier = of.ofp_barrier_request()
+      msgs.append(barrier.pack())
+      sw.connection.send(b''.join(msgs))
+      for wp in wps: wp.add_xid(sw.dpid, barrier.xid)
+
+installer = PathInstaller()
 
 
 class PathInstalled (Event):
@@ -245,21 +468,19 @@ class Switch (EventMixin):
     msg.hard_timeout = FLOW_HARD_TIMEOUT
     msg.actions.append(of.ofp_action_output(port = out_port))
     msg.buffer_id = buf
-    switch.connection.send(msg)
+    installer.send(switch, msg)
 
   def _install_path (self, p, match, packet_in=None):
     wp = WaitingPath(p, packet_in)
     for sw,in_port,out_port in p:
       self._install(sw, in_port, out_port, match)
-      msg = of.ofp_barrier_request()
-      sw.connection.send(msg)
-      wp.add_xid(sw.dpid,msg.xid)
+      installer.wait(sw, wp)
 
   def install_path (self, dst_sw, last_port, match, event):
     """
     Attempts to install a path between this switch and some destination
     """
-    p = _get_path(self, dst_sw, event.port, last_port)
+    p = _get_path(self, dst_sw, event.port, last_port, match)
     if p is None:
       log.warning("Can't get from %s to %s", match.dl_src, match.dl_dst)
 
@@ -380,7 +601,7 @@ class Switch (EventMixin):
         flood()
       else:
         dest = mac_map[packet.dst]
-        match = of.ofp_match.from_packet(packet)
+        match = of.ofp_match.from_packet(event.data)
         self.install_path(dest[0], dest[1], match, event)
 
   def disconnect (self):
@@ -430,18 +651,8 @@ class l2_multi (EventMixin):
     l = event.link
     sw1 = switches[l.dpid1]
     sw2 = switches[l.dpid2]
-
-    # Invalidate all flows and path info.
-    # For link adds, this makes sure that if a new link leads to an
-    # improved path, we use it.
-    # For link removals, this makes sure that we don't use a
-    # path that may have been broken.
-    #NOTE: This could be radically improved! (e.g., not *ALL* paths break)
-    clear = of.ofp_flow_mod(command=of.OFPFC_DELETE)
-    for sw in switches.itervalues():
-      if sw.connection is None: continue
-      sw.connection.send(clear)
-    path_map.clear()
+    old_port = adjacency[sw1][sw2]
+    bad_macs = set()
 
     if event.removed:
       # This link no longer okay
@@ -472,7 +683,6 @@ class l2_multi (EventMixin):
 
       # If we have learned a MAC on this port which we now know to
       # be connected to a switch, unlearn it.
-      bad_macs = set()
       for mac,(sw,port) in mac_map.iteritems():
         if sw is sw1 and port == l.port1: bad_macs.add(mac)
         if sw is sw2 and port == l.port2: bad_macs.add(mac)
@@ -480,6 +690,30 @@ class l2_multi (EventMixin):
         log.debug("Unlearned %s", mac)
         del mac_map[mac]
 
+    new_port = adjacency[sw1][sw2]
+    if new_port == old_port and not bad_macs:
+      # Nothing that any installed flow depends on has changed
+      return
+
+    # Invalidate all flows.
+    # For link adds, this makes sure that if a new link leads to an
+    # improved path, we use it.
+    # For link removals, this makes sure that we don't use a
+    # path that may have been broken.
+    #NOTE: This could be radically improved! (e.g., not *ALL* paths break)
+    clear = of.ofp_flow_mod(command=of.OFPFC_DELETE)
+    for sw in switches.itervalues():
+      if sw.connection is None: continue
+      sw.connection.send(clear)
+
+    if new_port != old_port:
+      # Cached paths have their ports baked in
+      path_cache.clear()
+      next_hop_cache.clear()
+      if (old_port is None) != (new_port is None):
+        # Connectivity changed (rather than just the port used)
+        _update_paths(sw1, sw2, new_port is not None)
+
   def _handle_openflow_ConnectionUp (self, event):
     sw = switches.get(event.dpid)
     if sw is None:
@@ -490,17 +724,65 @@ class l2_multi (EventMixin):
     else:
       sw.connect(event.connection)
 
+  def _handle_openflow_PortStatsReceived (self, event):
+    now = time.time()
+    for ps in event.stats:
+      key = (event.dpid, ps.port_no)
+      old = port_load.get(key)
+      rate = 0.0
+      if old is not None and now > old[1] and ps.tx_bytes >= old[0]:
+        rate = (ps.tx_bytes - old[0]) * 8 / (now - old[1]) / 1000000.0
+      port_load[key] = (ps.tx_bytes, now, rate)
+
   def _handle_openflow_BarrierIn (self, event):
-    wp = waiting_paths.pop((event.dpid,event.xid), None)
-    if not wp:
+    wps = waiting_paths.pop((event.dpid,event.xid), None)
+    if not wps:
       #log.info("No waiting packet %s,%s", event.dpid, event.xid)
       return
     #log.debug("Notify waiting packet %s,%s", event.dpid, event.xid)
-    wp.notify(event)
+    for wp in wps:
+      wp.notify(event)
+
+  def setup_latency (self, percentiles = (50, 90, 99)):
+    """
+    Returns {percentile:seconds} for the time taken by recent path setups
+    """
+    times = sorted(path_setup_times)
+    if not times: return {}
+    return dict((p, times[min(len(times)-1, int(len(times) * p / 100.0))])
+                for p in percentiles)
+
 
+def _request_port_stats ():
+  for sw in switches.itervalues():
+    if sw.connection is None: continue
+    sw.connection.send(of.ofp_stats_request(body=of.ofp_port_stats_request()))
+
+
+def launch (lazy_paths = False, ecmp = False, ecmp_stats = None):
+  """
+  Starts l2_multi
+
+  --lazy_paths only computes paths from a switch when they're needed
+  --ecmp spreads flows across equal-cost paths
+  --ecmp_stats[=<seconds>] weights ECMP by link load from port stats
+  """
+  global LAZY_PATHS, ECMP, ECMP_STATS_INTERVAL
+  LAZY_PATHS = str_to_bool(lazy_paths)
+  ECMP = str_to_bool(ecmp)
+  if ecmp_stats is not None:
+    ECMP = True
+    ECMP_STATS_INTERVAL = 5 if ecmp_stats is True else float(ecmp_stats)
+    Timer(ECMP_STATS_INTERVAL, _request_port_stats, recurring=True)
 
-def launch ():
   core.registerNew(l2_multi)
 
+  def expire ():
+    WaitingPath.expire_waiting_paths()
+    latency = core.l2_multi.setup_latency()
+    if latency:
+      log.debug("Path setup times: %s", " ".join("p%s=%0.1fms"
+                % (p,latency[p]*1000) for p in sorted(latency)))
+
   timeout = min(max(PATH_SETUP_TIME, 5) * 2, 15)
-  Timer(timeout, WaitingPath.expire_waiting_paths, recurring=True)
+  Timer(timeout, expire, recurring=True)
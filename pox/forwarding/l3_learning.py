@@ -212,7 +212,7 @@ class l3_switch (EventMixin):
           if self.wide:
             match = of.ofp_match(dl_type = packet.type, nw_dst = dstaddr)
           else:
-            match = of.ofp_match.from_packet(packet, inport)
+            match = of.ofp_match.from_packet(event.data, inport)
 
           msg = of.ofp_flow_mod(command=of.OFPFC_ADD,
                                 idle_timeout=FLOW_IDLE_TIMEOUT,
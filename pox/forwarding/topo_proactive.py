@@ -53,6 +53,9 @@ switches_by_id = {}
 # [sw1][sw2] -> (distance, intermediate)
 path_map = defaultdict(lambda:defaultdict(lambda:(None,None)))
 
+# (sw1,sw2) -> cooked path (see _get_path()).  Cleared along with path_map.
+path_cache = {}
+
 
 def dpid_to_mac (dpid):
   return EthAddr("%012x" % (dpid & 0xffFFffFFffFF,))
@@ -74,6 +77,7 @@ def _calc_paths ():
 
   sws = switches_by_dpid.values()
   path_map.clear()
+  path_cache.clear()
   for k in sws:
     for j,port in adjacency[k].iteritems():
       if port is None: continue
@@ -97,43 +101,34 @@ def _calc_paths ():
   #dump()
 
 
-def _get_raw_path (src, dst):
+def _get_path (src, dst):
   """
-  Get a raw path (just a list of nodes to traverse)
+  Gets a cooked path -- a tuple of (node,out_port)
+
+  Paths are built from the (cached) paths to and from the intermediate
+  switch, and are themselves kept in path_cache.
   """
+  key = (src,dst)
+  try:
+    return path_cache[key]
+  except KeyError:
+    pass
+
   if len(path_map) == 0: _calc_paths()
   if src is dst:
     # We're here!
-    return []
-  if path_map[src][dst][0] is None:
-    return None
-  intermediate = path_map[src][dst][1]
-  if intermediate is None:
-    # Directly connected
-    return []
-  return _get_raw_path(src, intermediate) + [intermediate] + \
-         _get_raw_path(intermediate, dst)
-
-
-def _get_path (src, dst):
-  """
-  Gets a cooked path -- a list of (node,out_port)
-  """
-  # Start with a raw path...
-  if src == dst:
-    path = [src]
+    r = ()
+  elif path_map[src][dst][0] is None:
+    r = None
   else:
-    path = _get_raw_path(src, dst)
-    if path is None: return None
-    path = [src] + path + [dst]
-
-  # Now add the ports
-  r = []
-  for s1,s2 in zip(path[:-1],path[1:]):
-    out_port = adjacency[s1][s2]
-    r.append((s1,out_port))
-    in_port = adjacency[s2][s1]
+    intermediate = path_map[src][dst][1]
+    if intermediate is None:
+      # Directly connected
+      r = ((src,adjacency[src][dst]),)
+    else:
+      r = _get_path(src, intermediate) + _get_path(intermediate, dst)
 
+  path_cache[key] = r
   return r
 
 
@@ -427,6 +422,7 @@ class topo_addressing (object):
       if sw.connection is None: continue
       sw.connection.send(clear)
     path_map.clear()
+    path_cache.clear()
 
     if event.removed:
       # This link no longer okay
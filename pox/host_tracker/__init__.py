@@ -26,7 +26,13 @@ import logging
 log.setLevel(logging.INFO)
 from pox.lib.addresses import EthAddr
 
-def launch (src_mac = None, no_flow = False, **kw):
+def launch (src_mac = None, no_flow = False, batch = None, **kw):
+  """
+  Starts host_tracker
+
+  --batch[=<seconds>] handles PacketIns in batches, delivered once per
+  scheduler cycle or after the given number of seconds
+  """
   for k, v in kw.iteritems():
     if k in host_tracker.timeoutSec:
       host_tracker.timeoutSec[k] = int(v)
@@ -36,5 +42,9 @@ def launch (src_mac = None, no_flow = False, **kw):
       log.debug("Changing ping limit to %s",v)
     else:
       log.error("Unknown option: %s(=%s)",k,v)
+  window = None
+  if batch is not None and batch is not True:
+    window = float(batch)
   core.registerNew(host_tracker.host_tracker, ping_src_mac = src_mac,
-      install_flow = not no_flow)
+      install_flow = not no_flow, batch = batch is not None,
+      batch_window = window)
@@ -51,6 +51,7 @@ from pox.lib.recoco import Timer
 from pox.lib.revent import Event, EventHalt
 
 import pox.openflow.libopenflow_01 as of
+from pox.openflow import PacketIn
 
 import pox.openflow.discovery as discovery
 
@@ -211,7 +212,7 @@ class host_tracker (EventMixin):
   _eventMixin_events = set([HostEvent])
 
   def __init__ (self, ping_src_mac = None, install_flow = True,
-      eat_packets = True):
+      eat_packets = True, batch = False, batch_window = None):
 
     if ping_src_mac is None:
       ping_src_mac = DEFAULT_ARP_PING_SRC_MAC
@@ -220,6 +221,10 @@ class host_tracker (EventMixin):
     self.install_flow = install_flow
     self.eat_packets = eat_packets
 
+    # If batch, PacketIns are handled in batches (see _handle_PacketIns())
+    self.batch = batch
+    self.batch_window = batch_window
+
     # The following tables should go to Topology later
     self.entryByMAC = {}
     self._t = Timer(timeoutSec['timerInterval'],
@@ -232,6 +237,9 @@ class host_tracker (EventMixin):
     core.listen_to_dependencies(self, listen_args=listen_args)
 
   def _all_dependencies_met (self):
+    if self.batch:
+      core.openflow.add_batch_listener(self._handle_PacketIns, PacketIn,
+                                       window=self.batch_window)
     log.info("host_tracker ready")
 
   # The following two functions should go to Topology also
@@ -336,6 +344,21 @@ class host_tracker (EventMixin):
     removing the info from antoher entry previously with that IP address).
     It does not forward any packets, just extract info from them.
     """
+    if self.batch:
+      # Only our own ping replies are handled right away (so that they can
+      # be eaten).  Everything else arrives in _handle_PacketIns().
+      if not self.eat_packets: return
+      if event.parsed.dst != self.ping_src_mac: return
+    return self._learn(event)
+
+  def _handle_PacketIns (self, events):
+    """
+    Handles a batch of PacketIns (if batch is set)
+    """
+    for event in events:
+      self._learn(event)
+
+  def _learn (self, event):
     dpid = event.connection.dpid
     inport = event.port
     packet = event.parsed
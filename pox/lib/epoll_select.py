@@ -27,6 +27,37 @@ class EpollSelect(object):
     self.lastrl_set = set()
     self.lastwl = []
     self.lastwl_set = set()
+    self.persistent = {} # obj -> fd
+
+  def _persistent_mask(self, read, write):
+    mask = select.EPOLLONESHOT
+    if read: mask |= select.EPOLLIN|select.EPOLLPRI
+    if write: mask |= select.EPOLLOUT
+    return mask
+
+  def add_persistent(self, obj, read=True, write=False):
+    """ register obj until remove_persistent() is called.
+        Persistent objects are reported by select() without having to be
+        passed to it.  They're one-shot: once reported, an object is
+        disarmed until rearmed with modify_persistent().
+        Don't pass persistent objects to select() as well.
+    """
+    fd = obj.fileno() if hasattr(obj, "fileno") else obj
+    self.persistent[obj] = fd
+    self.fd_to_obj[fd] = obj
+    self.epoll.register(fd, self._persistent_mask(read, write))
+
+  def modify_persistent(self, obj, read=True, write=False):
+    """ change the interest mask of a persistent object (and rearm it) """
+    self.epoll.modify(self.persistent[obj], self._persistent_mask(read, write))
+
+  def remove_persistent(self, obj):
+    fd = self.persistent.pop(obj)
+    try:
+      self.epoll.unregister(fd)
+    except (IOError, OSError):
+      # Already closed (which removes it from the epoll set)
+      pass
 
   def select(self, rl, wl, xl, timeout=0):
     """ emulate the select semantics on top of _epoll.
@@ -71,7 +71,7 @@ class ethernet(packet_base):
 
   type_parsers = {}
 
-  def __init__(self, raw=None, prev=None, **kw):
+  def __init__(self, raw=None, prev=None, lazy=False, **kw):
     packet_base.__init__(self)
 
     if len(ethernet.type_parsers) == 0:
@@ -102,6 +102,9 @@ class ethernet(packet_base):
     self.type = 0
     self.next = b''
 
+    if lazy:
+      self.lazy = True
+
     if raw is not None:
       self.parse(raw)
 
@@ -124,7 +127,7 @@ class ethernet(packet_base):
     self.hdr_len = ethernet.MIN_LEN
     self.payload_len = alen - self.hdr_len
 
-    self.next = ethernet.parse_next(self, self.type, raw, ethernet.MIN_LEN)
+    self._set_next(ethernet.parse_next, self.type, raw, ethernet.MIN_LEN)
     self.parsed = True
 
   @staticmethod
@@ -148,26 +148,32 @@ class ipv4(packet_base):
         # packet
         self.parsed = True
 
+        self._set_next(ipv4._parse_payload, raw)
+
+    def _parse_payload(self, raw):
+        dlen = len(raw)
         length = self.iplen
         if length > dlen:
             length = dlen # Clamp to what we've got
+        p = None
         if self.protocol == ipv4.UDP_PROTOCOL:
-            self.next = udp(raw=raw[self.hl*4:length], prev=self)
+            p = udp(raw=raw[self.hl*4:length], prev=self)
         elif self.protocol == ipv4.TCP_PROTOCOL:
-            self.next = tcp(raw=raw[self.hl*4:length], prev=self)
+            p = tcp(raw=raw[self.hl*4:length], prev=self)
         elif self.protocol == ipv4.ICMP_PROTOCOL:
-            self.next = icmp(raw=raw[self.hl*4:length], prev=self)
+            p = icmp(raw=raw[self.hl*4:length], prev=self)
         elif self.protocol == ipv4.IGMP_PROTOCOL:
-            self.next = igmp(raw=raw[self.hl*4:length], prev=self)
+            p = igmp(raw=raw[self.hl*4:length], prev=self)
         elif self.protocol == ipv4.GRE_PROTOCOL:
-            self.next = gre(raw=raw[self.hl*4:length], prev=self)
+            p = gre(raw=raw[self.hl*4:length], prev=self)
         elif dlen < self.iplen:
             self.msg('(ip parse) warning IP packet data shorter than IP len: %u < %u' % (dlen, self.iplen))
         else:
-            self.next =  raw[self.hl*4:length]
+            p =  raw[self.hl*4:length]
 
-        if isinstance(self.next, packet_base) and not self.next.parsed:
-            self.next = raw[self.hl*4:length]
+        if isinstance(p, packet_base) and not p.parsed:
+            p = raw[self.hl*4:length]
+        return p
 
     def checksum(self):
         data = struct.pack('!BBHHHBBHII', (self.v << 4) + self.hl, self.tos,
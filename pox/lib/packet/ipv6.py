@@ -369,22 +369,26 @@ class ipv6 (packet_base):
 
     self.parsed = True
 
+    self._set_next(ipv6._parse_payload, raw, offset, length, nht)
+
+  def _parse_payload (self, raw, offset, length, nht):
     #TODO: This should be done a better way (and shared with IPv4?).
     if nht == self.UDP_PROTOCOL:
-      self.next = udp(raw=raw[offset:offset+length], prev=self)
+      p = udp(raw=raw[offset:offset+length], prev=self)
     elif nht == self.TCP_PROTOCOL:
-      self.next = tcp(raw=raw[offset:offset+length], prev=self)
+      p = tcp(raw=raw[offset:offset+length], prev=self)
     elif nht == self.ICMP6_PROTOCOL:
-      self.next = icmpv6(raw=raw[offset:offset+length], prev=self)
+      p = icmpv6(raw=raw[offset:offset+length], prev=self)
 #    elif nht == self.IGMP_PROTOCOL:
-#      self.next = igmp(raw=raw[offset:offset+length], prev=self)
+#      p = igmp(raw=raw[offset:offset+length], prev=self)
     elif nht == self.NO_NEXT_HEADER:
-      self.next = None
+      p = None
     else:
-      self.next =  raw[offset:offset+length]
+      p =  raw[offset:offset+length]
 
-    if isinstance(self.next, packet_base) and not self.next.parsed:
-      self.next = raw[offset:offset+length]
+    if isinstance(p, packet_base) and not p.parsed:
+      p = raw[offset:offset+length]
+    return p
 
   def add_header (self, eh):
     if self.extension_headers:
@@ -91,8 +91,8 @@ class llc (packet_base):
     self.parsed = True
 
     if self.oui == '\0\0\0':
-      self.next = ethernet.parse_next(self, self.eth_type, raw, self.length,
-                                      allow_llc = False)
+      self._set_next(ethernet.parse_next, self.eth_type, raw, self.length,
+                     False)
     else:
       self.next = raw[self.length:]
 
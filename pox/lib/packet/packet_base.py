@@ -61,6 +61,11 @@ class packet_base (object):
         def __str__(self):
             # optionally convert to human readable string
     """
+    # If True, parse() leaves the payload undecoded until .next (or
+    # .payload, find(), etc.) is first used.  Lazy packets make their
+    # payloads lazy too.
+    lazy = False
+
     def __init__ (self):
         self.next = None
         self.prev = None
@@ -73,6 +78,28 @@ class packet_base (object):
           del kw['payload']
         initHelper(self, kw)
 
+    def _set_next (self, parse, *args):
+        """
+        Sets .next to parse(self, *args), deferring the call if lazy
+        """
+        prev = self.prev
+        if self.lazy or (isinstance(prev, packet_base) and prev.lazy):
+            self.lazy = True
+            self.__dict__.pop('next', None)
+            self._next_parse = (parse, args)
+        else:
+            self.next = parse(self, *args)
+
+    def __getattr__ (self, attr):
+        # Only called when normal lookup fails, i.e., for a lazy .next
+        if attr == 'next':
+            pending = self.__dict__.pop('_next_parse', None)
+            if pending is not None:
+                self.next = pending[0](self, *pending[1])
+                return self.next
+        raise AttributeError("'%s' object has no attribute '%s'"
+                             % (type(self).__name__, attr))
+
     def msg(self, *args):
         """ Shortcut for logging """
         #TODO: Remove?
@@ -432,6 +432,19 @@ class PCap (object):
       data = bytes(data) # Give it a try...
     return pcapc.inject(self.pcap, data)
 
+  def inject_many (self, frames):
+    """
+    Sends a sequence of raw frames (bytes or bytearrays)
+
+    Returns the number of frames sent.
+    """
+    inject = pcapc.inject
+    pcap = self._pcap
+    sent = 0
+    for data in frames:
+      if inject(pcap, data) > 0: sent += 1
+    return sent
+
   def set_filter (self, filter, optimize = True):
     if self.pcap is None:
       self.deferred_filter = (filter, optimize)
@@ -14,6 +14,7 @@
 
 from __future__ import print_function
 from collections import deque
+from heapq import heappush, heappop, heapify
 from Queue import PriorityQueue
 from Queue import Queue
 import time
@@ -24,7 +25,6 @@ import traceback
 import os
 import socket
 import pox.lib.util
-import random
 from types import GeneratorType
 from pox.lib.epoll_select import EpollSelect
 
@@ -47,8 +47,16 @@ def generateTaskID ():
 class BaseTask  (object):
   id = None
   #running = False
+
+  # Scheduling weight.  Tasks with the same priority share a ready queue,
+  # and each queue gets a share of the scheduler proportional to this.
+  # Priorities <= 0 only run when nothing else is ready.
   priority = 1
 
+  # Time-slice accounting (only updated if the scheduler is doing it)
+  run_time = 0.0 # Total seconds spent running
+  run_count = 0 # Number of slices run
+
   @classmethod
   def new (cls, *args, **kw):
     """
@@ -138,14 +146,127 @@ class Task (BaseTask):
                                getattr(self,'id',None))
 
 
+class _ReadyLevel (object):
+  """
+  The ready tasks with a given priority
+  """
+  __slots__ = ['weight', 'tasks', 'vtime']
+
+  def __init__ (self, weight):
+    self.weight = weight
+    self.tasks = deque()
+    self.vtime = 0.0
+
+
+class ReadyQueue (object):
+  """
+  Multi-level ready queue for a Scheduler
+
+  Tasks are queued FIFO by priority level, and levels are served by
+  weighted fair queueing: each level has a virtual time which advances by
+  the cost of each slice it runs divided by its weight, and the non-empty
+  level with the lowest virtual time goes next.  Thus a level with twice
+  the weight gets twice as many slices (or twice the time, if the
+  scheduler charges by time), but no level gets starved.
+
+  Levels with a weight of zero or less only run when nothing else is ready.
+
+  Tasks added with first=True jump ahead of everything.
+
+  Adding tasks is safe from any thread.
+  """
+  def __init__ (self):
+    self._lock = threading.Lock()
+    self._first = deque()
+    self._levels = {} # priority -> _ReadyLevel
+    self._active = [] # _ReadyLevels with tasks (excluding idle ones)
+    self._idle = [] # _ReadyLevels with tasks and weights <= 0
+    self._vtime = 0.0 # Virtual time of the last level served
+    self._last = None # Last level served
+    self._count = 0
+
+  def __len__ (self):
+    return self._count
+
+  def __contains__ (self, task):
+    with self._lock:
+      if task in self._first: return True
+      level = self._levels.get(task.priority)
+      if level is not None and task in level.tasks: return True
+      # Priority may have changed since it was queued
+      return any(task in l.tasks for l in self._levels.itervalues())
+
+  def append (self, task):
+    with self._lock:
+      p = task.priority
+      level = self._levels.get(p)
+      if level is None:
+        level = _ReadyLevel(p)
+        self._levels[p] = level
+      if not level.tasks:
+        if p <= 0:
+          self._idle.append(level)
+        else:
+          # Don't let a level bank credit while it had nothing to do
+          if level.vtime < self._vtime: level.vtime = self._vtime
+          self._active.append(level)
+      level.tasks.append(task)
+      self._count += 1
+
+  def appendleft (self, task):
+    with self._lock:
+      self._first.appendleft(task)
+      self._count += 1
+
+  def popleft (self):
+    """
+    Removes and returns the next task to run (or None if there are none)
+    """
+    with self._lock:
+      self._last = None
+      if self._first:
+        self._count -= 1
+        return self._first.popleft()
+      best = None
+      for level in self._active:
+        if best is None or level.vtime < best.vtime: best = level
+      if best is not None:
+        active = self._active
+        self._vtime = best.vtime
+        self._last = best
+      elif self._idle:
+        best = self._idle[0]
+        active = self._idle
+      else:
+        return None
+      t = best.tasks.popleft()
+      if not best.tasks: active.remove(best)
+      self._count -= 1
+      return t
+
+  def charge (self, cost):
+    """
+    Charges the level of the last task popped for the cost of its slice
+    """
+    level = self._last
+    if level is not None:
+      level.vtime += cost / float(level.weight)
+
+
 class Scheduler (object):
   """ Scheduler for Tasks """
 
   def __init__ (self, isDefaultScheduler = None, startInThread = True,
-                daemon = False, use_epoll=False, threaded_selecthub = True):
-
-    self._ready = deque()
+                daemon = False, use_epoll=False, threaded_selecthub = True,
+                slice_accounting = False):
+    """
+    If slice_accounting is True, the time each slice takes is measured and
+    added to the task's run_time, and tasks' shares of the scheduler are
+    based on time.  Otherwise, they're based on the number of slices.
+    """
+    self._ready = ReadyQueue()
     self._hasQuit = False
+    self._slice_accounting = slice_accounting
 
     self._selectHub = SelectHub(self, use_epoll=use_epoll,
                                 threaded=threaded_selecthub)
@@ -255,6 +376,21 @@ class Scheduler (object):
 
     self._selectHub.break_idle()
 
+  def registerFD (self, task, fd, read = True, write = False):
+    """
+    Persistently register a task's interest in a file descriptor
+
+    The FD stays registered until unregisterFD(), and the task waits on all
+    its FDs at once with WaitIO.  See SelectHub.registerFD().
+    """
+    self._selectHub.registerFD(task, fd, read, write)
+
+  def modifyFD (self, fd, read = True, write = False):
+    self._selectHub.modifyFD(fd, read, write)
+
+  def unregisterFD (self, fd):
+    self._selectHub.unregisterFD(fd)
+
   def quit (self):
     self._hasQuit = True
 
@@ -274,33 +410,40 @@ class Scheduler (object):
   def cycle (self):
     #if len(self._ready) == 0: return False
 
-    # Patented hilarious priority system
-    #TODO: Replace it with something better
-    t = None
-    try:
-      while True:
-        t = self._ready.popleft()
-        if t.priority >= 1: break
-        if len(self._ready) == 0: break
-        if t.priority >= random.random(): break
-        self._ready.append(t)
-    except IndexError:
-      return False
+    t = self._ready.popleft()
+    if t is None: return False
 
     #print(len(self._ready), "tasks")
 
+    if self._slice_accounting:
+      start = time.time()
+      self._run_slice(t)
+      elapsed = time.time() - start
+      t.run_time += elapsed
+      t.run_count += 1
+      self._ready.charge(elapsed)
+    else:
+      self._run_slice(t)
+      self._ready.charge(1)
+
+    return True
+
+  def _run_slice (self, t):
+    """
+    Runs a task until it blocks or yields
+    """
     while True:
       try:
         rv = t.execute()
       except StopIteration:
-        return True
+        return
       except:
         try:
           print("Task", t, "caused exception and was de-scheduled")
           traceback.print_exc()
         except:
           pass
-        return True
+        return
 
       if isinstance(rv, BlockingOperation):
         try:
@@ -326,8 +469,6 @@ class Scheduler (object):
 
       break
 
-    return True
-
 
 #TODO: Read() and Write() BlockingOperations that use nonblocking sockets with
 #      SelectHub and do post-processing of the return value.
@@ -528,6 +669,24 @@ class Select (BlockingOperation):
     scheduler._selectHub.registerSelect(task, *self._args, **self._kw)
 
 
+class WaitIO (BlockingOperation):
+  """
+  Waits for IO on the FDs a task has registered with Scheduler.registerFD()
+
+  Unlike Select, the set of FDs doesn't need to be passed in each time, so
+  this is much cheaper when a task has a lot of FDs and only a few of them
+  are active.  The return value is like Select's: (rlist, wlist, xlist).
+  An FD which has been returned won't be returned again until the next
+  WaitIO, so it's fine for the task to not service everything at once.
+  """
+  def __init__ (self, timeout = None, timeIsAbsolute = False):
+    self._timeout = timeout
+    self._absolute = timeIsAbsolute
+
+  def execute (self, task, scheduler):
+    scheduler._selectHub.registerWait(task, self._timeout, self._absolute)
+
+
 defaultRecvFlags = 0
 try:
   defaultRecvFlags = socket.MSG_DONTWAIT
@@ -616,24 +775,53 @@ class Send (BlockingOperation):
     scheduler._selectHub.registerSelect(task, None, [self._fd], [self._fd])
 
 
+# Marks a SelectHub item as being a WaitIO
+_REGISTERED_FDS = object()
+
+
 #TODO: just merge this in with Scheduler?
 class SelectHub (object):
   """
   This class is a single select() loop that handles all Select() requests for
   a scheduler as well as timed wakes (i.e., Sleep()).
+
+  Timeouts are kept in a heap, so finding the next one is cheap no matter
+  how many tasks are waiting.  Entries in the heap are invalidated lazily:
+  when a task is woken by IO or unregistered, its heap entry is just left
+  behind and skipped when it reaches the top.
+
+  Besides one-off Select()s, tasks can register FDs persistently with
+  registerFD() and then wait on them with WaitIO.  With epoll, these stay
+  in the epoll set rather than being passed in on every cycle, so the
+  cost of a wakeup depends on the number of active FDs rather than the
+  total.  Persistent FDs are one-shot: once an FD is reported to its task,
+  it's disarmed until the task waits again.
   """
   def __init__ (self, scheduler, use_epoll=False, threaded=True):
-    # We store tuples of (elapse-time, task)
+    # Items are (task, rlist, wlist, xlist, timeout) tuples
     self._incoming = Queue() # Threadsafe queue for new items
+    self._unregistered = deque() # Tasks to unregister (threadsafe appends)
+    self._fd_ops = deque() # Persistent FD changes (threadsafe appends)
 
     self._scheduler = scheduler
     self._pinger = pox.lib.util.makePinger()
     if use_epoll:
-      self._select_func = EpollSelect().select
+      self._epoll = EpollSelect()
+      self._select_func = self._epoll.select
     else:
+      self._epoll = None
       self._select_func = select.select
 
-    self._tasks = {}
+    # Persistent FD state
+    self._fds = {} # FD -> [task, read, write, armed]
+    self._disarmed = {} # Task -> set of its FDs which have been reported
+    self._pending = {} # Task -> (r,w,x) reported while task wasn't waiting
+    self._parked = set() # Tasks in WaitIO
+
+    self._tasks = {} # Task -> item, for tasks waiting on IO
+    self._waiting = {} # Task -> item, for all waiting tasks
+    self._timers = [] # Heap of (timeout, seq, task, item)
+    self._timer_seq = 0
 
     self._thread = None
     if threaded:
@@ -690,26 +878,30 @@ class SelectHub (object):
     timeout = None
     timeoutTask = None
 
+    if self._fd_ops: self._process_fd_ops()
+
     now = time.time()
 
-    expired = None
+    # Release expired timeouts and find the next one
+    timers = self._timers
+    waiting = self._waiting
+    while timers:
+      tto,_,t,item = timers[0]
+      if waiting.get(t) is not item:
+        # Stale -- task was already woken or unregistered
+        heappop(timers)
+        continue
+      if tto <= now:
+        # Already expired
+        heappop(timers)
+        self._remove(t)
+        self._return(t, ([],[],[]))
+        continue
+      timeout = tto - now
+      timeoutTask = t
+      break
 
-    #TODO: Fix this.  It's pretty expensive.  There had been some code which
-    #      priority heaped this, but I don't think a fully working version
-    #      ever quite made it.
     for t,trl,twl,txl,tto in tasks.itervalues():
-      if tto != None:
-        if tto <= now:
-          # Already expired
-          if expired is None: expired = []
-          expired.append(t)
-          if tto-now > 0.1: print("preexpired",tto,now,tto-now)
-          continue
-        tt = tto - now
-        if tt < timeout or timeout is None:
-          timeout = tt
-          timeoutTask = t
-
       if trl:
         for i in trl: rl[i] = t
       if twl:
@@ -717,54 +909,189 @@ class SelectHub (object):
       if txl:
         for i in txl: xl[i] = t
 
-    if expired:
-      for t in expired:
-        del tasks[t]
-        self._return(t, ([],[],[]))
+    # Persistent FDs are already in the epoll set; without epoll, we have
+    # to pass the armed ones in.
+    prl = []
+    pwl = []
+    pxl = []
+    if self._epoll is None:
+      for fd,info in self._fds.iteritems():
+        if not info[3]: continue
+        if info[1]: prl.append(fd)
+        if info[2]: pwl.append(fd)
+        pxl.append(fd)
 
     if timeout is None: timeout = CYCLE_MAXIMUM
-    ro, wo, xo = self._select_func( rl.keys() + [self._pinger],
-                                    wl.keys(),
-                                    xl.keys(), timeout )
+    try:
+      ro, wo, xo = self._select_func( rl.keys() + prl + [self._pinger],
+                                      wl.keys() + pwl,
+                                      xl.keys() + pxl, timeout )
+    except Exception:
+      # Probably an FD which was closed while we were waiting on it.  If
+      # there are persistent FD changes pending, apply them and try again.
+      if not self._fd_ops: raise
+      self._process_fd_ops()
+      return
 
     if len(ro) == 0 and len(wo) == 0 and len(xo) == 0 and timeoutTask != None:
       # IO is idle - dispatch timers / release timeouts
-      del tasks[timeoutTask]
-      self._return(timeoutTask, ([],[],[]))
+      if timeoutTask in waiting:
+        self._remove(timeoutTask)
+        self._return(timeoutTask, ([],[],[]))
     else:
       # We have IO events
       if self._pinger in ro:
         self._pinger.pongAll()
+        self._process_fd_ops()
         while not self._incoming.empty():
-          stuff = self._incoming.get(True)
-          task = stuff[0]
-          assert task not in tasks
-          tasks[task] = stuff
+          item = self._incoming.get(True)
+          self._add(item)
           self._incoming.task_done()
+        while self._unregistered:
+          self._remove(self._unregistered.popleft())
         if len(ro) == 1 and len(wo) == 0 and len(xo) == 0:
           # Just recycle
           return
         ro.remove(self._pinger)
 
       # At least one thread is going to be resumed
+      fds = self._fds
       for i in ro:
-        task = rl[i]
+        if i in fds:
+          self._fd_ready(i, 0, rets)
+          continue
+        task = rl.get(i)
+        if task is None: continue # Persistent FD which is now gone
         if task not in rets: rets[task] = ([],[],[])
         rets[task][0].append(i)
       for i in wo:
-        task = wl[i]
+        if i in fds:
+          self._fd_ready(i, 1, rets)
+          continue
+        task = wl.get(i)
+        if task is None: continue
         if task not in rets: rets[task] = ([],[],[])
         rets[task][1].append(i)
       for i in xo:
-        task = xl[i]
+        if i in fds:
+          self._fd_ready(i, 2, rets)
+          continue
+        task = xl.get(i)
+        if task is None: continue
         if task not in rets: rets[task] = ([],[],[])
         rets[task][2].append(i)
 
       for t,v in rets.iteritems():
-        del tasks[t]
+        self._remove(t)
         self._return(t, v)
       rets.clear()
 
+  def _add (self, item):
+    """
+    Start waiting on an item from registerSelect()
+    """
+    task,trl,twl,txl,tto = item
+    assert task not in self._waiting
+    if trl is _REGISTERED_FDS:
+      # WaitIO
+      self._rearm(task)
+      pending = self._pending.pop(task, None)
+      if pending:
+        self._return(task, pending)
+        return
+      self._parked.add(task)
+    elif trl or twl or txl:
+      self._tasks[task] = item
+    self._waiting[task] = item
+    if tto is not None:
+      self._timer_seq += 1
+      heappush(self._timers, (tto, self._timer_seq, task, item))
+      if len(self._timers) > 2 * len(self._waiting) + 64:
+        # Mostly stale entries; rebuild the heap
+        self._timers[:] = [x for x in self._timers
+                        if self._waiting.get(x[2]) is x[3]]
+        heapify(self._timers)
+
+  def _remove (self, task):
+    """
+    Stop waiting for a task
+
+    Any entry in the timer heap is left to be discarded lazily.
+    """
+    self._waiting.pop(task, None)
+    self._tasks.pop(task, None)
+    self._parked.discard(task)
+
+  def _fd_ready (self, fd, which, rets):
+    """
+    Handle a persistent FD being ready
+
+    which is 0, 1, or 2 for read, write, or exceptional.  If the owning
+    task is waiting, its return value is added to rets; otherwise it's
+    saved for the next time it waits.
+    """
+    info = self._fds[fd]
+    task = info[0]
+    if info[3]:
+      info[3] = False
+      self._disarmed.setdefault(task, set()).add(fd)
+    if task in self._parked:
+      if task not in rets: rets[task] = ([],[],[])
+      r = rets[task]
+    else:
+      r = self._pending.get(task)
+      if r is None:
+        r = ([],[],[])
+        self._pending[task] = r
+    if fd not in r[which]: r[which].append(fd)
+
+  def _rearm (self, task):
+    """
+    Rearm the FDs which have been reported to a task
+    """
+    disarmed = self._disarmed.pop(task, None)
+    if not disarmed: return
+    for fd in disarmed:
+      info = self._fds.get(fd)
+      if info is None or info[3]: continue
+      info[3] = True
+      if self._epoll is not None:
+        self._epoll.modify_persistent(fd, info[1], info[2])
+
+  def _process_fd_ops (self):
+    """
+    Apply changes from registerFD()/modifyFD()/unregisterFD()
+    """
+    ops = self._fd_ops
+    epoll = self._epoll
+    while ops:
+      fd,task,read,write = ops.popleft()
+      info = self._fds.get(fd)
+      if task is False:
+        # Unregister
+        if info is None: continue
+        del self._fds[fd]
+        if epoll is not None: epoll.remove_persistent(fd)
+        disarmed = self._disarmed.get(info[0])
+        if disarmed: disarmed.discard(fd)
+        pending = self._pending.get(info[0])
+        if pending:
+          for l in pending:
+            if fd in l: l.remove(fd)
+          if not any(pending): del self._pending[info[0]]
+      elif task is None:
+        # Modify
+        if info is None: continue
+        info[1] = read
+        info[2] = write
+        if info[3] and epoll is not None:
+          epoll.modify_persistent(fd, read, write)
+      else:
+        # Register
+        assert info is None, "FD registered twice"
+        self._fds[fd] = [task, read, write, True]
+        if epoll is not None: epoll.add_persistent(fd, read, write)
+
   def registerSelect (self, task, rlist = None, wlist = None, xlist = None,
                       timeout = None, timeIsAbsolute = False):
     if not timeIsAbsolute:
@@ -774,6 +1101,51 @@ class SelectHub (object):
     self._incoming.put((task, rlist, wlist, xlist, timeout))
     self._cycle()
 
+  def registerWait (self, task, timeout = None, timeIsAbsolute = False):
+    """
+    Wait for IO on the task's persistent FDs (used by WaitIO)
+    """
+    return self.registerSelect(task, _REGISTERED_FDS, None, None, timeout,
+                               timeIsAbsolute)
+
+  def registerFD (self, task, fd, read = True, write = False):
+    """
+    Persistently register interest in an FD for a task
+
+    fd can be an integer or anything with a fileno() method.  It remains
+    registered until unregisterFD(), and an FD can only be registered once.
+    Don't also pass it to Select().  Safe to call from any thread.
+    """
+    assert task is not None
+    self._fd_ops.append((fd, task, read, write))
+    self._cycle()
+
+  def modifyFD (self, fd, read = True, write = False):
+    """
+    Change whether we're interested in reading or writing a persistent FD
+    """
+    self._fd_ops.append((fd, None, read, write))
+    self._cycle()
+
+  def unregisterFD (self, fd):
+    """
+    Unregister a persistent FD
+
+    Call this before closing it.
+    """
+    self._fd_ops.append((fd, False, None, None))
+    self._cycle()
+
+  def unregister (self, task):
+    """
+    Stop waiting on IO and timeouts for a task
+
+    The task won't be woken by the SelectHub (though if it has already been
+    woken, this has no effect).  Safe to call from any thread.
+    """
+    self._unregistered.append(task)
+    self._cycle()
+
   def _cycle (self):
     """
     Cycle the wait thread so that new timers or FDs can be picked up
@@ -896,15 +1268,19 @@ class Timer (Task):
 
     if started: self.start(scheduler)
 
-  def start (self, *args, **kw):
+  def start (self, scheduler = None, *args, **kw):
     assert not self._started
     if not self._absolute_time:
       self._next += time.time()
     self._started = True
-    return super(Timer,self).start(*args, **kw)
+    self._scheduler = scheduler if scheduler is not None else defaultScheduler
+    return super(Timer,self).start(scheduler, *args, **kw)
 
   def cancel (self):
     self._cancelled = True
+    if self._started and self._scheduler is not None:
+      # Don't leave the timer sitting in the SelectHub until it expires
+      self._scheduler._selectHub.unregister(self)
 
   def run (self):
     while not self._cancelled:
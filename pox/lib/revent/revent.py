@@ -165,6 +165,8 @@ class Event (object):
   def _invoke (self, handler, *args, **kw):
     return handler(self, *args, **kw)
 
+_default_invoke = Event._invoke.im_func
+
 def handleEventException (source, event, args, kw, exc_info):
   """
   Called when an exception is raised by an event handler when the event
@@ -219,6 +221,7 @@ class EventMixin (object):
     elif self._eventMixin_events == None:
       self._eventMixin_events = set()
     self._eventMixin_events.add(eventType)
+    self._eventMixin_dispatch.clear()
 
   def __init__ (self):
     self._eventMixin_init()
@@ -228,6 +231,28 @@ class EventMixin (object):
       setattr(self, "_eventMixin_events", True)
     if not hasattr(self, "_eventMixin_handlers"):
       setattr(self, "_eventMixin_handlers", {})
+    if not hasattr(self, "_eventMixin_dispatch"):
+      setattr(self, "_eventMixin_dispatch", {})
+
+  def _eventMixin_compile (self, eventType):
+    """
+    Builds the dispatch table entry for an event type
+
+    The entry is (handlers, direct, valid).  handlers is a tuple of
+    (handler, once, eid), direct is True if handlers can be called without
+    going through Event._invoke(), and valid is True if the event type may
+    be raised by this object.  Entries are dropped whenever listeners
+    change, so raiseEvent() only does this work once per change.
+    """
+    handlers = tuple((h, once, eid) for (priority, h, once, eid)
+                     in self._eventMixin_handlers.get(eventType, ()))
+    invoke = getattr(eventType, "_invoke", None)
+    direct = getattr(invoke, "im_func", _default_invoke) is _default_invoke
+    valid = (self._eventMixin_events is True
+             or eventType in self._eventMixin_events)
+    entry = (handlers, direct, valid)
+    self._eventMixin_dispatch[eventType] = entry
+    return entry
 
   def raiseEventNoErrors (self, event, *args, **kw):
     """
@@ -256,62 +281,79 @@ class EventMixin (object):
     Returns the event object, unless it was never created (because there
     were no listeners) in which case returns None.
     """
-    self._eventMixin_init()
+    try:
+      dispatch = self._eventMixin_dispatch
+    except AttributeError:
+      self._eventMixin_init()
+      dispatch = self._eventMixin_dispatch
 
     classCall = False
     if isinstance(event, Event):
       eventType = event.__class__
       classCall = True
       if event.source is None: event.source = self
+      entry = dispatch.get(eventType) or self._eventMixin_compile(eventType)
+      handlers,direct,valid = entry
     elif issubclass(event, Event):
+      eventType = event
+      entry = dispatch.get(eventType) or self._eventMixin_compile(eventType)
+      handlers,direct,valid = entry
       # Check for early-out
-      if event not in self._eventMixin_handlers:
-        return None
-      if len(self._eventMixin_handlers[event]) == 0:
+      if not handlers:
         return None
 
       classCall = True
+      if valid:
+        event = eventType(*args, **kw)
+        args = ()
+        kw = {}
+        if event.source is None:
+          event.source = self
+    else:
       eventType = event
-      event = eventType(*args, **kw)
-      args = ()
-      kw = {}
-      if event.source is None:
-        event.source = self
+      entry = dispatch.get(eventType) or self._eventMixin_compile(eventType)
+      handlers,direct,valid = entry
     #print("raise",event,eventType)
-    if (self._eventMixin_events is not True
-        and eventType not in self._eventMixin_events):
+    if not valid:
       raise ReventError("Event %s not defined on object of type %s"
                         % (eventType, type(self)))
 
-    # Create a copy so that it can be modified freely during event
-    # processing.  It might make sense to change this.
-    handlers = self._eventMixin_handlers.get(eventType, [])
-    for (priority, handler, once, eid) in handlers:
-      if classCall:
-        rv = event._invoke(handler, *args, **kw)
-      else:
+    # The handlers are a tuple, so they can be modified freely during
+    # event processing.
+    for (handler, once, eid) in handlers:
+      if direct:
         rv = handler(event, *args, **kw)
+      else:
+        rv = event._invoke(handler, *args, **kw)
       if once: self.removeListener(eid)
-      if rv is None: continue
-      if rv is False:
-        self.removeListener(eid)
-      if rv is True:
-        if classCall: event.halt = True
-        break
-      if type(rv) == tuple:
-        if len(rv) >= 2 and rv[1] == True:
-          self.removeListener(eid)
-        if len(rv) >= 1 and rv[0]:
-          if classCall: event.halt = True
-          break
-        if len(rv) == 0:
-          if classCall: event.halt = True
+      if rv is not None:
+        if self._eventMixin_handleReturn(rv, eid, event, classCall):
           break
       #if classCall and hasattr(event, "halt") and event.halt:
       if classCall and event.halt:
         break
     return event
 
+  def _eventMixin_handleReturn (self, rv, eid, event, classCall):
+    """
+    Acts on a handler's return value; returns True to stop handling
+    """
+    if rv is False:
+      self.removeListener(eid)
+    if rv is True:
+      if classCall: event.halt = True
+      return True
+    if type(rv) == tuple:
+      if len(rv) >= 2 and rv[1] == True:
+        self.removeListener(eid)
+      if len(rv) >= 1 and rv[0]:
+        if classCall: event.halt = True
+        return True
+      if len(rv) == 0:
+        if classCall: event.halt = True
+        return True
+    return False
+
   def removeListeners (self, listeners):
     altered = False
     for l in listeners:
@@ -375,6 +417,7 @@ class EventMixin (object):
                                                 if x[1] != handler]
         altered = altered or l != len(self._eventMixin_handlers[eventType])
 
+    self._eventMixin_dispatch.clear()
     return altered
 
   def addListenerByName (self, *args, **kw):
@@ -406,6 +449,39 @@ class EventMixin (object):
     return self.addListener(t, handler, once=once, weak=weak, byName=by_name,
                             priority=priority)
 
+  def add_batch_listener (self, handler, event_type=None, event_name=None,
+                          priority=None, schedule=None):
+    """
+    Add a handler which is called with lists of events.
+
+    Events are collected from the time the first one of a batch is raised
+    until the batch is flushed, and handler is then called with the list.
+    schedule is called with the flush function when a batch starts, and
+    should arrange for it to be called later (e.g., core.call_later).
+    Batch handlers can't halt events, and their return values are ignored.
+
+    The return value can be used for removing the listener.
+    """
+    if schedule is None:
+      raise RuntimeError("No way to schedule batches")
+    if (not event_type) and not (event_name):
+      if not handler.func_name.startswith("_handle_"):
+        raise RuntimeError("Could not infer event type")
+      event_name = handler.func_name.rsplit('_', 1)[-1]
+    by_name = True if event_name else False
+    t = event_name if by_name else event_type
+
+    batch = []
+    def flush ():
+      events = batch[:]
+      del batch[:]
+      if events: handler(events)
+    def collect (event, *args, **kw):
+      batch.append(event)
+      if len(batch) == 1: schedule(flush)
+
+    return self.addListener(t, collect, byName=by_name, priority=priority)
+
   def addListener (self, eventType, handler, once=False, weak=False,
                    priority=None, byName=False):
     """
@@ -467,6 +543,7 @@ class EventMixin (object):
     if priority is not None:
       # If priority is specified, sort the event handlers
       handlers.sort(reverse = True, key = operator.itemgetter(0))
+    self._eventMixin_dispatch.pop(eventType, None)
 
     return (eventType,eid)
 
@@ -497,6 +574,7 @@ class EventMixin (object):
     Remove all handlers from this object
     """
     self._eventMixin_handlers = {}
+    self._eventMixin_dispatch = {}
 
 
 def autoBindEvents (sink, source, prefix='', weak=False, priority=None):
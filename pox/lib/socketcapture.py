@@ -33,6 +33,12 @@ class SocketWedge (object):
     self._recv_out(r)
     return r
 
+  def recv_into (self, buffer, nbytes = 0, *args, **kw):
+    r = self._socket.recv_into(buffer, nbytes, *args, **kw)
+    d = buffer[:r]
+    self._recv_out(d.tobytes() if isinstance(d, memoryview) else bytes(d))
+    return r
+
   def __getattr__ (self, n):
     return getattr(self._socket, n)
 
@@ -77,6 +77,27 @@ class ConnectionDown (Event):
     self.connection = connection
     self.dpid = connection.dpid
 
+class SendBufferFull (Event):
+  """
+  Raised when a connection's send queue passes its high water mark
+
+  The switch isn't keeping up with what's being sent to it.  Senders which
+  can back off should hold off until SendBufferDrained.
+  """
+  def __init__ (self, connection):
+    self.connection = connection
+    self.dpid = connection.dpid
+    self.queued = connection._send_queued
+
+class SendBufferDrained (Event):
+  """
+  Raised when a full send queue drains to its low water mark
+  """
+  def __init__ (self, connection):
+    self.connection = connection
+    self.dpid = connection.dpid
+    self.queued = connection._send_queued
+
 class PortStatus (Event):
   """
   Fired in response to port status changes.
@@ -172,6 +193,11 @@ class PacketIn (Event):
   data (bytes) - raw packet data
   parsed (packet subclasses) - pox.lib.packet's parsed version
   """
+
+  # Parse lazily, so that payloads past the ethernet header are only
+  # decoded if a handler actually looks at them
+  lazy_parse = True
+
   def __init__ (self, connection, ofp):
     self.connection = connection
     self.ofp = ofp
@@ -182,7 +208,7 @@ class PacketIn (Event):
 
   def parse (self):
     if self._parsed is None:
-      self._parsed = ethernet(self.data)
+      self._parsed = ethernet(self.data, lazy=self.lazy_parse)
     return self._parsed
 
   @property
@@ -337,6 +363,8 @@ class OpenFlowNexus (EventMixin):
     ConnectionHandshakeComplete,
     ConnectionUp,
     ConnectionDown,
+    SendBufferFull,
+    SendBufferDrained,
     FeaturesReceived,
     PortStatus,
     PacketIn,
@@ -370,6 +398,24 @@ class OpenFlowNexus (EventMixin):
   def connections (self):
     return self._connections
 
+  def add_batch_listener (self, handler, event_type=None, event_name=None,
+                          priority=None, schedule=None, window=None):
+    """
+    Add a handler which is called with lists of events.
+
+    By default, events are delivered in a batch once per scheduler cycle.
+    If window is set, they're collected for that many seconds instead.
+    See EventMixin.add_batch_listener().
+    """
+    if schedule is None:
+      from pox.core import core
+      if window is None:
+        schedule = core.call_later
+      else:
+        schedule = lambda flush: core.call_delayed(window, flush)
+    return EventMixin.add_batch_listener(self, handler, event_type,
+                                         event_name, priority, schedule)
+
   def getConnection (self, dpid):
     """
     Get the Connection object associated with a DPID.
@@ -0,0 +1,282 @@
+# Copyright 2013 James McCauley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Classifies batches of raw packets against a FlowTable using NumPy
+
+The header fields of a whole batch are extracted into columns at once.
+Entries which share a wildcard mask are then matched against them in one
+go, by searching the entries' sorted keys for each packet's key.  For
+each packet, the result is the index (in the table's entries) of the
+entry that FlowTable.entry_for_packet() would find, or -1.
+
+Frames the vectorized extraction doesn't handle (e.g., LLC frames and
+TCP headers with options) are handled by ofp_match.from_packet().
+
+Requires NumPy.
+"""
+
+import numpy as np
+import struct
+import pox.openflow.libopenflow_01 as of
+from pox.openflow.flow_table import FlowTableModification
+from pox.openflow.flow_table import _exact_fields, _match_values
+from pox.openflow.flow_table import _ip_prefix_mask
+
+# Order of the rows returned by extract_fields()
+FIELDS = _exact_fields + ('nw_src', 'nw_dst')
+_rows = dict((f, i) for i,f in enumerate(FIELDS))
+
+# Enough for Ethernet, a VLAN tag, IPv4 with options, and L4 ports
+_HEADER_LEN = 96
+
+
+def _eth_int (addr):
+  return struct.unpack("!Q", b"\0\0" + addr.toRaw())[0]
+
+
+def _value (field, value):
+  """
+  Converts a _match_values() value to a column value (-1 for None)
+  """
+  if value is None: return -1
+  if field in ('dl_src', 'dl_dst'): return _eth_int(value)
+  return value
+
+
+def extract_fields (frames, in_ports):
+  """
+  Extracts exact match fields from raw frames into columns
+
+  in_ports is a sequence of port numbers or a single one for all frames.
+  Returns an int64 array with a row for each of FIELDS and a column for
+  each frame.  Fields ofp_match.from_packet() would leave wildcarded
+  (e.g., nw_src for non-IP packets) are -1.
+  """
+  n = len(frames)
+  cols = np.full((len(FIELDS), n), -1, dtype=np.int64)
+  if not n: return cols
+  cols[_rows['in_port']] = in_ports
+
+  w = _HEADER_LEN
+  pad = b"\0" * w
+  h = np.frombuffer(b"".join([(bytes(f[:w]) + pad)[:w] for f in frames]),
+                    dtype=np.uint8).reshape(n, w).astype(np.int64)
+  length = np.array([len(f) for f in frames], dtype=np.int64)
+  each = np.arange(n)
+
+  def u8 (offset):
+    return h[each, offset]
+  def u16 (offset):
+    return (h[each, offset] << 8) | h[each, offset + 1]
+  def u32 (offset):
+    return (u16(offset) << 16) | u16(offset + 2)
+  def mac (offset):
+    v = h[:, offset]
+    for i in range(1, 6):
+      v = (v << 8) | h[:, offset + i]
+    return v
+  def put (field, where, values):
+    row = cols[_rows[field]]
+    row[where] = values[where] if isinstance(values, np.ndarray) else values
+
+  # Rows we leave to ofp_match.from_packet()
+  bad = length < 14
+
+  cols[_rows['dl_dst']] = mac(0)
+  cols[_rows['dl_src']] = mac(6)
+  dl_type = u16(12)
+  bad |= dl_type < 1536
+
+  tagged = dl_type == 0x8100
+  bad |= tagged & (length < 18)
+  tci = u16(14)
+  dl_type = np.where(tagged, u16(16), dl_type)
+  cols[_rows['dl_type']] = dl_type
+  cols[_rows['dl_vlan']] = np.where(tagged, tci & 0x0fff, of.OFP_VLAN_NONE)
+  cols[_rows['dl_vlan_pcp']] = np.where(tagged, tci >> 13, 0)
+  offset = np.where(tagged, 18, 14)
+  dlen = length - offset
+
+  ip = dl_type == 0x0800
+  bad |= ip & (dlen < 20)
+  vhl = u8(offset)
+  hlen = (vhl & 0x0f) * 4
+  iplen = u16(offset + 2)
+  bad |= ip & (((vhl >> 4) != 4) | (hlen < 20) | (iplen < hlen) |
+               (hlen > dlen))
+  put('nw_tos', ip, u8(offset + 1))
+  put('nw_proto', ip, u8(offset + 9))
+  put('nw_src', ip, u32(offset + 12))
+  put('nw_dst', ip, u32(offset + 16))
+
+  # Per the spec, fragments have L4 ports of zero
+  frag = ip & ((u16(offset + 6) & 0x3fff) != 0)
+  put('tp_src', frag, 0)
+  put('tp_dst', frag, 0)
+
+  whole = ip & ~frag
+  proto = u8(offset + 9)
+  start = offset + hlen
+  plen = np.minimum(iplen, dlen) - hlen
+  tcp = whole & (proto == 6) & (plen >= 20)
+  tcp_off = (u8(start + 12) >> 4) * 4
+  bad |= tcp & (tcp_off > 20) & (tcp_off <= plen) # Options
+  ports = (tcp & (tcp_off == 20)) | (whole & (proto == 17) & (plen >= 8))
+  put('tp_src', ports, u16(start))
+  put('tp_dst', ports, u16(start + 2))
+  icmp = whole & (proto == 1) & (plen >= 4)
+  put('tp_src', icmp, u8(start))
+  put('tp_dst', icmp, u8(start + 1))
+
+  arp = (dl_type == 0x0806) | (dl_type == 0x8035)
+  bad |= arp & (dlen < 28)
+  bad |= arp & ((u16(offset) != 1) | (u16(offset + 2) != 0x0800) |
+                (u8(offset + 4) != 6) | (u8(offset + 5) != 4))
+  opcode = u16(offset + 6)
+  arp &= opcode <= 255
+  put('nw_proto', arp, opcode)
+  put('nw_src', arp, u32(offset + 14))
+  put('nw_dst', arp, u32(offset + 24))
+
+  for i in np.flatnonzero(bad):
+    in_port = int(cols[_rows['in_port'], i])
+    match = of.ofp_match.from_packet(bytes(frames[i]), in_port,
+                                     spec_frags = True)
+    values = _match_values(match)
+    for f in FIELDS:
+      cols[_rows[f], i] = _value(f, values[f])
+
+  return cols
+
+
+class _Group (object):
+  """
+  The entries of a BatchClassifier which share a wildcard mask
+
+  Only the best (first) entry for each key is kept.
+  """
+  def __init__ (self, wildcards):
+    self.rows = [_rows[f] for f in _exact_fields
+                 if not (wildcards & of.ofp_match_data[f][1])]
+    self.fields = [FIELDS[r] for r in self.rows]
+    self.masks = []
+    for f,mask,shift in (('nw_src',of.OFPFW_NW_SRC_MASK,of.OFPFW_NW_SRC_SHIFT),
+                         ('nw_dst',of.OFPFW_NW_DST_MASK,of.OFPFW_NW_DST_SHIFT)):
+      m = _ip_prefix_mask(wildcards, mask, shift)
+      if m:
+        self.fields.append(f)
+        self.masks.append((_rows[f], m))
+    self._best = {} # key -> entry position
+    self.keys = None
+    self.positions = None
+
+  def add (self, values, position):
+    """
+    Adds an entry (given its _match_values()) at a table position
+    """
+    key = []
+    for f in self.fields:
+      v = values[f]
+      # Can't match anything (as in TupleSpaceClassifier)
+      if v is None: return
+      key.append(_value(f, v))
+    self._best.setdefault(tuple(key), position)
+
+  def finish (self):
+    """
+    Sorts the keys for searching (call after adding all entries)
+    """
+    keys = list(self._best)
+    self.positions = np.array([self._best[k] for k in keys], dtype=np.int64)
+    if self.fields and keys:
+      self.keys = _as_records(np.array(keys, dtype=np.int64))
+      order = np.argsort(self.keys)
+      self.keys = self.keys[order]
+      self.positions = self.positions[order]
+    self._best = None
+
+  def lookup (self, cols):
+    """
+    Returns each packet's best entry position (or -1) given the field rows
+    """
+    n = cols.shape[1]
+    if not len(self.positions): return np.full(n, -1, dtype=np.int64)
+    if not self.fields: return np.full(n, self.positions[0], dtype=np.int64)
+    rows = [cols[r] for r in self.rows]
+    for r,mask in self.masks:
+      # IPs of entries aren't masked (see TupleSpaceClassifier)
+      rows.append(np.where(cols[r] < 0, -1, cols[r] & mask))
+    keys = _as_records(np.vstack(rows).T)
+    i = np.searchsorted(self.keys, keys)
+    np.minimum(i, len(self.keys) - 1, out=i)
+    return np.where(self.keys[i] == keys, self.positions[i], -1)
+
+
+def _as_records (a):
+  """
+  Views each row of a 2D int64 array as a single comparable record
+  """
+  a = np.ascontiguousarray(a)
+  return a.view(np.dtype((np.void, a.dtype.itemsize * a.shape[1]))).ravel()
+
+
+class BatchClassifier (object):
+  """
+  Finds the best entries of a FlowTable for batches of raw frames
+
+  The compiled form of the table is rebuilt after the table changes.
+  """
+  def __init__ (self, table):
+    self.table = table
+    self.entries = None # The table's entries when last compiled
+    self._groups = None
+    table.addListener(FlowTableModification, self._handle_FlowTableModification)
+
+  def _handle_FlowTableModification (self, event):
+    self._groups = None
+
+  def _compile (self):
+    self.entries = list(self.table.entries)
+    groups = {}
+    for position,entry in enumerate(self.entries):
+      wildcards = entry.match.wildcards & of.OFPFW_ALL
+      g = groups.get(wildcards)
+      if g is None:
+        g = groups[wildcards] = _Group(wildcards)
+      g.add(_match_values(entry.match), position)
+    for g in groups.itervalues():
+      g.finish()
+    self._groups = groups.values()
+
+  def classify (self, frames, in_ports):
+    """
+    Returns an array with each frame's best entry index (or -1)
+
+    The indices are into self.entries, which is the table's entries when
+    this was called.  in_ports is as for extract_fields().
+    """
+    if self._groups is None: self._compile()
+    n = len(frames)
+    if not self._groups: return np.full(n, -1, dtype=np.int64)
+    cols = extract_fields(frames, in_ports)
+    # Positions are compared with "no match" being past the end
+    none = len(self.entries)
+    best = np.full(n, none, dtype=np.int64)
+    for g in self._groups:
+      found = g.lookup(cols)
+      found[found < 0] = none
+      np.minimum(best, found, out=best)
+    best[best == none] = -1
+    return best
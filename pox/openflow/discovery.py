@@ -273,6 +273,11 @@ class Discovery (EventMixin):
 
   Link = Link
 
+  # If set, called with each Link whose originating switch is connected to
+  # some other process (see openflow.sharding).  Otherwise, LLDP from
+  # unknown switches is ignored.
+  remote_link_handler = None
+
   def __init__ (self, install_flow = True, explicit_drop = True,
                 link_timeout = None, eat_early_packets = False):
     self._eat_early_packets = eat_early_packets
@@ -320,10 +325,14 @@ class Discovery (EventMixin):
       self.install_flow(event.connection)
 
   def _handle_openflow_ConnectionDown (self, event):
-    # Delete all links on this switch
+    self.delete_switch_links(event.dpid)
+
+  def delete_switch_links (self, dpid):
+    """
+    Deletes all links on a switch
+    """
     self._delete_links([link for link in self.adjacency
-                        if link.dpid1 == event.dpid
-                        or link.dpid2 == event.dpid])
+                        if link.dpid1 == dpid or link.dpid2 == dpid])
 
   def _expire_links (self):
     """
@@ -426,7 +435,8 @@ class Discovery (EventMixin):
       log.warning("Couldn't find a DPID in the LLDP packet")
       return EventHalt
 
-    if originatorDPID not in core.openflow.connections:
+    remote = originatorDPID not in core.openflow.connections
+    if remote and self.remote_link_handler is None:
       log.info('Received LLDP packet from unknown switch')
       return EventHalt
 
@@ -456,6 +466,19 @@ class Discovery (EventMixin):
     link = Discovery.Link(originatorDPID, originatorPort, event.dpid,
                           event.port)
 
+    if remote:
+      self.remote_link_handler(link)
+    else:
+      self.link_seen(link, event)
+
+    return EventHalt # Probably nobody else needs this event
+
+  def link_seen (self, link, event = None):
+    """
+    Adds a link or refreshes its timestamp
+
+    event is the PacketIn it was seen in, if any.
+    """
     if link not in self.adjacency:
       self.adjacency[link] = time.time()
       log.info('link detected: %s', link)
@@ -464,8 +487,6 @@ class Discovery (EventMixin):
       # Just update timestamp
       self.adjacency[link] = time.time()
 
-    return EventHalt # Probably nobody else needs this event
-
   def _delete_links (self, links):
     for link in links:
       self.raiseEventNoErrors(LinkEvent, False, link)
@@ -21,6 +21,7 @@ from pox.lib.revent import *
 
 import time
 import math
+from heapq import heappush, heappop, heapify
 
 # FlowTable Entries:
 #   match - ofp_match (13-tuple)
@@ -125,6 +126,20 @@ class TableEntry (object):
         return True
     return False
 
+  def expiry_time (self):
+    """
+    Earliest time this entry might expire, or None if it never will
+
+    The entry may still be alive then if it has been touched since.
+    """
+    t = None
+    if self.hard_timeout > 0:
+      t = self.created + self.hard_timeout
+    if self.idle_timeout > 0:
+      idle = self.last_touched + self.idle_timeout
+      if t is None or idle < t: t = idle
+    return t
+
   def is_expired (self, now=None):
     """
     Tests whether this flow entry is expired due to its idle or hard timeout
@@ -181,6 +196,266 @@ class TableEntry (object):
     return fr
 
 
+# Fields which a TupleSpaceClassifier matches exactly.  The IP addresses are
+# handled separately since they can be prefixes.
+_exact_fields = ('in_port', 'dl_src', 'dl_dst', 'dl_vlan', 'dl_vlan_pcp',
+                 'dl_type', 'nw_tos', 'nw_proto', 'tp_src', 'tp_dst')
+
+def _ip_prefix_mask (wildcards, mask, shift):
+  """
+  Returns the netmask (as a host-order integer) for wildcard bits
+  """
+  bits = (wildcards & mask) >> shift
+  if bits >= 32: return 0
+  return (0xffFFffFF << bits) & 0xffFFffFF
+
+def _ip_value (addr):
+  if addr is None: return None
+  if isinstance(addr, (int, long)): return addr & 0xffFFffFF
+  return IPAddr(addr).toUnsigned()
+
+def _eth_value (addr):
+  if addr is None or type(addr) is EthAddr: return addr
+  return EthAddr(addr)
+
+def _match_values (match):
+  """
+  Returns a dict of the match's field values normalized for hashing
+
+  Wildcarded fields have value None.
+  """
+  values = {}
+  for f in _exact_fields:
+    values[f] = getattr(match, f)
+  values['dl_src'] = _eth_value(values['dl_src'])
+  values['dl_dst'] = _eth_value(values['dl_dst'])
+  values['nw_src'] = _ip_value(match.nw_src)
+  values['nw_dst'] = _ip_value(match.nw_dst)
+  return values
+
+
+class _Subtable (object):
+  """
+  The entries of a TupleSpaceClassifier which share a wildcard mask
+
+  Entries are kept in a dict keyed on the tuple of their non-wildcarded
+  field values.  Each value is a list of entries sorted best-first (there
+  is usually just one).
+  """
+  def __init__ (self, wildcards):
+    self.wildcards = wildcards
+    self.fields = tuple(f for f in _exact_fields
+                        if not (wildcards & ofp_match_data[f][1]))
+    self.nw_src_mask = _ip_prefix_mask(wildcards, OFPFW_NW_SRC_MASK,
+                                       OFPFW_NW_SRC_SHIFT)
+    self.nw_dst_mask = _ip_prefix_mask(wildcards, OFPFW_NW_DST_MASK,
+                                       OFPFW_NW_DST_SHIFT)
+    self.buckets = {}
+    self.priorities = {} # effective_priority -> count
+    self.max_priority = -1
+
+  def __len__ (self):
+    return sum(self.priorities.itervalues())
+
+  def key (self, values, mask_ips=True):
+    """
+    Returns the bucket key for the given field values
+
+    Returns None if a field we need is wildcarded in values (it can't
+    match any of our entries).  IP addresses from entries are not masked,
+    since matches_with_wildcards() doesn't mask them either.
+    """
+    key = []
+    for f in self.fields:
+      v = values[f]
+      if v is None: return None
+      key.append(v)
+    if self.nw_src_mask:
+      v = values['nw_src']
+      if v is None: return None
+      key.append((v & self.nw_src_mask) if mask_ips else v)
+    if self.nw_dst_mask:
+      v = values['nw_dst']
+      if v is None: return None
+      key.append((v & self.nw_dst_mask) if mask_ips else v)
+    return tuple(key)
+
+  def add (self, entry, key, order):
+    bucket = self.buckets.setdefault(key, [])
+    bucket.append(entry)
+    bucket.sort(key=order, reverse=True)
+    p = entry.effective_priority
+    self.priorities[p] = self.priorities.get(p, 0) + 1
+    if p > self.max_priority: self.max_priority = p
+
+  def remove (self, entry, key):
+    bucket = self.buckets[key]
+    bucket.remove(entry)
+    if not bucket: del self.buckets[key]
+    p = entry.effective_priority
+    count = self.priorities[p] - 1
+    if count:
+      self.priorities[p] = count
+    else:
+      del self.priorities[p]
+      if p == self.max_priority:
+        self.max_priority = max(self.priorities) if self.priorities else -1
+
+
+def _strict_key (priority, match, values = None):
+  """
+  Returns a key which is equal for strictly equal priorities and matches
+  """
+  if values is None: values = _match_values(match)
+  return ((priority, match.wildcards) +
+          tuple(values[f] for f in _exact_fields) +
+          (values['nw_src'], values['nw_dst']))
+
+def _wildcard_widths (wildcards):
+  """
+  Returns (non-IP wildcard bits, nw_src bits, nw_dst bits)
+  """
+  return (wildcards & ~(OFPFW_NW_SRC_MASK | OFPFW_NW_DST_MASK),
+          min(32, (wildcards & OFPFW_NW_SRC_MASK) >> OFPFW_NW_SRC_SHIFT),
+          min(32, (wildcards & OFPFW_NW_DST_MASK) >> OFPFW_NW_DST_SHIFT))
+
+def _covers (a, b):
+  """
+  Tests whether wildcard widths a are at least as wide as b
+  """
+  return (a[0] | b[0]) == a[0] and a[1] >= b[1] and a[2] >= b[2]
+
+
+class _PriorityBucket (object):
+  """
+  The entries of a FlowTable which share an effective priority
+
+  Used to find overlapping entries.  Entries are grouped into _Subtables
+  by wildcards (only their key() and buckets are used).  A match can only
+  encompass another if its wildcards are at least as wide, and then only
+  if the other's values agree with it on the fields it doesn't wildcard.
+  Entries are bucketed by their masked IP addresses, so ones with host
+  bits set beyond their prefix are still found; candidates() may return
+  entries which don't overlap, but never misses one which does.
+  """
+  def __init__ (self):
+    self.groups = {} # wildcards -> (_Subtable, _wildcard_widths())
+    self.count = 0
+
+  def add (self, entry, values):
+    wildcards = entry.match.wildcards & OFPFW_ALL
+    group = self.groups.get(wildcards)
+    if group is None:
+      group = (_Subtable(wildcards), _wildcard_widths(wildcards))
+      self.groups[wildcards] = group
+    key = group[0].key(values)
+    group[0].buckets.setdefault(key, []).append(entry)
+    self.count += 1
+
+  def remove (self, entry, values):
+    wildcards = entry.match.wildcards & OFPFW_ALL
+    sub = self.groups[wildcards][0]
+    key = sub.key(values)
+    sub.buckets[key].remove(entry)
+    if not sub.buckets[key]:
+      del sub.buckets[key]
+      if not sub.buckets: del self.groups[wildcards]
+    self.count -= 1
+
+  def candidates (self, match, values):
+    """
+    Entries which might encompass or be encompassed by a match
+    """
+    wildcards = match.wildcards & OFPFW_ALL
+    widths = _wildcard_widths(wildcards)
+    for group_wildcards,(sub,group_widths) in self.groups.iteritems():
+      if _covers(group_widths, widths):
+        # Entries which encompass the match (or, with the same wildcards,
+        # which it encompasses) are in the bucket for its masked values
+        for e in sub.buckets.get(sub.key(values), ()):
+          yield e
+      elif _covers(widths, group_widths):
+        for entries in sub.buckets.itervalues():
+          for e in entries:
+            yield e
+
+
+class TupleSpaceClassifier (object):
+  """
+  Indexes TableEntries for fast packet lookup
+
+  This is a tuple space search classifier: entries are grouped into
+  subtables by wildcard mask, and each subtable is a hash table on the
+  non-wildcarded fields.  A lookup probes the subtables in order of the
+  highest priority they contain, and stops as soon as no remaining
+  subtable could contain a better entry than the one already found.
+
+  Results are identical to walking a FlowTable in order and calling
+  matches_with_wildcards() on each entry (including ties, where the most
+  recently added entry wins).
+  """
+  def __init__ (self):
+    self._subtables = {} # wildcards -> _Subtable
+    self._ordered = [] # _Subtables sorted by descending max_priority
+    self._entries = {} # TableEntry -> (wildcards, key, sequence number)
+    self._next_seq = 0
+
+  def __len__ (self):
+    return len(self._entries)
+
+  def _order (self, entry):
+    return (entry.effective_priority, self._entries[entry][2])
+
+  def _resort (self):
+    self._ordered.sort(key=lambda s: s.max_priority, reverse=True)
+
+  def add (self, entry):
+    wildcards = entry.match.wildcards & OFPFW_ALL
+    sub = self._subtables.get(wildcards)
+    if sub is None:
+      sub = _Subtable(wildcards)
+      self._subtables[wildcards] = sub
+      self._ordered.append(sub)
+    key = sub.key(_match_values(entry.match), mask_ips=False)
+    self._next_seq += 1
+    self._entries[entry] = (wildcards, key, self._next_seq)
+    old_max = sub.max_priority
+    sub.add(entry, key, self._order)
+    if sub.max_priority != old_max: self._resort()
+
+  def remove (self, entry):
+    wildcards, key, seq = self._entries[entry]
+    sub = self._subtables[wildcards]
+    old_max = sub.max_priority
+    sub.remove(entry, key)
+    del self._entries[entry]
+    if not sub.buckets:
+      del self._subtables[wildcards]
+      self._ordered.remove(sub)
+    elif sub.max_priority != old_max:
+      self._resort()
+
+  def lookup (self, packet_match):
+    """
+    Returns the best entry matching an exact packet match (or None)
+    """
+    values = _match_values(packet_match)
+    best = None
+    best_order = None
+    for sub in self._ordered:
+      if best is not None and sub.max_priority < best_order[0]: break
+      key = sub.key(values)
+      if key is None: continue
+      bucket = sub.buckets.get(key)
+      if not bucket: continue
+      entry = bucket[0]
+      order = self._order(entry)
+      if best is None or order > best_order:
+        best = entry
+        best_order = order
+    return best
+
+
 class FlowTableModification (Event):
   def __init__ (self, added=[], removed=[], reason=None):
     self.added = added
@@ -198,15 +473,65 @@ class FlowTable (EventMixin):
 
   Maintains an ordered list of flow entries, and finds matching entries for
   packets and other entries. Supports expiration of flows.
+
+  If indexed is True, entries are additionally kept in a
+  TupleSpaceClassifier, which makes entry_for_packet() much faster for
+  large tables (at the cost of some extra work when adding and removing
+  entries).
   """
   _eventMixin_events = set([FlowTableModification])
 
-  def __init__ (self):
+  def __init__ (self, indexed=False):
     EventMixin.__init__(self)
 
     # Table is a list of TableEntry sorted by descending effective_priority.
     self._table = []
 
+    self._classifier = TupleSpaceClassifier() if indexed else None
+
+    # Indexes for strict lookups and overlap checks
+    self._strict = {} # _strict_key() -> [TableEntry]
+    self._priorities = {} # effective_priority -> _PriorityBucket
+
+    # Heap of (expiry time, seq, entry) for entries with timeouts, so that
+    # remove_expired_entries() only looks at entries which may be expiring.
+    # Touching an entry doesn't update its heap item; if it turns out to
+    # still be alive when it comes up, it just gets pushed again.
+    # _expiry_seqs maps entries to the seq of their current heap item, so
+    # stale items (e.g., for removed entries) can be skipped.
+    self._expiry = []
+    self._expiry_seqs = {}
+    self._expiry_seq = 0
+
+  def _index (self, entry):
+    values = _match_values(entry.match)
+    key = _strict_key(entry.priority, entry.match, values)
+    self._strict.setdefault(key, []).append(entry)
+    bucket = self._priorities.get(entry.effective_priority)
+    if bucket is None:
+      bucket = self._priorities[entry.effective_priority] = _PriorityBucket()
+    bucket.add(entry, values)
+    self._index_expiry(entry)
+
+  def _unindex (self, entry):
+    values = _match_values(entry.match)
+    key = _strict_key(entry.priority, entry.match, values)
+    entries = self._strict[key]
+    entries.remove(entry)
+    if not entries: del self._strict[key]
+    p = entry.effective_priority
+    bucket = self._priorities[p]
+    bucket.remove(entry, values)
+    if not bucket.count: del self._priorities[p]
+    self._expiry_seqs.pop(entry, None)
+
+  def _index_expiry (self, entry):
+    t = entry.expiry_time()
+    if t is None: return
+    self._expiry_seq += 1
+    self._expiry_seqs[entry] = self._expiry_seq
+    heappush(self._expiry, (t, self._expiry_seq, entry))
+
   def _dirty (self):
     """
     Call when table changes
@@ -240,6 +565,9 @@ class FlowTable (EventMixin):
           continue
         low = middle + 1
     table.insert(low, entry)
+    if self._classifier is not None:
+      self._classifier.add(entry)
+    self._index(entry)
 
     self._dirty()
 
@@ -248,11 +576,17 @@ class FlowTable (EventMixin):
   def remove_entry (self, entry, reason=None):
     assert isinstance(entry, TableEntry)
     self._table.remove(entry)
+    if self._classifier is not None:
+      self._classifier.remove(entry)
+    self._unindex(entry)
     self._dirty()
     self.raiseEvent(FlowTableModification(removed=[entry], reason=reason))
 
   def matching_entries (self, match, priority=0, strict=False, out_port=None):
     entry_match = lambda e: e.is_matched_by(match, priority, strict, out_port)
+    if strict:
+      entries = self._strict.get(_strict_key(priority, match), ())
+      return [ entry for entry in entries if entry_match(entry) ]
     return [ entry for entry in self._table if entry_match(entry) ]
 
   def flow_stats (self, match, out_port=None, now=None):
@@ -279,8 +613,13 @@ class FlowTable (EventMixin):
     if not flows: return
     self._dirty()
     remove_flows = set(flows)
+    if len(remove_flows) <= 16:
+      # Few enough that searching for each one (in C) is quicker
+      for entry in remove_flows:
+        self._table.remove(entry)
+      remove_flows.clear()
     i = 0
-    while i < len(self._table):
+    while remove_flows and i < len(self._table):
       entry = self._table[i]
       if entry in remove_flows:
         del self._table[i]
@@ -289,17 +628,35 @@ class FlowTable (EventMixin):
       else:
         i += 1
     assert len(remove_flows) == 0
+    if self._classifier is not None:
+      for entry in set(flows):
+        self._classifier.remove(entry)
+    for entry in set(flows):
+      self._unindex(entry)
     self.raiseEvent(FlowTableModification(removed=flows, reason=reason))
 
   def remove_expired_entries (self, now=None):
     idle = []
     hard = []
+    alive = []
     if now is None: now = time.time()
-    for entry in self._table:
+    heap = self._expiry
+    seqs = self._expiry_seqs
+    if len(heap) > 2 * len(seqs) + 64:
+      # Mostly stale; rebuild it
+      heap[:] = [item for item in heap if seqs.get(item[2]) == item[1]]
+      heapify(heap)
+    while heap and heap[0][0] < now:
+      t,seq,entry = heappop(heap)
+      if seqs.get(entry) != seq: continue
       if entry.is_idle_timed_out(now):
         idle.append(entry)
       elif entry.is_hard_timed_out(now):
         hard.append(entry)
+      else:
+        alive.append(entry)
+    for entry in alive:
+      self._index_expiry(entry)
     self._remove_specific_entries(idle, OFPRR_IDLE_TIMEOUT)
     self._remove_specific_entries(hard, OFPRR_HARD_TIMEOUT)
 
@@ -314,10 +671,14 @@ class FlowTable (EventMixin):
     Finds the flow table entry that matches the given packet.
 
     Returns the highest priority flow table entry that matches the given packet
-    on the given in_port, or None if no matching entry is found.
+    on the given in_port, or None if no matching entry is found.  The packet
+    can be an ethernet instance or raw bytes (which is faster).
     """
     packet_match = ofp_match.from_packet(packet, in_port, spec_frags = True)
 
+    if self._classifier is not None:
+      return self._classifier.lookup(packet_match)
+
     for entry in self._table:
       if entry.match.matches_with_wildcards(packet_match,
                                             consider_other_wildcards=False):
@@ -329,25 +690,19 @@ class FlowTable (EventMixin):
     """
     Tests if the input entry overlaps with another entry in this table.
 
-    Returns true if there is an overlap, false otherwise. Since the table is
-    sorted, there is only a need to check a certain portion of it.
+    Returns true if there is an overlap, false otherwise.  Only entries with
+    the same priority and compatible wildcards are checked.
     """
-    #NOTE: Assumes that entries are sorted by decreasing effective_priority
     #NOTE: Ambiguous whether matching should be based on effective_priority
     #      or the regular priority.  Doing it based on effective_priority
     #      since that's what actually affects packet matching.
-    #NOTE: We could improve performance by doing a binary search to find the
-    #      right priority entries.
 
-    priority = in_entry.effective_priority
+    bucket = self._priorities.get(in_entry.effective_priority)
+    if bucket is None: return False
 
-    for e in self._table:
-      if e.effective_priority < priority:
-        break
-      elif e.effective_priority > priority:
-        continue
-      else:
-        if e.is_matched_by(in_entry.match) or in_entry.is_matched_by(e.match):
-          return True
+    match = in_entry.match
+    for e in bucket.candidates(match, _match_values(match)):
+      if e.is_matched_by(match) or in_entry.is_matched_by(e.match):
+        return True
 
     return False
@@ -40,6 +40,7 @@ from pox.lib.util import is_listlike
 
 
 EMPTY_ETH = EthAddr(None)
+_EMPTY_ETH_RAW = EMPTY_ETH.toRaw()
 
 # ----------------------------------------------------------------------
 # Logging
@@ -101,7 +102,11 @@ def _read (data, offset, length):
   if (len(data)-offset) < length:
     raise UnderrunError("wanted %s bytes but only have %s"
                         % (length, len(data)-offset))
-  return (offset+length, data[offset:offset+length])
+  d = data[offset:offset+length]
+  if type(d) is not bytes:
+    # Unpacking from a memoryview or bytearray; fields are always bytes
+    d = bytes(d) if type(d) is bytearray else d.tobytes()
+  return (offset+length, d)
 
 def _unpack (fmt, data, offset):
   size = struct.calcsize(fmt)
@@ -134,6 +139,33 @@ def _readip (data, offset, networkOrder = True):
   (offset, d) = _read(data, offset, 4)
   return (offset, IPAddr(d, networkOrder = networkOrder))
 
+def _make_codec (fields):
+  """
+  Generates a packer and unpacker for a run of fixed-size fields
+
+  fields is a sequence of (attribute, format) pairs, where format is a
+  struct format such as "H" or "6s".  Padding has None as its attribute
+  (e.g., (None, "2x")).  The struct is compiled once, and the functions
+  are generated so that each is a single struct call on plain attribute
+  loads/stores.
+
+  Returns (pack, unpack, size), where pack(obj) returns bytes and
+  unpack(obj, raw, offset) returns the new offset.  Assigned in a class
+  body, they work as methods.
+  """
+  s = struct.Struct("!" + "".join(f for a,f in fields))
+  attrs = ", ".join("obj." + a for a,f in fields if a is not None)
+  src = ("def pack (obj):\n"
+         "  return _pack(%s)\n"
+         "def unpack (obj, raw, offset):\n"
+         "  if len(raw) - offset < _size: raise UnderrunError()\n"
+         "  %s, = _unpack_from(raw, offset)\n"
+         "  return offset + _size\n") % (attrs, attrs)
+  ns = dict(_pack = s.pack, _unpack_from = s.unpack_from, _size = s.size,
+            UnderrunError = UnderrunError)
+  exec src in ns
+  return ns['pack'], ns['unpack'], s.size
+
 # ----------------------------------------------------------------------
 
 
@@ -566,22 +598,22 @@ class ofp_header (ofp_base):
       return "type is not a known message type"
     return None
 
+  _header = struct.Struct("!BBHL")
+
   def pack (self):
     assert self._assert()
-
-    packed = b""
-    packed += struct.pack("!BBHL", self.version, self.header_type,
-        len(self), self.xid)
-    return packed
+    return self._header.pack(self.version, self.header_type, len(self),
+                             self.xid)
 
   def unpack (self, raw, offset=0):
     offset,length = self._unpack_header(raw, offset)
     return offset,length
 
   def _unpack_header (self, raw, offset):
-    offset,(self.version, self.header_type, length, self.xid) = \
-        _unpack("!BBHL", raw, offset)
-    return offset,length
+    if len(raw) - offset < 8: raise UnderrunError()
+    (self.version, self.header_type, length, self._xid) = \
+        self._header.unpack_from(raw, offset)
+    return offset+8,length
 
   def __eq__ (self, other):
     if type(self) != type(other): return False
@@ -920,6 +952,91 @@ class ofp_queue_prop_min_rate (ofp_base):
     return outstr
 
 
+# Precompiled header layouts for _match_fields_from_raw()
+_eth_header = struct.Struct("!6s6sH")
+_vlan_header = struct.Struct("!HH")
+_ipv4_header = struct.Struct("!BBHHHBBHII")
+_arp_header = struct.Struct("!HHBBH6sI6sI")
+_tp_ports = struct.Struct("!HH")
+_icmp_header = struct.Struct("!BB")
+
+def _match_fields_from_raw (raw, spec_frags = False):
+  """
+  Extracts the fields for an exact match directly from raw packet bytes
+
+  Returns a tuple of (dl_src, dl_dst, dl_vlan, dl_vlan_pcp, dl_type,
+  nw_tos, nw_proto, nw_src, nw_dst, tp_src, tp_dst).  Ethernet addresses
+  are raw bytes and IP addresses are host-order integers.  Fields which
+  ofp_match.from_packet() would leave wildcarded are None.
+
+  Returns None for packets this doesn't handle: truncated or malformed
+  headers, LLC frames, and (some) TCP options.  Parse those with the packet
+  library instead.
+  """
+  rlen = len(raw)
+  if rlen < 14: return None
+  dl_dst,dl_src,dl_type = _eth_header.unpack_from(raw, 0)
+  if dl_type < 1536: return None
+  offset = 14
+
+  if dl_type == 0x8100:
+    if rlen < 18: return None
+    tci,dl_type = _vlan_header.unpack_from(raw, 14)
+    dl_vlan = tci & 0x0fff
+    dl_vlan_pcp = tci >> 13
+    offset = 18
+  else:
+    dl_vlan = OFP_VLAN_NONE
+    dl_vlan_pcp = 0
+
+  nw_tos = nw_proto = nw_src = nw_dst = tp_src = tp_dst = None
+
+  if dl_type == 0x0800:
+    dlen = rlen - offset
+    if dlen < 20: return None
+    (vhl, nw_tos, iplen, _, frag, _, nw_proto, _, nw_src,
+     nw_dst) = _ipv4_header.unpack_from(raw, offset)
+    hlen = (vhl & 0x0f) * 4
+    if (vhl >> 4) != 4 or hlen < 20 or iplen < hlen or hlen > dlen:
+      return None
+    if spec_frags and (frag & 0x3fff):
+      # More fragments flag or a fragment offset
+      tp_src = tp_dst = 0
+    else:
+      if iplen > dlen: iplen = dlen
+      start = offset + hlen
+      plen = iplen - hlen
+      if nw_proto == 6:
+        if plen >= 20:
+          off = (ord(raw[start+12]) >> 4) * 4
+          if off == 20:
+            tp_src,tp_dst = _tp_ports.unpack_from(raw, start)
+          elif off > 20 and off <= plen:
+            # Options; let the TCP parser decide if they're valid
+            t = tcp(raw=raw[start:start+plen])
+            if t.parsed:
+              tp_src,tp_dst = t.srcport,t.dstport
+      elif nw_proto == 17:
+        if plen >= 8:
+          tp_src,tp_dst = _tp_ports.unpack_from(raw, start)
+      elif nw_proto == 1:
+        if plen >= 4:
+          tp_src,tp_dst = _icmp_header.unpack_from(raw, start)
+  elif dl_type == 0x0806 or dl_type == 0x8035:
+    if rlen - offset < 28: return None
+    (hwtype, prototype, hwlen, protolen, opcode, _, src, _,
+     dst) = _arp_header.unpack_from(raw, offset)
+    if hwtype != 1 or hwlen != 6 or prototype != 0x0800 or protolen != 4:
+      return None
+    if opcode <= 255:
+      nw_proto = opcode
+      nw_src = src
+      nw_dst = dst
+
+  return (dl_src, dl_dst, dl_vlan, dl_vlan_pcp, dl_type, nw_tos, nw_proto,
+          nw_src, nw_dst, tp_src, tp_dst)
+
+
 ##2.3 Flow Match Structures
 class ofp_match (ofp_base):
   adjust_wildcards = True # Set to true to "fix" outgoing wildcards
@@ -932,12 +1049,21 @@ class ofp_match (ofp_base):
     @param in_port The switch port the packet arrived on if you want
                    the resulting match to have its in_port set.
                    If "packet" is a packet_in, this is ignored.
-    @param packet  A pox.packet.ethernet instance or a packet_in
+    @param packet  A pox.packet.ethernet instance, a packet_in, or raw
+                   packet bytes
     @param spec_frags Handle IP fragments as specified in the spec.
+
+    Raw bytes (including a packet_in's data) are usually handled without
+    parsing the packet at all, so pass those if you have them.
     """
     if isinstance(packet, ofp_packet_in):
       in_port = packet.in_port
-      packet = ethernet(packet.data)
+      packet = packet.data
+    if type(packet) is bytes:
+      fields = _match_fields_from_raw(packet, spec_frags)
+      if fields is not None:
+        return cls.from_fields(fields, in_port)
+      packet = ethernet(packet)
     assert assert_type("packet", packet, ethernet, none_ok=False)
 
     match = cls()
@@ -993,6 +1119,32 @@ class ofp_match (ofp_base):
 
     return match
 
+  @classmethod
+  def from_fields (cls, fields, in_port = None):
+    """
+    Constructs an exact match from a _match_fields_from_raw() tuple
+    """
+    (dl_src, dl_dst, dl_vlan, dl_vlan_pcp, dl_type, nw_tos, nw_proto,
+     nw_src, nw_dst, tp_src, tp_dst) = fields
+    match = cls()
+    if in_port is not None:
+      match.in_port = in_port
+    match.dl_src = EthAddr(dl_src)
+    match.dl_dst = EthAddr(dl_dst)
+    match.dl_type = dl_type
+    match.dl_vlan = dl_vlan
+    match.dl_vlan_pcp = dl_vlan_pcp
+    if nw_proto is not None:
+      match.nw_src = IPAddr(nw_src)
+      match.nw_dst = IPAddr(nw_dst)
+      match.nw_proto = nw_proto
+      if nw_tos is not None:
+        match.nw_tos = nw_tos
+      if tp_src is not None:
+        match.tp_src = tp_src
+        match.tp_dst = tp_dst
+    return match
+
   def clone (self):
     n = ofp_match()
     for k,v in ofp_match_data.iteritems():
@@ -1020,8 +1172,7 @@ class ofp_match (ofp_base):
   def __init__ (self, **kw):
     self._locked = False
 
-    for k,v in ofp_match_data.iteritems():
-      setattr(self, '_' + k, v[0])
+    self.__dict__.update(_ofp_match_defaults)
 
     self.wildcards = self._normalize_wildcards(OFPFW_ALL)
 
@@ -1162,54 +1313,59 @@ class ofp_match (ofp_base):
 
     return True # Always; we don't actually want an assertion error
 
+  # Wire format: wildcards, in_port, dl_src, dl_dst, dl_vlan, dl_vlan_pcp,
+  # pad, dl_type, nw_tos, nw_proto, pad, nw_src, nw_dst, tp_src, tp_dst
+  _struct = struct.Struct("!LH6s6sHBxHBBxx4s4sHH")
+
   def pack (self, flow_mod=False):
     assert self._assert()
 
-    packed = b""
     if self.adjust_wildcards and flow_mod:
       wc = self._wire_wildcards(self.wildcards)
       assert self._prereq_warning()
     else:
       wc = self.wildcards
-    packed += struct.pack("!LH", wc, self.in_port or 0)
-    if self.dl_src is None:
-      packed += EMPTY_ETH.toRaw()
-    elif type(self.dl_src) is bytes:
-      packed += self.dl_src
+
+    # This reads the underlying fields directly rather than going through
+    # __getattr__, but wildcarded fields still pack as zero.
+    d = self.__dict__
+    w = self.wildcards
+    def get (name, bit):
+      return 0 if (w & bit) == bit else (d[name] or 0)
+
+    def eth (name, bit):
+      addr = None if w & bit else d[name]
+      if addr is None: return _EMPTY_ETH_RAW
+      if type(addr) is bytes: return addr
+      return addr.toRaw()
+    dl_src = eth('_dl_src', OFPFW_DL_SRC)
+    dl_dst = eth('_dl_dst', OFPFW_DL_DST)
+
+    dl_type = get('_dl_type', OFPFW_DL_TYPE)
+    is_ip = dl_type == 0x0800
+    if is_ip or dl_type == 0x0806:
+      nw_tos = get('_nw_tos', OFPFW_NW_TOS) if is_ip else 0
+      nw_proto = get('_nw_proto', OFPFW_NW_PROTO)
+      def fix (addr, all_bits):
+        if (w & all_bits) == all_bits or addr is None: return _PAD4
+        if type(addr) is int or type(addr) is long:
+          return struct.pack("!L", addr & 0xffFFffFF)
+        return IPAddr(addr).toRaw()
+      nw_src = fix(d['_nw_src'], OFPFW_NW_SRC_ALL)
+      nw_dst = fix(d['_nw_dst'], OFPFW_NW_DST_ALL)
     else:
-      packed += self.dl_src.toRaw()
-    if self.dl_dst is None:
-      packed += EMPTY_ETH.toRaw()
-    elif type(self.dl_dst) is bytes:
-      packed += self.dl_dst
+      nw_tos = nw_proto = 0
+      nw_src = nw_dst = _PAD4
+    if is_ip and nw_proto in (1,6,17):
+      tp_src = get('_tp_src', OFPFW_TP_SRC)
+      tp_dst = get('_tp_dst', OFPFW_TP_DST)
     else:
-      packed += self.dl_dst.toRaw()
-
-    def check_ip(val):
-      return (val or 0) if self.dl_type == 0x0800 else 0
-    def check_ip_or_arp(val):
-      return (val or 0) if self.dl_type == 0x0800 \
-                           or self.dl_type == 0x0806 else 0
-    def check_tp(val):
-      return (val or 0) if self.dl_type == 0x0800 \
-                           and self.nw_proto in (1,6,17) else 0
-
-    packed += struct.pack("!HB", self.dl_vlan or 0, self.dl_vlan_pcp or 0)
-    packed += _PAD # Hardcode padding
-    packed += struct.pack("!HBB", self.dl_type or 0,
-        check_ip(self.nw_tos), check_ip_or_arp(self.nw_proto))
-    packed += _PAD2 # Hardcode padding
-    def fix (addr):
-      if addr is None: return 0
-      if type(addr) is int: return addr & 0xffFFffFF
-      if type(addr) is long: return addr & 0xffFFffFF
-      return addr.toUnsigned()
-
-    packed += struct.pack("!LLHH", check_ip_or_arp(fix(self.nw_src)),
-        check_ip_or_arp(fix(self.nw_dst)),
-        check_tp(self.tp_src), check_tp(self.tp_dst))
+      tp_src = tp_dst = 0
 
-    return packed
+    return self._struct.pack(wc, get('_in_port', OFPFW_IN_PORT),
+        dl_src, dl_dst, get('_dl_vlan', OFPFW_DL_VLAN),
+        get('_dl_vlan_pcp', OFPFW_DL_VLAN_PCP), dl_type, nw_tos, nw_proto,
+        nw_src, nw_dst, tp_src, tp_dst)
 
   def _normalize_wildcards (self, wildcards):
     """
@@ -1332,26 +1488,31 @@ class ofp_match (ofp_base):
     return not self.is_wildcarded
 
   def unpack (self, raw, offset=0, flow_mod=False):
-    _offset = offset
-    offset,(wildcards, self._in_port) = _unpack("!LH",raw, offset)
-    offset,self._dl_src = _readether(raw, offset)
-    offset,self._dl_dst = _readether(raw, offset)
-    offset,(self._dl_vlan, self._dl_vlan_pcp) = \
-        _unpack("!HB", raw, offset)
-    offset = _skip(raw, offset, 1)
-    offset,(self._dl_type, self._nw_tos, self._nw_proto) = \
-        _unpack("!HBB", raw, offset)
-    offset = _skip(raw, offset, 2)
-    offset,self._nw_src = _readip(raw, offset)
-    offset,self._nw_dst = _readip(raw, offset)
-    offset,(self._tp_src, self._tp_dst) = _unpack("!HH", raw, offset)
+    if self._locked:
+      raise AttributeError('match object is locked')
+    if len(raw) - offset < 40: raise UnderrunError()
+    (wildcards, in_port, dl_src, dl_dst, dl_vlan, dl_vlan_pcp, dl_type,
+     nw_tos, nw_proto, nw_src, nw_dst, tp_src, tp_dst) = \
+        self._struct.unpack_from(raw, offset)
+    d = self.__dict__
+    d['_in_port'] = in_port
+    d['_dl_src'] = EthAddr(dl_src)
+    d['_dl_dst'] = EthAddr(dl_dst)
+    d['_dl_vlan'] = dl_vlan
+    d['_dl_vlan_pcp'] = dl_vlan_pcp
+    d['_dl_type'] = dl_type
+    d['_nw_tos'] = nw_tos
+    d['_nw_proto'] = nw_proto
+    d['_nw_src'] = IPAddr(nw_src)
+    d['_nw_dst'] = IPAddr(nw_dst)
+    d['_tp_src'] = tp_src
+    d['_tp_dst'] = tp_dst
 
     # Only unwire wildcards for flow_mod
     self.wildcards = self._normalize_wildcards(
         self._unwire_wildcards(wildcards) if flow_mod else wildcards)
 
-    assert offset - _offset == len(self)
-    return offset
+    return offset + 40
 
   @staticmethod
   def __len__ ():
@@ -2319,13 +2480,14 @@ class ofp_flow_mod (ofp_header):
       buffer_id = NO_BUFFER
 
     assert self._assert()
-    packed = b""
-    packed += ofp_header.pack(self)
-    packed += self.match.pack(flow_mod=True)
-    packed += struct.pack("!QHHHHLHH", self.cookie, self.command,
-                          self.idle_timeout, self.hard_timeout,
-                          self.priority, buffer_id, self.out_port,
-                          self.flags)
+    own_buffer_id = self._buffer_id
+    self._buffer_id = buffer_id
+    try:
+      packed = b"".join((ofp_header.pack(self),
+                         self.match.pack(flow_mod=True),
+                         self._pack_body()))
+    finally:
+      self._buffer_id = own_buffer_id
     for i in self.actions:
       packed += i.pack()
 
@@ -2334,13 +2496,15 @@ class ofp_flow_mod (ofp_header):
       packed += po.pack()
     return packed
 
+  _pack_body,_unpack_body,_ = _make_codec((
+      ("cookie", "Q"), ("command", "H"), ("idle_timeout", "H"),
+      ("hard_timeout", "H"), ("priority", "H"), ("_buffer_id", "L"),
+      ("out_port", "H"), ("flags", "H")))
+
   def unpack (self, raw, offset=0):
     offset,length = self._unpack_header(raw, offset)
     offset = self.match.unpack(raw, offset, flow_mod=True)
-    offset,(self.cookie, self.command, self.idle_timeout,
-            self.hard_timeout, self.priority, self._buffer_id,
-            self.out_port, self.flags) = \
-            _unpack("!QHHHHLHH", raw, offset)
+    offset = self._unpack_body(raw, offset)
     offset,self.actions = _unpack_actions(raw,
         length-(32 + len(self.match)), offset)
     assert length == len(self)
@@ -3600,18 +3764,22 @@ class ofp_packet_out (ofp_header):
 
     if self.data is not None:
       return b''.join((ofp_header.pack(self),
-        struct.pack("!LHH", self._buffer_id, self.in_port, actions_len),
+        self._body.pack(self._buffer_id, self.in_port, actions_len),
         actions, self.data))
     else:
       return b''.join((ofp_header.pack(self),
-      struct.pack("!LHH", self._buffer_id, self.in_port, actions_len),
+      self._body.pack(self._buffer_id, self.in_port, actions_len),
       actions))
 
+  _body = struct.Struct("!LHH")
+
   def unpack (self, raw, offset=0):
     _offset = offset
     offset,length = self._unpack_header(raw, offset)
-    offset,(self._buffer_id, self.in_port, actions_len) = \
-        _unpack("!LHH", raw, offset)
+    if len(raw) - offset < 8: raise UnderrunError()
+    (self._buffer_id, self.in_port, actions_len) = \
+        self._body.unpack_from(raw, offset)
+    offset += 8
     offset,self.actions = _unpack_actions(raw, actions_len, offset)
 
     remaining = length - (offset - _offset)
@@ -3777,16 +3945,15 @@ class ofp_packet_in (ofp_header):
     else:
       self._data = data
 
+  _pack_body,_unpack_body,_ = _make_codec((
+      ("_buffer_id", "L"), ("total_len", "H"), ("in_port", "H"),
+      ("reason", "B"), (None, "x")))
+
   def pack (self):
     assert self._assert()
 
-    packed = b""
-    packed += ofp_header.pack(self)
-    packed += struct.pack("!LHHBB", self._buffer_id, self.total_len,
-                          self.in_port, self.reason, 0)
-    packed += self.data
     #TODO: Padding?  See __len__
-    return packed
+    return b"".join((ofp_header.pack(self), self._pack_body(), self.data))
 
   @property
   def is_complete (self):
@@ -3795,8 +3962,7 @@ class ofp_packet_in (ofp_header):
 
   def unpack (self, raw, offset=0):
     offset,length = self._unpack_header(raw, offset)
-    offset,(self._buffer_id, self._total_len, self.in_port, self.reason,
-            pad) = _unpack("!LHHBB", raw, offset)
+    offset = self._unpack_body(raw, offset)
     offset,self.data = _read(raw, offset, length-18)
     assert length == len(self)
     return offset,length
@@ -3853,28 +4019,18 @@ class ofp_flow_removed (ofp_header):
   def pack (self):
     assert self._assert()
 
-    packed = b""
-    packed += ofp_header.pack(self)
-    packed += self.match.pack()
-    packed += struct.pack("!QHB", self.cookie, self.priority, self.reason)
-    packed += _PAD
-    packed += struct.pack("!LLH", self.duration_sec, self.duration_nsec,
-                          self.idle_timeout)
-    packed += _PAD2
-    packed += struct.pack("!QQ", self.packet_count, self.byte_count)
-    return packed
+    return b"".join((ofp_header.pack(self), self.match.pack(),
+                     self._pack_body()))
+
+  _pack_body,_unpack_body,_ = _make_codec((
+      ("cookie", "Q"), ("priority", "H"), ("reason", "B"), (None, "x"),
+      ("duration_sec", "L"), ("duration_nsec", "L"), ("idle_timeout", "H"),
+      (None, "2x"), ("packet_count", "Q"), ("byte_count", "Q")))
 
   def unpack (self, raw, offset=0):
     offset,length = self._unpack_header(raw, offset)
     offset = self.match.unpack(raw, offset)
-    offset,(self.cookie, self.priority, self.reason) = \
-        _unpack("!QHB", raw, offset)
-    offset = _skip(raw, offset, 1)
-    offset,(self.duration_sec, self.duration_nsec, self.idle_timeout) = \
-        _unpack("!LLH", raw, offset)
-    offset = _skip(raw, offset, 2)
-    offset,(self.packet_count, self.byte_count) = \
-        _unpack("!QQ", raw, offset)
+    offset = self._unpack_body(raw, offset)
     assert length == len(self)
     return offset,length
 
@@ -4179,7 +4335,7 @@ class ofp_vendor_generic (ofp_vendor_base):
     offset,(self.vendor,) = _unpack("!L", raw, offset)
     offset,self.data = _read(raw, offset, length-12)
     if self._collect_raw:
-      self.raw = raw[_offset, _offset+length]
+      self.raw = _read(raw, _offset, length)[1]
     return offset,length
 
   def __len__ (self):
@@ -4460,3 +4616,6 @@ ofp_match_data = {
   'tp_src' : (0, OFPFW_TP_SRC),
   'tp_dst' : (0, OFPFW_TP_DST),
 }
+
+_ofp_match_defaults = dict(('_' + k, v[0])
+                           for k,v in ofp_match_data.iteritems())
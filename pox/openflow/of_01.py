@@ -36,6 +36,8 @@ log = core.getLogger()
 
 import socket
 import select
+from collections import deque, defaultdict, Counter
+from weakref import WeakKeyDictionary
 
 # List where the index is an OpenFlow message type (OFPT_xxx), and
 # the values are unpack functions that unpack the wire format of that
@@ -191,9 +193,9 @@ class DefaultOpenFlowHandlers (OpenFlowHandlers):
 
   @staticmethod
   def handle_PACKET_IN (con, msg): #A
-    e = con.ofnexus.raiseEventNoErrors(PacketIn, con, msg)
-    if e is None or e.halt != True:
-      con.raiseEventNoErrors(PacketIn, con, msg)
+    if packet_in_limiter is not None:
+      if not packet_in_limiter.admit(con, msg): return
+    _raise_packet_in(con, msg)
 
   @staticmethod
   def handle_ERROR (con, msg): #A
@@ -396,112 +398,218 @@ statsHandlerMap = {
 }
 
 
-# Deferred sending should be unusual, so don't worry too much about
-# efficiency
-class DeferredSender (threading.Thread):
+class DeferredSender (object):
   """
-  Class that handles sending when a socket write didn't complete
+  Flushes Connection send queues from within the recoco loop
+
+  Connection.send() just queues data and marks the connection as dirty.
+  Dirty connections are flushed once per pass of the OpenFlow loop (or by
+  a callLater for data sent from elsewhere), so a burst of small messages
+  goes out in a single socket write.  Connections whose sockets fill up
+  wait for writability in the OpenFlow loop.
   """
   def __init__ (self):
-    threading.Thread.__init__(self)
-    core.addListeners(self)
-    self._dataForConnection = {}
-    self._lock = threading.RLock()
-    self._waker = pox.lib.util.makePinger()
-    self.sending = False
-
-    self.start()
+    self._dirty = set()
+    self._lock = threading.Lock()
+    self._scheduled = False
 
-  def _handle_GoingDownEvent (self, event):
-    self._waker.ping()
+  def send (self, con, data):
+    """
+    Queue data on a connection to be sent soon
+    """
+    con._queue(data)
 
-  def _sliceup (self, data):
+  def schedule (self, con):
     """
-    Takes an array of data bytes, and slices into elements of
-    PIPE_BUF bytes each
+    Mark a connection as having queued data
     """
-    out = []
-    while len(data) > PIPE_BUF:
-      out.append(data[0:PIPE_BUF])
-      data = data[PIPE_BUF:]
-    if len(data) > 0:
-      out.append(data)
-    return out
+    with self._lock:
+      self._dirty.add(con)
+      if self._scheduled: return
+      self._scheduled = True
+    core.callLater(self.flush)
 
-  def send (self, con, data):
+  def kill (self, con):
     with self._lock:
-      self.sending = True
+      self._dirty.discard(con)
 
-      data = self._sliceup(data)
+  def flush (self):
+    """
+    Write out queued data for all dirty connections
+    """
+    with self._lock:
+      self._scheduled = False
+      if not self._dirty: return
+      dirty = self._dirty
+      self._dirty = set()
+    for con in dirty:
+      con.flush()
 
-      if con not in self._dataForConnection:
-        self._dataForConnection[con] = data
-      else:
-        self._dataForConnection[con].extend(data)
 
-      self._waker.ping()
+class TokenBucket (object):
+  """
+  Allows rate events per second on average, in bursts of up to burst
+  """
+  def __init__ (self, rate, burst = None):
+    self.rate = float(rate)
+    if burst is None: burst = max(rate, 1)
+    self.burst = float(burst)
+    self.tokens = self.burst
+    self.last = time.time()
+
+  def take (self, now = None):
+    """
+    Takes a token if there is one
+    """
+    if now is None: now = time.time()
+    elapsed = now - self.last
+    if elapsed > 0:
+      self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+      self.last = now
+    if self.tokens < 1: return False
+    self.tokens -= 1
+    return True
 
-  def kill (self, con):
-    with self._lock:
-      try:
-        del self._dataForConnection[con]
-      except:
-        pass
 
-      self._waker.ping()
+class PacketInLimiter (object):
+  """
+  Admission control for packet-ins
 
-  def run (self):
-    while core.running:
+  Each connection gets a token bucket allowing rate packet-ins per
+  second, and all connections share one allowing global_rate.  Packet-ins
+  beyond that are dropped or, with the "queue" policy, held (up to
+  queue_limit per connection) and handled as tokens become available.
 
-      with self._lock:
-        cons = self._dataForConnection.keys()
+  If mac_rate is set, a source MAC sending more packet-ins than that per
+  second to a switch gets a flow which drops its traffic on that port for
+  drop_time seconds.
 
-      rlist, wlist, elist = select.select([self._waker], cons, cons, 5)
-      if not core.running: break
+  counters maps DPIDs to Counters of packet-ins "admitted", "dropped" and
+  "queued", and MACs "blocked".
+  """
+  # Most MACs we keep buckets for before starting over
+  max_macs = 10000
+
+  drop_priority = of.OFP_DEFAULT_PRIORITY + 1000
+
+  def __init__ (self, rate = None, global_rate = None, burst = None,
+                policy = "drop", queue_limit = 1000, mac_rate = None,
+                drop_time = 10):
+    if policy not in ("drop", "queue"):
+      raise RuntimeError("Unknown packet-in policy '%s'" % (policy,))
+    self.rate = rate
+    self.burst = burst
+    self.policy = policy
+    self.queue_limit = queue_limit
+    self.mac_rate = mac_rate
+    self.drop_time = drop_time
+    self.counters = defaultdict(Counter)
+
+    self._global = TokenBucket(global_rate, burst) if global_rate else None
+    self._buckets = WeakKeyDictionary() # Connection -> TokenBucket
+    self._queues = {} # Connection -> deque of ofp_packet_ins
+    self._mac_buckets = {} # (DPID, MAC) -> TokenBucket
+    self._blocked = {} # (DPID, MAC) -> expiration time
+    self._drain_scheduled = False
+    self._drain_interval = max(0.01,
+        1.0 / min(r for r in (rate, global_rate, 1) if r))
+
+  def admit (self, con, msg):
+    """
+    Returns True if the packet-in should be handled now
+    """
+    now = time.time()
+    counters = self.counters[con.dpid]
+    if self.mac_rate and not self._check_mac(con, msg, now):
+      counters["dropped"] += 1
+      return False
+    q = self._queues.get(con)
+    if not q and self._take(con, now):
+      counters["admitted"] += 1
+      return True
+    if self.policy == "queue":
+      if q is None: q = self._queues[con] = deque()
+      if len(q) < self.queue_limit:
+        q.append(msg)
+        counters["queued"] += 1
+        self._schedule_drain()
+        return False
+    counters["dropped"] += 1
+    return False
 
-      with self._lock:
-        if len(rlist) > 0:
-          self._waker.pongAll()
+  def _take (self, con, now):
+    b = None
+    if self.rate:
+      b = self._buckets.get(con)
+      if b is None:
+        b = self._buckets[con] = TokenBucket(self.rate, self.burst)
+      if not b.take(now): return False
+    if self._global is not None and not self._global.take(now):
+      if b is not None: b.tokens += 1 # Give it back
+      return False
+    return True
 
-        for con in elist:
-          try:
-            del self._dataForConnection[con]
-          except:
-            pass
+  def _check_mac (self, con, msg, now):
+    # Too short to have a source MAC, so there's nothing to key on
+    if len(msg.data) < 12: return True
+    mac = msg.data[6:12]
+    key = (con.dpid, mac)
+    expires = self._blocked.get(key)
+    if expires is not None:
+      if expires > now: return False
+      del self._blocked[key]
+    b = self._mac_buckets.get(key)
+    if b is None:
+      if len(self._mac_buckets) >= self.max_macs: self._mac_buckets.clear()
+      b = self._mac_buckets[key] = TokenBucket(self.mac_rate)
+    if b.take(now): return True
+
+    del self._mac_buckets[key]
+    self._blocked[key] = now + self.drop_time
+    self.counters[con.dpid]["blocked"] += 1
+    mac = EthAddr(mac)
+    log.warning("%s: Dropping packets from %s on port %s for %s seconds",
+                con, mac, msg.in_port, self.drop_time)
+    fm = of.ofp_flow_mod()
+    fm.match.in_port = msg.in_port
+    fm.match.dl_src = mac
+    fm.priority = self.drop_priority
+    fm.hard_timeout = self.drop_time
+    con.send(fm)
+    return False
+
+  def _schedule_drain (self):
+    if self._drain_scheduled: return
+    self._drain_scheduled = True
+    core.call_delayed(self._drain_interval, self._drain)
+
+  def _drain (self):
+    """
+    Handles queued packet-ins, taking turns among connections
+    """
+    self._drain_scheduled = False
+    now = time.time()
+    active = self._queues.items()
+    while active:
+      still_active = []
+      for con,q in active:
+        if con.disconnected or not self._take(con, now): continue
+        self.counters[con.dpid]["admitted"] += 1
+        _raise_packet_in(con, q.popleft())
+        if q: still_active.append((con,q))
+      active = still_active
+    for con,q in self._queues.items():
+      if con.disconnected or not q: del self._queues[con]
+    if self._queues: self._schedule_drain()
+
+# Set by limit_packet_ins()
+packet_in_limiter = None
+
+def _raise_packet_in (con, msg):
+  e = con.ofnexus.raiseEventNoErrors(PacketIn, con, msg)
+  if e is None or e.halt != True:
+    con.raiseEventNoErrors(PacketIn, con, msg)
 
-        for con in wlist:
-          try:
-            alldata = self._dataForConnection[con]
-            while len(alldata):
-              data = alldata[0]
-              try:
-                l = con.sock.send(data)
-                if l != len(data):
-                  alldata[0] = data[l:]
-                  break
-                del alldata[0]
-              except socket.error as (errno, strerror):
-                if errno != EAGAIN:
-                  con.msg("DeferredSender/Socket error: " + strerror)
-                  con.disconnect()
-                  del self._dataForConnection[con]
-                break
-              except:
-                con.msg("Unknown error doing deferred sending")
-                break
-            if len(alldata) == 0:
-              try:
-                del self._dataForConnection[con]
-                if len(self._dataForConnection) == 0:
-                  self.sending = False
-                  break
-              except:
-                pass
-          except:
-            try:
-              del self._dataForConnection[con]
-            except:
-              pass
 
 class DummyOFNexus (object):
   def raiseEventNoErrors (self, event, *args, **kw):
@@ -712,6 +820,8 @@ class Connection (EventMixin):
   _eventMixin_events = set([
     ConnectionUp,
     ConnectionDown,
+    SendBufferFull,
+    SendBufferDrained,
     PortStatus,
     PacketIn,
     ErrorIn,
@@ -733,6 +843,19 @@ class Connection (EventMixin):
 
   _aborted_connections = 0
 
+  # Reads start at _min_read bytes and double (up to _max_read) each time
+  # the socket fills the whole read.
+  _min_read = 4096
+  _max_read = 65536
+
+  # Largest single write when coalescing queued messages
+  _max_write = 262144
+
+  # When more than send_high_water bytes are queued, SendBufferFull is
+  # raised.  SendBufferDrained is raised once it's back to send_low_water.
+  send_high_water = 1024 * 1024
+  send_low_water = 256 * 1024
+
   def msg (self, m):
     #print str(self), m
     log.debug(str(self) + " " + str(m))
@@ -749,7 +872,21 @@ class Connection (EventMixin):
 
     self.ofnexus = _dummyOFNexus
     self.sock = sock
-    self.buf = b''
+
+    # Receive buffer.  Data between _rstart and _rend has been received
+    # but not yet unpacked (i.e., it's a partial message).
+    self._rbuf = bytearray(self._min_read * 2)
+    self._rview = memoryview(self._rbuf)
+    self._rstart = 0
+    self._rend = 0
+    self._read_size = self._min_read
+
+    # Send queue.  Data is written out by the DeferredSender.
+    self._send_queue = deque()
+    self._send_queued = 0
+    self._send_lock = threading.Lock()
+    self._want_write = False
+    self.send_buffer_full = False
     Connection.ID += 1
     self.ID = Connection.ID
 
@@ -836,11 +973,19 @@ class Connection (EventMixin):
         self.ofnexus.raiseEventNoErrors(ConnectionDown, self)
         self.raiseEventNoErrors(ConnectionDown, self)
 
-    try:
-      #deferredSender.kill(self)
-      pass
-    except:
-      pass
+    with self._send_lock:
+      # One last (non-blocking) try at sending what's queued, such as
+      # error replies
+      data = b''.join(self._send_queue)
+      self._send_queue.clear()
+      self._send_queued = 0
+      if data:
+        try:
+          self.sock.send(data)
+        except socket.error:
+          pass
+    if deferredSender:
+      deferredSender.kill(self)
     try:
       self.sock.shutdown(socket.SHUT_RDWR)
     except:
@@ -857,6 +1002,11 @@ class Connection (EventMixin):
 
     Data should probably either be raw bytes in OpenFlow wire format, or
     an OpenFlow controller-to-switch message object from libopenflow.
+
+    The data is queued and written out (along with anything else queued)
+    shortly afterwards from the recoco loop.  If the queue grows past
+    send_high_water, SendBufferFull is raised; senders that can back off
+    should wait for SendBufferDrained.
     """
     if self.disconnected: return
     if type(data) is not bytes:
@@ -866,64 +1016,158 @@ class Connection (EventMixin):
       assert isinstance(data, of.ofp_header)
       data = data.pack()
 
-    if deferredSender.sending:
-      log.debug("deferred sender is sending!")
-      deferredSender.send(self, data)
-      return
-    try:
-      l = self.sock.send(data)
-      if l != len(data):
-        self.msg("Didn't send complete buffer.")
-        data = data[l:]
-        deferredSender.send(self, data)
-    except socket.error as (errno, strerror):
-      if errno == EAGAIN:
-        self.msg("Out of send buffer space.  " +
-                 "Consider increasing SO_SNDBUF.")
-        deferredSender.send(self, data)
-      else:
-        self.msg("Socket error: " + strerror)
-        self.disconnect(defer_event=True)
+    self._queue(data)
+
+  def _queue (self, data):
+    with self._send_lock:
+      self._send_queue.append(data)
+      self._send_queued += len(data)
+      full = (self._send_queued >= self.send_high_water
+              and not self.send_buffer_full)
+      if full: self.send_buffer_full = True
+
+    if deferredSender:
+      deferredSender.schedule(self)
+    else:
+      self.flush()
+
+    if full:
+      self.msg("Send buffer full (%s bytes queued)" % (self._send_queued,))
+      self.ofnexus.raiseEventNoErrors(SendBufferFull, self)
+      self.raiseEventNoErrors(SendBufferFull, self)
+
+  def flush (self):
+    """
+    Write as much queued data as the socket will take
+
+    Queued messages are joined so that they go out in as few writes as
+    possible.  Returns True if the queue is now empty.
+
+    The lock is held while writing (the socket doesn't block), so this
+    is safe to call from any thread.
+    """
+    q = self._send_queue
+    lock = self._send_lock
+    max_write = self._max_write
+    error = None
+    with lock:
+      while q:
+        data = q.popleft()
+        if q and len(data) < max_write:
+          parts = [data]
+          size = len(data)
+          while q and size < max_write:
+            d = q.popleft()
+            parts.append(d)
+            size += len(d)
+          data = b''.join(parts)
+
+        try:
+          l = self.sock.send(data)
+        except socket.error as (errno, strerror):
+          l = 0
+          if errno != EAGAIN: error = strerror
+
+        self._send_queued -= l
+        if l != len(data):
+          q.appendleft(data[l:])
+          break
+
+    if error is not None:
+      self.msg("Socket error: " + error)
+      self.disconnect(defer_event=True)
+      return False
+
+    drained = False
+    with lock:
+      empty = not q
+      if self.send_buffer_full and self._send_queued <= self.send_low_water:
+        self.send_buffer_full = False
+        drained = True
+
+    if empty == self._want_write:
+      # Only wait for writability while there's something left to write
+      self._want_write = not empty
+      core.scheduler.modifyFD(self, True, not empty)
+
+    if drained:
+      self.ofnexus.raiseEventNoErrors(SendBufferDrained, self)
+      self.raiseEventNoErrors(SendBufferDrained, self)
+
+    return empty
 
   def read (self):
     """
     Read data from this connection.  Generally this is just called by the
     main OpenFlow loop below.
 
+    Data is received directly into a reusable buffer and messages are
+    unpacked from a memoryview of it, so the only copying is moving a
+    trailing partial message back to the front of the buffer.
+
     Note: This function will block if data is not available.
     """
+    buf = self._rbuf
+    start = self._rstart
+    end = self._rend
+    want = self._read_size
+
+    pending = end - start
+    if pending >= 4:
+      # Make sure the rest of a partial message can be read in one go
+      msg_length = buf[start+2] << 8 | buf[start+3]
+      want = max(want, msg_length - pending)
+
+    if len(buf) - end < want:
+      if start:
+        buf[0:pending] = buf[start:end]
+        start = 0
+        end = pending
+      if len(buf) - end < want:
+        size = len(buf) * 2
+        while size - end < want: size *= 2
+        new_buf = bytearray(size)
+        new_buf[0:end] = buf[0:end]
+        buf = self._rbuf = new_buf
+        self._rview = memoryview(buf)
+      self._rstart = start
+      self._rend = end
+
+    view = self._rview
     try:
-      d = self.sock.recv(2048)
+      n = self.sock.recv_into(view[end:end+want], want)
     except:
       return False
-    if len(d) == 0:
+    if n == 0:
       return False
-    self.buf += d
-    buf_len = len(self.buf)
-
-
-    offset = 0
-    while buf_len - offset >= 8: # 8 bytes is minimum OF message size
+    if n == want and self._read_size < self._max_read:
+      self._read_size = min(self._read_size * 2, self._max_read)
+    end += n
+    self._rend = end
+
+    data = view[:end]
+    offset = start
+    while end - offset >= 8: # 8 bytes is minimum OF message size
       # We pull the first four bytes of the OpenFlow header off by hand
-      # (using ord) to find the version/length/type so that we can
-      # correctly call libopenflow to unpack it.
+      # to find the version/length/type so that we can correctly call
+      # libopenflow to unpack it.
 
-      ofp_type = ord(self.buf[offset+1])
+      ofp_type = buf[offset+1]
 
-      if ord(self.buf[offset]) != of.OFP_VERSION:
+      if buf[offset] != of.OFP_VERSION:
         if ofp_type == of.OFPT_HELLO:
           # We let this through and hope the other side switches down.
           pass
         else:
           log.warning("Bad OpenFlow version (0x%02x) on connection %s"
-                      % (ord(self.buf[offset]), self))
+                      % (buf[offset], self))
           return False # Throw connection away
 
-      msg_length = ord(self.buf[offset+2]) << 8 | ord(self.buf[offset+3])
+      msg_length = buf[offset+2] << 8 | buf[offset+3]
 
-      if buf_len - offset < msg_length: break
+      if end - offset < msg_length: break
 
-      new_offset,msg = self.unpackers[ofp_type](self.buf, offset)
+      new_offset,msg = self.unpackers[ofp_type](data, offset)
       assert new_offset - offset == msg_length
       offset = new_offset
 
@@ -936,8 +1180,11 @@ class Connection (EventMixin):
                       ("\n" + str(self) + " ").join(str(msg).split('\n')))
         continue
 
-    if offset != 0:
-      self.buf = self.buf[offset:]
+    if offset == end:
+      # Everything consumed; start over at the front of the buffer
+      self._rstart = self._rend = 0
+    else:
+      self._rstart = offset
 
     return True
 
@@ -1002,18 +1249,70 @@ def wrap_socket (new_sock):
 
 from pox.lib.recoco.recoco import *
 
+class SSLHandshake (object):
+  """
+  A TLS handshake in progress on a newly accepted socket
+
+  The OpenFlow loop calls step() whenever the socket is ready, so a slow
+  switch doesn't hold up anyone else.
+  """
+  def __init__ (self, sock, timeout):
+    self.sock = sock
+    self.deadline = time.time() + timeout
+    self._want_write = False
+
+  def fileno (self):
+    return self.sock.fileno()
+
+  def close (self):
+    self.sock.close()
+
+  def step (self):
+    """
+    Continue the handshake
+
+    Returns True once it's complete.  Raises ssl.SSLError if it fails.
+    """
+    try:
+      self.sock.do_handshake()
+    except ssl.SSLWantReadError:
+      self._wait(False)
+      return False
+    except ssl.SSLWantWriteError:
+      self._wait(True)
+      return False
+    return True
+
+  def _wait (self, write):
+    if write != self._want_write:
+      self._want_write = write
+      core.scheduler.modifyFD(self, not write, write)
+
+
 class OpenFlow_01_Task (Task):
   """
   The main recoco thread for listening to openflow messages
   """
+  # Get a bigger share of the scheduler than default-priority tasks
+  priority = 2
+
+  # Set SO_REUSEPORT on the listening socket so that several processes can
+  # share the OpenFlow port (see openflow.sharding)
+  reuse_port = False
+
+  # Seconds a switch has to finish its TLS handshake
+  handshake_timeout = 10
+
   def __init__ (self, port = 6633, address = '0.0.0.0',
-                ssl_key = None, ssl_cert = None, ssl_ca_cert = None):
+                ssl_key = None, ssl_cert = None, ssl_ca_cert = None,
+                reuse_port = None):
     """
     Initialize
 
     This listener will be for SSL connections if the SSL params are specified
     """
     Task.__init__(self)
+    if reuse_port is not None: self.reuse_port = reuse_port
     self.port = int(port)
     self.address = address
     self.started = False
@@ -1030,8 +1329,27 @@ class OpenFlow_01_Task (Task):
       except:
         raise RuntimeError("SSL is not available")
 
+    self._ssl_context = None
+
     core.addListener(pox.core.GoingUpEvent, self._handle_GoingUpEvent)
 
+  @property
+  def ssl_context (self):
+    """
+    The SSLContext shared by all our connections
+
+    Sharing it lets reconnecting switches resume their TLS sessions.
+    """
+    if self._ssl_context is None:
+      ctx = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+      if self.ssl_cert or self.ssl_key:
+        ctx.load_cert_chain(self.ssl_cert or self.ssl_key, self.ssl_key)
+      if self.ssl_ca_cert is not None:
+        ctx.load_verify_locations(self.ssl_ca_cert)
+        ctx.verify_mode = ssl.CERT_REQUIRED
+      self._ssl_context = ctx
+    return self._ssl_context
+
   def _handle_GoingUpEvent (self, event):
     self.start()
 
@@ -1042,11 +1360,56 @@ class OpenFlow_01_Task (Task):
     return super(OpenFlow_01_Task,self).start()
 
   def run (self):
-    # List of open sockets/connections to select on
-    sockets = []
+    # Open sockets/connections.  These are registered with the scheduler
+    # persistently, so we don't have to pass them all in on every wait.
+    sockets = set()
+    scheduler = core.scheduler
+
+    def add_socket (sock):
+      sockets.add(sock)
+      scheduler.registerFD(self, sock)
+
+    def remove_socket (sock):
+      if sock in sockets:
+        sockets.remove(sock)
+        scheduler.unregisterFD(sock)
+
+    # TLS handshakes in progress (SSLHandshake objects)
+    handshakes = set()
+
+    def end_handshake (handshake):
+      handshakes.discard(handshake)
+      remove_socket(handshake)
+
+    def step_handshake (handshake):
+      try:
+        if not handshake.step(): return
+      except (ssl.SSLError, socket.error) as exc:
+        end_handshake(handshake)
+        handshake.close()
+        if "EOF occurred" in str(exc) or "unexpected eof" in str(exc):
+          # Annoying, but just ignore
+          pass
+        else:
+          log.warn("SSL negotiation failed: " + str(exc))
+        return
+      end_handshake(handshake)
+      new_connection(handshake.sock)
+
+    def new_connection (new_sock):
+      if pox.openflow.debug.pcap_traces:
+        new_sock = wrap_socket(new_sock)
+      new_sock.setblocking(0)
+      # Note that instantiating a Connection object fires a
+      # ConnectionUp event (after negotation has completed)
+      add_socket(Connection(new_sock))
 
     listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if self.reuse_port:
+      # Value is from Linux, for Pythons which don't know it
+      listener.setsockopt(socket.SOL_SOCKET,
+                          getattr(socket, "SO_REUSEPORT", 15), 1)
     try:
       listener.bind((self.address, self.port))
     except socket.error as (errno, strerror):
@@ -1063,7 +1426,7 @@ class OpenFlow_01_Task (Task):
 
     listener.listen(16)
     listener.setblocking(0)
-    sockets.append(listener)
+    add_socket(listener)
 
     log.debug("Listening on %s:%s" %
               (self.address, self.port))
@@ -1073,7 +1436,7 @@ class OpenFlow_01_Task (Task):
       try:
         while True:
           con = None
-          rlist, wlist, elist = yield Select(sockets, [], sockets, 5)
+          rlist, wlist, elist = yield WaitIO(5)
           if len(rlist) == 0 and len(wlist) == 0 and len(elist) == 0:
             if not core.running: break
 
@@ -1081,57 +1444,51 @@ class OpenFlow_01_Task (Task):
             if con is listener:
               raise RuntimeError("Error on listener socket")
             else:
+              remove_socket(con)
+              handshakes.discard(con)
               try:
                 con.close()
               except:
                 pass
-              try:
-                sockets.remove(con)
-              except:
-                pass
+
+          for con in wlist:
+            if isinstance(con, SSLHandshake):
+              if con in handshakes: step_handshake(con)
+            else:
+              con.flush()
 
           timestamp = time.time()
           for con in rlist:
             if con is listener:
               new_sock = listener.accept()[0]
+              new_sock.setblocking(0)
 
               if self.ssl_key or self.ssl_cert or self.ssl_ca_cert:
-                cert_reqs = ssl.CERT_REQUIRED
-                if self.ssl_ca_cert is None:
-                  cert_reqs = ssl.CERT_NONE
-                new_sock = ssl.wrap_socket(new_sock, server_side=True,
-                    keyfile = self.ssl_key, certfile = self.ssl_cert,
-                    ca_certs = self.ssl_ca_cert, cert_reqs = cert_reqs,
-                    do_handshake_on_connect = False,
+                new_sock = self.ssl_context.wrap_socket(new_sock,
+                    server_side = True, do_handshake_on_connect = False,
                     suppress_ragged_eofs = True)
-                #FIXME: We currently do a blocking handshake so that SSL errors
-                #       can't occur out of the blue later.  This isn't a good
-                #       thing, but getting around it will take some effort.
-                try:
-                  new_sock.setblocking(1)
-                  new_sock.do_handshake()
-                except ssl.SSLError as exc:
-                  if exc.errno == 8 and "EOF occurred" in exc.strerror:
-                    # Annoying, but just ignore
-                    pass
-                  else:
-                    #log.exception("SSL negotiation failed")
-                    log.warn("SSL negotiation failed: " + str(exc))
-                  continue
-
-              if pox.openflow.debug.pcap_traces:
-                new_sock = wrap_socket(new_sock)
-              new_sock.setblocking(0)
-              # Note that instantiating a Connection object fires a
-              # ConnectionUp event (after negotation has completed)
-              newcon = Connection(new_sock)
-              sockets.append( newcon )
-              #print str(newcon) + " connected"
+                handshake = SSLHandshake(new_sock, self.handshake_timeout)
+                handshakes.add(handshake)
+                add_socket(handshake)
+                continue
+
+              new_connection(new_sock)
+            elif isinstance(con, SSLHandshake):
+              if con in handshakes: step_handshake(con)
             else:
               con.idle_time = timestamp
               if con.read() is False:
+                remove_socket(con)
                 con.close()
-                sockets.remove(con)
+
+          if handshakes:
+            for h in [h for h in handshakes if h.deadline < timestamp]:
+              log.warn("SSL negotiation timed out")
+              end_handshake(h)
+              h.close()
+
+          # Write out everything handlers sent while processing this batch
+          if deferredSender: deferredSender.flush()
       except KeyboardInterrupt:
         break
       except:
@@ -1151,6 +1508,9 @@ class OpenFlow_01_Task (Task):
             con.info("Connection reset")
           elif sock_error == EMFILE:
             log.error("Couldn't accept connection: out of file descriptors.")
+          elif sock_error == EAGAIN:
+            # Someone else sharing the port got it first
+            pass
           else:
             do_close = True
             log_tb()
@@ -1164,19 +1524,19 @@ class OpenFlow_01_Task (Task):
             log_tb()
 
         if do_close:
+          remove_socket(con)
           try:
             con.close()
           except:
             pass
-          try:
-            sockets.remove(con)
-          except:
-            pass
 
         if do_break:
           # Leave the OpenFlow loop
           break
 
+    for sock in list(sockets):
+      remove_socket(sock)
+
     log.debug("No longer listening for connections")
 
     #pox.core.quit()
@@ -1221,3 +1581,21 @@ def launch (port=6633, address="0.0.0.0", name=None,
                        ssl_ca_cert = ca_cert)
   core.register(name, l)
   return l
+
+
+def limit_packet_ins (rate = None, global_rate = None, burst = None,
+                      policy = "drop", queue_limit = 1000, mac_rate = None,
+                      drop_time = 10):
+  """
+  Limit packet-ins per connection (rate) and overall (global_rate)
+
+  Rates are per second.  Excess packet-ins are dropped, or queued with
+  --policy=queue.  With --mac_rate, source MACs which exceed it have their
+  traffic dropped at the switch for drop_time seconds.
+  """
+  global packet_in_limiter
+  f = lambda v: None if v is None else float(v)
+  packet_in_limiter = PacketInLimiter(rate=f(rate),
+      global_rate=f(global_rate), burst=f(burst), policy=policy,
+      queue_limit=int(queue_limit), mac_rate=f(mac_rate),
+      drop_time=int(drop_time))
@@ -0,0 +1,198 @@
+# Copyright 2013 James McCauley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Handles packet-ins in a pool of worker processes
+
+PacketIn handlers normally run one after another in the recoco thread.
+Handlers which only need the packet itself (and not state kept by the
+controller) can instead be registered with core.openflow_offload, which
+runs them in worker processes:
+
+  def decide (dpid, ofp, packet):
+    msg = of.ofp_packet_out(data = ofp)
+    msg.actions.append(of.ofp_action_output(port = of.OFPP_FLOOD))
+    return [msg]
+
+  core.openflow_offload.add_handler(decide)
+
+A handler is called with the switch's DPID, the ofp_packet_in and the
+parsed packet, and returns a list of OpenFlow messages (or None).  These
+are packed in the worker and sent to the switch from the recoco thread.
+Handlers must be module-level functions, since they're passed to the
+workers by name.
+
+Packet-ins for a given switch always go to the same worker, so they're
+handled in order.  With --by_flow, they're spread by flow instead: by IP
+addresses, protocol and ports for IP packets, and by Ethernet addresses
+otherwise.  Both directions of a flow go to the same worker.  This keeps
+order within a flow but not across a switch.
+
+Normal PacketIn listeners still get the events as usual.
+
+Example:
+  ./pox.py openflow.offload --workers=4 my_component
+"""
+
+from pox.core import core
+from pox.lib.packet.ethernet import ethernet
+from pox.lib.util import str_to_bool
+import pox.openflow.libopenflow_01 as of
+import multiprocessing
+import threading
+import signal
+
+log = core.getLogger()
+
+
+def _flow_key (data):
+  """
+  Returns a hashable key which is the same for both directions of a flow
+  """
+  fields = of._match_fields_from_raw(data, spec_frags=True)
+  if fields is None or fields[4] != 0x0800:
+    # Not IP (or not something we can parse quickly)
+    proto = None
+    a,b = data[6:12],data[0:6]
+  else:
+    proto = fields[6]
+    if proto in (6, 17):
+      a,b = (fields[7],fields[9]),(fields[8],fields[10])
+    else:
+      # ICMP types differ by direction, so just use the addresses
+      a,b = fields[7],fields[8]
+  return (proto,a,b) if a <= b else (proto,b,a)
+
+
+def _work (in_queue, out_queue):
+  """
+  Main loop of a worker process
+  """
+  # Ctrl-C goes to the whole process group; let the controller stop us
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  handlers = []
+  while True:
+    item = in_queue.get()
+    if item is None: break
+    dpid,raw = item
+    if dpid is None:
+      # It's a new handler
+      handlers.append(raw)
+      continue
+    ofp = of.ofp_packet_in()
+    ofp.unpack(raw)
+    packet = ethernet(ofp.data)
+    out = []
+    for handler in handlers:
+      try:
+        msgs = handler(dpid, ofp, packet)
+        if msgs:
+          out.extend(m if isinstance(m, bytes) else m.pack() for m in msgs)
+      except Exception:
+        log.exception("Exception in offloaded handler %s", handler)
+    if out:
+      out_queue.put((dpid, b''.join(out)))
+
+
+class PacketInOffload (object):
+  """
+  Passes packet-ins to worker processes and sends back what they return
+  """
+  _core_name = "openflow_offload"
+
+  def __init__ (self, workers = 2, by_flow = False, deliver = None):
+    """
+    deliver is called as deliver(dpid, data) in a separate thread for
+    each result; by default, the data is sent to the switch.
+    """
+    self.by_flow = by_flow
+    self.submitted = 0
+    self._handlers = []
+    self._deliver = deliver or self._send_later
+    self._out = multiprocessing.Queue()
+    self._queues = []
+    self._processes = []
+    for i in range(workers):
+      q = multiprocessing.Queue()
+      p = multiprocessing.Process(target=_work, args=(q, self._out),
+                                  name="offload%s" % (i,))
+      p.daemon = True
+      p.start()
+      self._queues.append(q)
+      self._processes.append(p)
+
+    t = threading.Thread(target=self._read_results)
+    t.daemon = True
+    t.start()
+
+    core.add_listener(self._handle_GoingDownEvent)
+
+  def add_handler (self, handler):
+    """
+    Run handler(dpid, ofp, packet) in the workers for each packet-in
+    """
+    if not self._handlers:
+      core.call_when_ready(self._listen, "openflow")
+    self._handlers.append(handler)
+    for q in self._queues:
+      q.put((None, handler))
+
+  def _listen (self):
+    core.openflow.addListenerByName("PacketIn", self._handle_PacketIn,
+                                    priority=1)
+
+  def submit (self, dpid, ofp):
+    """
+    Pass an ofp_packet_in from the given switch to a worker
+    """
+    if self.by_flow:
+      key = hash(_flow_key(ofp.data))
+    else:
+      key = dpid
+    self._queues[key % len(self._queues)].put((dpid, ofp.pack()))
+    self.submitted += 1
+
+  def _handle_PacketIn (self, event):
+    self.submit(event.dpid, event.ofp)
+
+  def _read_results (self):
+    while True:
+      item = self._out.get()
+      if item is None: break
+      self._deliver(*item)
+
+  def _send_later (self, dpid, data):
+    core.call_later(self._send, dpid, data)
+
+  def _send (self, dpid, data):
+    con = core.openflow.getConnection(dpid)
+    if con is None:
+      log.debug("Dropping offload result for disconnected %s", dpid)
+      return
+    con.send(data)
+
+  def _handle_GoingDownEvent (self, event):
+    self.stop()
+
+  def stop (self):
+    for q in self._queues:
+      q.put(None)
+    self._out.put(None)
+    for p in self._processes:
+      p.join(1)
+      if p.is_alive(): p.terminate()
+
+
+def launch (workers = 2, by_flow = False):
+  core.register(PacketInOffload(int(workers), by_flow=str_to_bool(by_flow)))
@@ -0,0 +1,336 @@
+# Copyright 2013 James McCauley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Spreads OpenFlow connections across several POX processes
+
+All switch connections are normally served by a single process (and a
+single GIL).  This component starts worker POX processes with the same
+command line (minus this component).  The original process (the
+coordinator) and the workers all listen on the OpenFlow port with
+SO_REUSEPORT, so the kernel spreads switch connections among them.  Each
+process runs the per-switch logic of the other components (for example,
+forwarding.l2_learning) for its own switches.
+
+Only events which matter beyond one switch are sent to the coordinator,
+over a Unix domain socket: connections coming and going, host_tracker's
+HostEvents and openflow.discovery's LinkEvents.  These are raised on the
+coordinator as ShardEvents by core.openflow_sharding.  Components can
+send their own with core.openflow_sharding.forward(name, data), where
+data is anything JSON can encode.  The coordinator counts as shard 0.
+
+Links between switches on different shards can't be found by any one
+process's openflow.discovery, since the LLDP arrives at a process which
+isn't connected to the switch that sent it.  Such LLDP is passed to the
+coordinator, whose openflow.discovery raises the LinkEvents (so they show
+up as ShardEvents from shard 0).
+
+Example:
+  ./pox.py openflow.sharding --workers=4 forwarding.l2_learning
+
+Requires SO_REUSEPORT (Linux 3.9 or later).
+"""
+
+from pox.core import core
+from pox.lib.revent import Event, EventMixin
+from pox.lib.recoco import Task, Select, WaitIO
+import pox.openflow.of_01 as of_01
+import socket
+from errno import EAGAIN
+import json
+import os
+import sys
+import tempfile
+import threading
+import subprocess
+
+log = core.getLogger()
+
+# How this component is named on the command line
+_component = __name__[4:] if __name__.startswith("pox.") else __name__
+
+
+class ShardEvent (Event):
+  """
+  Raised on the coordinator for each event forwarded by a shard
+
+  shard is the shard number (0 for the coordinator itself), name is the
+  kind of event (e.g., "ConnectionUp"), and data is a dict.
+  """
+  def __init__ (self, shard, name, data):
+    Event.__init__(self)
+    self.shard = shard
+    self.name = name
+    self.data = data
+
+
+class _ShardMember (object):
+  """
+  Forwards the local events that matter to the coordinator
+  """
+  shard = None
+
+  def _handle_core_UpEvent (self, event):
+    core.openflow.addListenerByName("ConnectionUp", self._forward_con)
+    core.openflow.addListenerByName("ConnectionDown", self._forward_con)
+    if core.hasComponent("host_tracker"):
+      core.host_tracker.addListenerByName("HostEvent",
+                                          self._forward_HostEvent)
+    if core.hasComponent("openflow_discovery"):
+      core.openflow_discovery.addListenerByName("LinkEvent",
+                                                self._forward_LinkEvent)
+      core.openflow_discovery.remote_link_handler = self._forward_remote_link
+
+  def _forward_con (self, event):
+    self.forward(type(event).__name__, {"dpid":event.dpid})
+
+  def _forward_HostEvent (self, event):
+    e = event.entry
+    data = {"mac":str(e.macaddr), "dpid":e.dpid, "port":e.port,
+            "join":event.join, "leave":event.leave, "move":event.move}
+    if event.move:
+      data["new_dpid"] = event.new_dpid
+      data["new_port"] = event.new_port
+    self.forward("HostEvent", data)
+
+  def _forward_LinkEvent (self, event):
+    self.forward("LinkEvent", {"link":list(event.link),
+                               "added":event.added})
+
+  def _forward_remote_link (self, link):
+    self.forward("RemoteLink", {"link":list(link)})
+
+
+class Coordinator (EventMixin, _ShardMember):
+  """
+  Starts the workers and collects the events they forward
+  """
+  _eventMixin_events = set([ShardEvent])
+  _core_name = "openflow_sharding"
+
+  shard = 0
+
+  def __init__ (self, workers, socket_path, argv):
+    self.workers = workers
+    self.socket_path = socket_path
+    self.switches = {} # DPID -> shard
+    self._argv = argv
+    self._processes = []
+
+    self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    if os.path.exists(socket_path): os.unlink(socket_path)
+    self._listener.bind(socket_path)
+    self._listener.listen(workers)
+
+    core.addListeners(self, prefix="core")
+    _CoordinatorTask(self, self._listener).start()
+
+  def _handle_core_UpEvent (self, event):
+    _ShardMember._handle_core_UpEvent(self, event)
+    for shard in range(1, self.workers):
+      argv = _worker_argv(self._argv, shard, self.socket_path)
+      log.debug("Starting shard %s", shard)
+      self._processes.append(subprocess.Popen([sys.executable] + argv,
+                                              close_fds=True))
+
+  def _handle_core_GoingDownEvent (self, event):
+    for p in self._processes:
+      try:
+        p.terminate()
+      except OSError:
+        pass
+    try:
+      os.unlink(self.socket_path)
+    except OSError:
+      pass
+
+  def forward (self, name, data, shard = 0):
+    discovery = core.components.get("openflow_discovery")
+    if name == "RemoteLink":
+      # Seen by a shard which isn't connected to the originating switch
+      if discovery:
+        discovery.link_seen(discovery.Link(*data["link"]))
+      return
+    if name == "ConnectionUp":
+      self.switches[data["dpid"]] = shard
+    elif name == "ConnectionDown":
+      if self.switches.get(data["dpid"]) == shard:
+        del self.switches[data["dpid"]]
+        # Links it had to other shards' switches are kept here
+        if discovery and shard != 0:
+          discovery.delete_switch_links(data["dpid"])
+    self.raiseEventNoErrors(ShardEvent, shard, name, data)
+
+
+class _CoordinatorTask (Task):
+  """
+  Reads forwarded events from the workers
+  """
+  def __init__ (self, coordinator, listener):
+    Task.__init__(self)
+    self.coordinator = coordinator
+    self.listener = listener
+
+  def run (self):
+    clients = {} # socket -> partial line
+    while core.running:
+      rlist,wlist,elist = yield Select([self.listener] + clients.keys(),
+                                       [], [], 5)
+      for sock in rlist:
+        if sock is self.listener:
+          clients[self.listener.accept()[0]] = ''
+          continue
+        try:
+          data = sock.recv(65536)
+        except socket.error:
+          data = ''
+        if not data:
+          log.warn("Lost a shard")
+          del clients[sock]
+          sock.close()
+          continue
+        lines = (clients[sock] + data).split('\n')
+        clients[sock] = lines.pop()
+        for line in lines:
+          try:
+            msg = json.loads(line)
+            self.coordinator.forward(msg["name"], msg["data"],
+                                     shard=msg["shard"])
+          except Exception:
+            log.exception("Bad message from shard")
+
+
+class Worker (EventMixin, _ShardMember):
+  """
+  Sends events to the coordinator
+
+  ShardEvents are only raised on the coordinator, but they're defined here
+  too so that components can listen for them in any process.
+  """
+  _eventMixin_events = set([ShardEvent])
+  _core_name = "openflow_sharding"
+
+  def __init__ (self, shard, socket_path):
+    self.shard = shard
+    self._lock = threading.Lock()
+    self._out = b'' # Data the coordinator hasn't taken yet
+    self._want_write = False
+    self._lost = False
+    self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self._sock.connect(socket_path)
+    self._sock.setblocking(0)
+
+    core.addListeners(self, prefix="core")
+    task = _WorkerTask(self)
+    core.scheduler.registerFD(task, self._sock)
+    task.start()
+
+  def forward (self, name, data):
+    msg = json.dumps({"shard":self.shard, "name":name, "data":data})
+    with self._lock:
+      if self._lost:
+        log.debug("Dropping %s for lost coordinator", name)
+        return
+      self._out += msg + '\n'
+      self._flush()
+
+  def _flush (self):
+    """
+    Sends as much queued data as the socket will take (call with the lock)
+
+    Anything left is sent by the _WorkerTask once the socket is writable.
+    """
+    try:
+      l = self._sock.send(self._out) if self._out else 0
+    except socket.error as (errno, strerror):
+      l = 0
+      if errno != EAGAIN:
+        # The coordinator is gone (and we're quitting)
+        self._lost = True
+        self._out = b''
+    self._out = self._out[l:]
+    want_write = bool(self._out)
+    if want_write != self._want_write:
+      self._want_write = want_write
+      core.scheduler.modifyFD(self._sock, True, want_write)
+
+
+class _WorkerTask (Task):
+  """
+  Sends a Worker's queued events and quits if the coordinator goes away
+  """
+  def __init__ (self, worker):
+    Task.__init__(self)
+    self.worker = worker
+
+  def run (self):
+    worker = self.worker
+    sock = worker._sock
+    while core.running:
+      rlist,wlist,elist = yield WaitIO(5)
+      if wlist:
+        with worker._lock:
+          worker._flush()
+      if rlist or elist:
+        try:
+          data = sock.recv(4096)
+        except socket.error as (errno, strerror):
+          data = None if errno == EAGAIN else ''
+        if data == '':
+          log.info("Coordinator went away")
+          with worker._lock:
+            worker._lost = True
+          core.scheduler.unregisterFD(sock)
+          core.quit()
+          return
+
+
+def _worker_argv (argv, shard, socket_path):
+  """
+  Turns the coordinator's command line into a worker's
+
+  This component (and its options) are replaced by the worker component.
+  """
+  r = argv[:1]
+  skipping = False
+  for arg in argv[1:]:
+    if not arg.startswith("-"):
+      skipping = arg.split(":")[0] in (_component, "pox." + _component)
+      if skipping:
+        r.append(_component + ":worker")
+        r.append("--shard=%s" % (shard,))
+        r.append("--coordinator=%s" % (socket_path,))
+        continue
+    if not skipping:
+      r.append(arg)
+  return r
+
+
+def worker (shard, coordinator):
+  """
+  Runs a worker (started by the coordinator)
+  """
+  of_01.OpenFlow_01_Task.reuse_port = True
+  core.register(Worker(int(shard), coordinator))
+
+
+def launch (workers = 2, socket_path = None):
+  """
+  Starts a coordinator with the given number of processes (including it)
+  """
+  if socket_path is None:
+    socket_path = os.path.join(tempfile.gettempdir(),
+                               "pox-sharding-%s" % (os.getpid(),))
+  of_01.OpenFlow_01_Task.reuse_port = True
+  core.register(Coordinator(int(workers), socket_path, list(sys.argv)))
@@ -20,6 +20,12 @@ import unittest
 import sys
 import os.path
 from copy import copy
+import random
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 sys.path.append(os.path.dirname(__file__) + "/../../..")
 
@@ -159,6 +165,88 @@ class SwitchImplTest (unittest.TestCase):
     self.assertEqual(event.port.port_no,3)
     self.assertEqual(event.packet, self.packet)
 
+  def test_microflow_cache(self):
+    c = self.conn
+    s = self.switch
+    received = []
+    s.addListener(DpPacketOut, lambda(event): received.append(event))
+    c.to_switch(ofp_flow_mod(xid=124, priority=1,
+                             match=ofp_match(in_port=1, nw_src="1.2.3.4"),
+                             actions = [ ofp_action_output(port=3) ]))
+    s.rx_packet(self.packet, in_port=1)
+    s.rx_packet(self.packet, in_port=1)
+    self.assertEqual([e.port.port_no for e in received], [3, 3])
+    self.assertEqual(len(s._microflow_cache), 1)
+    entry = s.table.entries[0]
+    self.assertEqual(entry.packet_count, 2)
+
+    # with the raw packet, the key comes straight from the bytes
+    self.packet.type = ethernet.IP_TYPE
+    raw = self.packet.pack()
+    s.rx_packet(ethernet(raw), in_port=1, packet_data=raw)
+    s.rx_packet(ethernet(raw), in_port=1, packet_data=raw)
+    self.assertEqual([e.port.port_no for e in received], [3, 3, 3, 3])
+    self.assertEqual(len(s._microflow_cache), 2)
+    self.assertEqual(entry.packet_count, 4)
+
+    # modify the actions -- cached flow should pick up the new ones
+    c.to_switch(ofp_flow_mod(xid=125, command=OFPFC_MODIFY, priority=1,
+                             match=ofp_match(in_port=1, nw_src="1.2.3.4"),
+                             actions = [ ofp_action_output(port=2) ]))
+    s.rx_packet(self.packet, in_port=1)
+    self.assertEqual(received[-1].port.port_no, 2)
+
+    # delete the entry -- should get a packet_in
+    c.to_switch(ofp_flow_mod(xid=126, command=OFPFC_DELETE,
+                             match=ofp_match()))
+    self.assertEqual(len(s._microflow_cache), 0)
+    s.rx_packet(self.packet, in_port=1)
+    self.assertTrue(isinstance(c.last, ofp_packet_in))
+
+    # cache is bounded
+    s.microflow_cache_size = 2
+    for port in (1, 2, 3, 4):
+      s.rx_packet(self.packet, in_port=port)
+    self.assertEqual(len(s._microflow_cache), 2)
+
+  def test_rx_batch(self):
+    self._check_rx_batch()
+
+  @unittest.skipUnless(numpy, "requires NumPy")
+  def test_rx_batch_classifier(self):
+    self.switch.batch_classifier = True
+    self._check_rx_batch()
+
+  def _check_rx_batch(self):
+    c = self.conn
+    s = self.switch
+    received = []
+    s.addListener(DpPacketOut, lambda(event): received.append(event))
+    c.to_switch(ofp_flow_mod(xid=124, priority=1,
+                             match=ofp_match(in_port=1, nw_src="1.2.3.4"),
+                             actions = [ ofp_action_tp_port.set_dst(80),
+                                         ofp_action_output(port=3) ]))
+    self.packet.type = ethernet.IP_TYPE
+    self.packet.payload.protocol = ipv4.UDP_PROTOCOL
+    raw = self.packet.pack()
+    s.rx_batch([(1, raw), (1, raw), (2, raw), (1, raw)])
+
+    # (without the classifier, the first packet fills the cache and the
+    # rest skip parsing)
+    self.assertEqual([e.port.port_no for e in received], [3, 3, 3])
+    for e in received:
+      self.assertEqual(e.packet.find('udp').dstport, 80)
+      self.assertEqual(e.packet.find('udp').srcport, 1234)
+    self.assertEqual(s.table.entries[0].packet_count, 3)
+    self.assertEqual(s.port_stats[1].rx_packets, 3)
+    self.assertEqual(s.port_stats[1].rx_bytes, 3 * len(raw))
+    self.assertEqual(s.port_stats[3].tx_packets, 3)
+
+    # a miss is still a packet_in
+    self.assertTrue(isinstance(c.last, ofp_packet_in))
+    self.assertEqual(c.last.in_port, 2)
+    self.assertEqual(c.last.data, raw)
+
   def test_delete_port(self):
     c = self.conn
     s = self.switch
@@ -324,6 +412,85 @@ class ProcessFlowModTest(unittest.TestCase):
     self.assertEquals(len(t.entries), 3)
 
 
+class CompiledActionsTest (unittest.TestCase):
+  def setUp (self):
+    self.switch = SoftwareSwitch(1, name="sw1")
+    self.switch.set_connection(MockConnection(False))
+    self.sent = []
+    # Keep the raw bytes (parsing and repacking would fix the checksums)
+    self.switch._output_frame_physical = self._output_frame_physical
+
+  def _output_frame_physical (self, frame, port_no):
+    self.sent.append((port_no, frame.data))
+
+  def _packets (self):
+    def ip (protocol, payload):
+      return ipv4(srcip=IPAddr("1.2.3.4"), dstip=IPAddr("1.2.3.5"), tos=0x10,
+                  protocol=protocol, payload=payload)
+    u = udp(srcport=1234, dstport=53, payload="haha")
+    t = tcp(srcport=80, dstport=5555, seq=1, ack=2, off=5, flags=0x10,
+            win=100, payload="hello world")
+    i = icmp(type=8, code=0, payload="ping")
+    a = arp(opcode=arp.REQUEST, hwsrc=EthAddr("00:00:00:00:00:01"),
+            protosrc=IPAddr("1.2.3.4"), protodst=IPAddr("1.2.3.5"))
+    def eth (type, payload, vid = None):
+      e = ethernet(src=EthAddr("00:00:00:00:00:01"),
+                   dst=EthAddr("00:00:00:00:00:02"), type=type,
+                   payload=payload)
+      if vid is not None:
+        e.payload = vlan(id=vid, pcp=5, eth_type=type, payload=payload)
+        e.type = ethernet.VLAN_TYPE
+      return e.pack()
+    return [eth(ethernet.IP_TYPE, ip(ipv4.UDP_PROTOCOL, u)),
+            eth(ethernet.IP_TYPE, ip(ipv4.TCP_PROTOCOL, t)),
+            eth(ethernet.IP_TYPE, ip(ipv4.ICMP_PROTOCOL, i)),
+            eth(ethernet.IP_TYPE, ip(ipv4.UDP_PROTOCOL, u), vid=7),
+            eth(ethernet.IP_TYPE, ip(ipv4.TCP_PROTOCOL, t), vid=7),
+            eth(ethernet.ARP_TYPE, a),
+            eth(ethernet.ARP_TYPE, a, vid=9)]
+
+  def test_raw_rewrites (self):
+    """ Compiled actions have the same results as the action handlers """
+    rewrites = [ofp_action_dl_addr.set_src(EthAddr("00:00:00:00:00:0a")),
+                ofp_action_dl_addr.set_dst(EthAddr("00:00:00:00:00:0b")),
+                ofp_action_vlan_vid(vlan_vid=300),
+                ofp_action_vlan_pcp(vlan_pcp=3),
+                ofp_action_strip_vlan(),
+                ofp_action_nw_addr.set_src(IPAddr("10.0.0.1")),
+                ofp_action_nw_addr.set_dst(IPAddr("192.168.255.254")),
+                ofp_action_nw_tos(nw_tos=0x20),
+                ofp_action_tp_port.set_src(40000),
+                ofp_action_tp_port.set_dst(1)]
+    s = self.switch
+    r = random.Random(1)
+    for raw in self._packets():
+      for i in range(40):
+        actions = r.sample(rewrites, r.randint(1, 4))
+        actions.insert(r.randint(0, len(actions)),
+                       ofp_action_output(port=2))
+        actions.append(ofp_action_output(port=3))
+
+        del self.sent[:]
+        packet = ethernet(raw)
+        for action in actions:
+          packet = s.action_handlers[action.type](action, packet, 1)
+        expected = list(self.sent)
+
+        del self.sent[:]
+        s._compile_actions(actions)(ethernet(raw), raw, 1)
+        self.assertEqual(self.sent, expected, actions)
+
+  def test_packed_once (self):
+    """ Unmodified frames are passed through without repacking """
+    s = self.switch
+    packet = ethernet(self._packets()[0])
+    frames = []
+    s._output_frame_physical = lambda frame, port_no: frames.append(frame)
+    s._compile_actions([ofp_action_output(port=2),
+                        ofp_action_output(port=3)])(packet, None, 1)
+    self.assertEqual(len(frames), 2)
+    self.assertTrue(frames[0] is frames[1])
+    self.assertTrue(frames[0].packet is packet)
 
 
 if __name__ == '__main__':
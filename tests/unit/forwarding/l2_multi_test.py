@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 James McCauley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import sys
+import os.path
+import random
+
+sys.path.append(os.path.dirname(__file__) + "/../../..")
+
+from pox.core import core
+import pox.openflow.libopenflow_01 as of
+import pox.forwarding.l2_multi as l2m
+
+
+class PathTest (unittest.TestCase):
+  def setUp (self):
+    l2m.adjacency.clear()
+    l2m.switches.clear()
+    l2m.path_map.clear()
+    l2m.path_cache.clear()
+    self.sws = []
+    for dpid in range(1, 31):
+      sw = l2m.Switch()
+      sw.dpid = dpid
+      l2m.switches[dpid] = sw
+      self.sws.append(sw)
+
+  def tearDown (self):
+    l2m.LAZY_PATHS = False
+    self.setUp()
+
+  def _link (self, sw1, sw2, up):
+    was = l2m.adjacency[sw1][sw2]
+    if up:
+      l2m.adjacency[sw1][sw2] = sw2.dpid
+      l2m.adjacency[sw2][sw1] = sw1.dpid
+    else:
+      l2m.adjacency[sw1].pop(sw2, None)
+      l2m.adjacency[sw2].pop(sw1, None)
+    if (was is None) == up:
+      l2m._update_paths(sw1, sw2, up)
+
+  def _check (self):
+    # Compare against paths computed from scratch
+    fresh = {}
+    for sw in self.sws:
+      fresh[sw] = dict(l2m.path_map.get(sw) or l2m._calc_paths_from(sw))
+    incremental = dict(l2m.path_map)
+    l2m.path_map.clear()
+    for sw in self.sws:
+      l2m._calc_paths_from(sw)
+    for src in self.sws:
+      expected = l2m.path_map[src]
+      for dst in self.sws:
+        if dst not in expected:
+          self.assertEqual(fresh[src].get(dst), None)
+          continue
+        self.assertEqual(fresh[src][dst][0], expected[dst][0])
+        path = [src] + l2m._get_raw_path(src, dst) + [dst]
+        if src is dst: path = [src]
+        self.assertEqual(len(path) - 1, expected[dst][0])
+        for a,b in zip(path[:-1], path[1:]):
+          self.assertTrue(l2m.adjacency[a][b] is not None)
+    l2m.path_map.clear()
+    l2m.path_map.update(incremental)
+
+  def _flap (self):
+    r = random.Random(1)
+    links = [(a,b) for a in self.sws for b in self.sws if a.dpid < b.dpid]
+    for i in range(200):
+      a,b = r.choice(links)
+      self._link(a, b, r.random() < 0.6)
+      if i % 10 == 0:
+        # Use some rows so that there's something to update
+        for sw in r.sample(self.sws, 5):
+          l2m._get_raw_path(sw, r.choice(self.sws))
+      self._check()
+
+  def test_incremental (self):
+    """ Incremental updates match a full recomputation """
+    self._flap()
+
+  def test_lazy (self):
+    """ Lazy updates match a full recomputation """
+    l2m.LAZY_PATHS = True
+    self._flap()
+
+  def test_unaffected (self):
+    """ Sources not using a removed link keep their paths """
+    a,b,c = self.sws[:3]
+    self._link(a, b, True)
+    self._link(b, c, True)
+    self._link(a, c, True)
+    self.assertEqual(l2m._get_raw_path(a, c), [])
+    row = l2m.path_map[a]
+    self._link(b, c, False)
+    self.assertTrue(l2m.path_map[a] is row)
+    self.assertEqual(l2m._get_raw_path(b, c), [a])
+
+  def test_path_cache (self):
+    """ Cooked paths come from the cache with the end ports filled in """
+    a,b,c = self.sws[:3]
+    self._link(a, b, True)
+    self._link(b, c, True)
+    p = l2m._get_path(a, c, 5, 6)
+    self.assertEqual(p, [(a,5,b.dpid), (b,a.dpid,c.dpid), (c,b.dpid,6)])
+    hops = l2m.path_cache[(a,c)]
+    self.assertEqual(l2m._get_path(a, c, 7, 8)[1:-1], p[1:-1])
+    self.assertTrue(l2m.path_cache[(a,c)] is hops)
+    self.assertEqual(l2m._get_path(a, a, 1, 2), [(a,1,2)])
+    self.assertEqual(l2m._get_path(a, self.sws[3], 1, 2), None)
+
+  def test_ecmp (self):
+    """ ECMP spreads flows over equal-cost paths """
+    # a-d has two equal-cost paths, via b and via c
+    a,b,c,d = self.sws[:4]
+    for x,y in ((a,b),(a,c),(b,d),(c,d)):
+      self._link(x, y, True)
+    self.assertEqual(l2m._get_next_hops(a, d), (b,c))
+    self.assertEqual(l2m._get_next_hops(b, d), (d,))
+    self.assertEqual(l2m._get_next_hops(d, d), ())
+
+    def used (count = 100):
+      r = {}
+      for i in range(count):
+        m = of.ofp_match(dl_type=0x800, nw_proto=6, nw_src="10.0.0.1",
+                         nw_dst="10.0.0.2", tp_src=1000+i, tp_dst=80)
+        p = l2m._get_path(a, d, 1, 2, m)
+        self.assertEqual(p, l2m._get_path(a, d, 1, 2, m))
+        self.assertEqual(len(p), 3)
+        self.assertTrue(l2m._check_path(p))
+        r[p[1][0]] = r.get(p[1][0], 0) + 1
+      return r
+
+    self.assertEqual(len(used()), 1)
+    l2m.ECMP = True
+    try:
+      self.assertEqual(set(used()), set([b,c]))
+
+      # Avoid a busy link
+      l2m.ECMP_STATS_INTERVAL = 5
+      l2m.port_load[(a.dpid, l2m.adjacency[a][b])] = (0, 0, 100.0)
+      counts = used()
+    finally:
+      l2m.ECMP = False
+      l2m.ECMP_STATS_INTERVAL = None
+      l2m.port_load.clear()
+    self.assertTrue(counts.get(b, 0) < 10)
+
+
+class MockConnection (object):
+  def __init__ (self):
+    self.sent = []
+
+  def send (self, data):
+    self.sent.append(data)
+
+
+class InstallerTest (unittest.TestCase):
+  def setUp (self):
+    self.installer = l2m.PathInstaller()
+    self.installer._scheduled = True # We flush by hand
+    self.sws = []
+    for dpid in range(1, 4):
+      sw = l2m.Switch()
+      sw.dpid = dpid
+      sw.connection = MockConnection()
+      self.sws.append(sw)
+    l2m.waiting_paths.clear()
+    self.installed = []
+    class Fake (l2m.l2_multi):
+      def __init__ (self): pass
+    self.l2m = Fake()
+    self.l2m.addListenerByName("PathInstalled",
+                               lambda e: self.installed.append(e.path))
+    core.components['l2_multi'] = self.l2m
+
+  def tearDown (self):
+    del core.components['l2_multi']
+    l2m.waiting_paths.clear()
+
+  def _barrier (self, sw):
+    # The barrier is the last thing in each batch
+    data = sw.connection.sent[-1][-8:]
+    offset,msg = of.ofp_barrier_request.unpack_new(data)
+    class Event (object): pass
+    e = Event()
+    e.dpid = sw.dpid
+    e.xid = msg.xid
+    self.l2m._handle_openflow_BarrierIn(e)
+
+  def test_shared_barriers (self):
+    """ Paths share a barrier per switch and complete together """
+    a,b,c = self.sws
+    paths = [[(a,1,2),(b,1,2)], [(a,3,2),(b,1,3),(c,1,2)]]
+    wps = []
+    for p in paths:
+      wp = l2m.WaitingPath(p, None)
+      wps.append(wp)
+      for sw,in_port,out_port in p:
+        self.installer.send(sw, of.ofp_flow_mod(
+            match=of.ofp_match(in_port=in_port),
+            action=of.ofp_action_output(port=out_port)))
+        self.installer.wait(sw, wp)
+    self.installer.flush()
+
+    for sw,count in ((a,2),(b,2),(c,1)):
+      self.assertEqual(len(sw.connection.sent), 1)
+      data = sw.connection.sent[0]
+      self.assertEqual(len(data), count * 80 + 8)
+      # Match was packed at send time
+      self.assertEqual(of.ofp_flow_mod.unpack_new(data)[1].match.in_port,
+                       paths[0][0][1] if sw is a else 1)
+    self.assertEqual(len(l2m.waiting_paths), 3)
+
+    self._barrier(a)
+    self._barrier(c)
+    self.assertEqual(self.installed, [])
+    self._barrier(b)
+    self.assertEqual(sorted(map(len, self.installed)), [2, 3])
+    self.assertEqual(l2m.waiting_paths, {})
+    self.assertEqual(len(l2m.path_setup_times), 2)
+    latency = self.l2m.setup_latency((50, 99))
+    self.assertEqual(sorted(latency), [50, 99])
+
+  def test_expire (self):
+    """ Paths through disconnected switches expire """
+    a,b,c = self.sws
+    b.connection = None
+    wp = l2m.WaitingPath([(a,1,2),(b,1,2)], None)
+    for sw in (a,b):
+      self.installer.wait(sw, wp)
+    self.installer.flush()
+    self._barrier(a)
+    self.assertEqual(self.installed, [])
+    self.installer.wait(a, l2m.WaitingPath([(a,1,2)], None))
+    self.installer.flush()
+    wp.expires_at = 0
+    l2m.WaitingPath.expire_waiting_paths()
+    self.assertEqual(len(l2m.waiting_paths), 1)
+
+  def test_disconnect_before_flush (self):
+    """ Paths through a switch which went away before the flush expire """
+    a,b,c = self.sws
+    wp = l2m.WaitingPath([(a,1,2)], None)
+    self.installer.send(a, of.ofp_flow_mod())
+    self.installer.wait(a, wp)
+    a.connection = None
+    self.installer.flush()
+    self.assertEqual(l2m.waiting_paths, {(a.dpid,None):[wp]})
+    l2m.WaitingPath.expire_waiting_paths()
+    self.assertEqual(len(l2m.waiting_paths), 1)
+    wp.expires_at = 0
+    l2m.WaitingPath.expire_waiting_paths()
+    self.assertEqual(l2m.waiting_paths, {})
+    self.assertEqual(self.installed, [])
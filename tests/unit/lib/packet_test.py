@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 James McCauley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import sys
+import os.path
+
+sys.path.append(os.path.dirname(__file__) + "/../../..")
+from pox.lib.packet import *
+from pox.lib.addresses import EthAddr, IPAddr, IPAddr6
+import pox.openflow.libopenflow_01 as of
+
+
+def make_packets ():
+  src = EthAddr("00:00:00:00:00:01")
+  dst = EthAddr("00:00:00:00:00:02")
+  r = []
+
+  t = tcp(srcport=1234, dstport=80, payload=b'hello')
+  i = ipv4(srcip=IPAddr("10.0.0.1"), dstip=IPAddr("10.0.0.2"),
+           protocol=ipv4.TCP_PROTOCOL, payload=t)
+  r.append(ethernet(src=src, dst=dst, type=ethernet.IP_TYPE, payload=i))
+
+  u = udp(srcport=1000, dstport=2000, payload=b'x' * 10)
+  i = ipv4(srcip=IPAddr("10.0.0.1"), dstip=IPAddr("10.0.0.2"),
+           protocol=ipv4.UDP_PROTOCOL, payload=u)
+  v = vlan(id=5, eth_type=ethernet.IP_TYPE, payload=i)
+  r.append(ethernet(src=src, dst=dst, type=ethernet.VLAN_TYPE, payload=v))
+
+  a = arp(opcode=arp.REQUEST, hwsrc=src, protosrc=IPAddr("10.0.0.1"),
+          protodst=IPAddr("10.0.0.2"))
+  r.append(ethernet(src=src, dst=dst, type=ethernet.ARP_TYPE, payload=a))
+
+  u = udp(srcport=1000, dstport=2000, payload=b'y' * 10)
+  i = ipv6(srcip=IPAddr6("fe80::1"), dstip=IPAddr6("fe80::2"),
+           next_header_type=ipv6.UDP_PROTOCOL, payload=u)
+  r.append(ethernet(src=src, dst=dst, type=ethernet.IPV6_TYPE, payload=i))
+
+  return [p.pack() for p in r]
+
+
+class LazyParseTest (unittest.TestCase):
+  def test_deferred (self):
+    raw = make_packets()[0]
+    p = ethernet(raw, lazy=True)
+    self.assertEqual(p.src, EthAddr("00:00:00:00:00:01"))
+    self.assertTrue('next' not in p.__dict__)
+    ip = p.payload
+    self.assertTrue(isinstance(ip, ipv4))
+    self.assertTrue(ip.lazy)
+    self.assertTrue('next' not in ip.__dict__)
+    self.assertEqual(ip.payload.dstport, 80)
+
+  def test_same_as_eager (self):
+    for raw in make_packets():
+      eager = ethernet(raw)
+      lazy = ethernet(raw, lazy=True)
+      self.assertEqual(lazy.dump(), eager.dump())
+      self.assertEqual(lazy.pack(), raw)
+      self.assertEqual(of.ofp_match.from_packet(ethernet(raw, lazy=True)),
+                       of.ofp_match.from_packet(eager))
+
+  def test_set_before_parse (self):
+    raw = make_packets()[0]
+    p = ethernet(raw, lazy=True)
+    p.payload = b'replaced'
+    self.assertEqual(p.next, b'replaced')
+    self.assertEqual(p.pack(), raw[:14] + b'replaced')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+#
+# Copyright 2011-2013 James McCauley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import sys
+import os.path
+import time
+import threading
+import socket
+
+sys.path.append(os.path.dirname(__file__) + "/../../..")
+
+from pox.lib.recoco import Scheduler, Timer, Task, WaitIO, ReadyQueue
+
+class FakeTask (object):
+  def __init__ (self, name, priority):
+    self.name = name
+    self.priority = priority
+  def __repr__ (self):
+    return self.name
+
+
+class ReadyQueueTest (unittest.TestCase):
+  def test_weighted (self):
+    q = ReadyQueue()
+    a = FakeTask('a', 1)
+    b = FakeTask('b', 2)
+    idle = FakeTask('idle', 0)
+    for t in (a, b, idle): q.append(t)
+    self.assertEqual(len(q), 3)
+    self.assertTrue(idle in q)
+    counts = {'a':0, 'b':0, 'idle':0}
+    for _ in range(30):
+      t = q.popleft()
+      q.charge(1)
+      counts[t.name] += 1
+      if t is not idle: q.append(t)
+    self.assertEqual(counts, {'a':10, 'b':20, 'idle':0})
+
+    # Idle tasks run when nothing else is ready
+    q.popleft()
+    q.popleft()
+    self.assertTrue(q.popleft() is idle)
+    self.assertTrue(q.popleft() is None)
+
+  def test_first (self):
+    q = ReadyQueue()
+    a = FakeTask('a', 1)
+    b = FakeTask('b', 1)
+    q.append(a)
+    q.appendleft(b)
+    self.assertTrue(q.popleft() is b)
+    self.assertTrue(q.popleft() is a)
+
+  def test_no_banking (self):
+    # A level which was empty for a while shouldn't then monopolize things
+    q = ReadyQueue()
+    a = FakeTask('a', 1)
+    b = FakeTask('b', 1.5)
+    q.append(a)
+    for _ in range(10):
+      q.popleft()
+      q.charge(1)
+      q.append(a)
+    q.append(b)
+    order = []
+    for _ in range(5):
+      t = q.popleft()
+      q.charge(1)
+      order.append(t.name)
+      q.append(t)
+    self.assertTrue('a' in order[:3])
+
+
+class TimerTest (unittest.TestCase):
+  def setUp (self):
+    self.scheduler = Scheduler(isDefaultScheduler=True, daemon=True)
+
+  def tearDown (self):
+    self.scheduler.quit()
+    self.scheduler._selectHub.break_idle()
+    self.scheduler._thread.join(5)
+
+  def test_timer_order (self):
+    fired = []
+    done = threading.Event()
+    def cb (n):
+      fired.append(n)
+      if len(fired) == 3: done.set()
+    for n in (5, 1, 3, 2, 4):
+      Timer(0.05 + n * 0.02, cb, args=(n,), scheduler=self.scheduler)
+    t = Timer(0.01, cb, args=(0,), scheduler=self.scheduler, started=False)
+    t.cancel()
+    # The three earliest timers should fire in order
+    done.wait(5)
+    self.assertEqual(fired[:3], [1, 2, 3])
+
+  def test_cancel (self):
+    fired = []
+    t1 = Timer(0.2, fired.append, args=(1,), scheduler=self.scheduler)
+    t2 = Timer(0.05, fired.append, args=(2,), scheduler=self.scheduler)
+    time.sleep(0.01)
+    t1.cancel()
+    hub = self.scheduler._selectHub
+    deadline = time.time() + 5
+    while t1 in hub._waiting and time.time() < deadline:
+      time.sleep(0.01)
+    self.assertFalse(t1 in hub._waiting)
+    time.sleep(0.3)
+    self.assertEqual(fired, [2])
+
+
+class WaitIOTest (unittest.TestCase):
+  use_epoll = False
+
+  def setUp (self):
+    self.scheduler = Scheduler(isDefaultScheduler=True, daemon=True,
+                               use_epoll=self.use_epoll)
+
+  def tearDown (self):
+    self.scheduler.quit()
+    self.scheduler._selectHub.break_idle()
+    self.scheduler._thread.join(5)
+
+  def test_registered_fds (self):
+    pairs = [socket.socketpair() for _ in range(3)]
+    readers = [p[0] for p in pairs]
+    got = []
+    ready = threading.Event()
+    scheduler = self.scheduler
+
+    class Reader (Task):
+      def run (self):
+        for r in readers:
+          scheduler.registerFD(self, r)
+        while len(got) < 2:
+          rl,wl,xl = yield WaitIO(5)
+          for r in rl:
+            got.append((readers.index(r), r.recv(100)))
+          ready.set()
+        for r in readers:
+          scheduler.unregisterFD(r)
+
+    Reader().start(scheduler)
+    time.sleep(0.05)
+    pairs[1][1].send("one")
+    ready.wait(5)
+    ready.clear()
+    pairs[2][1].send("two")
+    ready.wait(5)
+    self.assertEqual(got, [(1, "one"), (2, "two")])
+
+
+@unittest.skipUnless(sys.platform.startswith("linux"), "requires Linux")
+class EpollWaitIOTest (WaitIOTest):
+  use_epoll = True
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 James McCauley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import sys
+import os.path
+
+sys.path.append(os.path.dirname(__file__) + "/../../..")
+
+from pox.lib.revent import *
+
+
+class Ping (Event):
+  created = 0
+  def __init__ (self, value = None):
+    Event.__init__(self)
+    Ping.created += 1
+    self.value = value
+
+class Wrapped (Event):
+  def _invoke (self, handler, *args, **kw):
+    return handler("wrapped", *args, **kw)
+
+class Other (Event):
+  pass
+
+class Source (EventMixin):
+  _eventMixin_events = set([Ping, Wrapped])
+
+
+class DispatchTest (unittest.TestCase):
+  def setUp (self):
+    self.s = Source()
+    self.got = []
+
+  def _add (self, name, rv = None, **kw):
+    def handler (event):
+      self.got.append(name)
+      return rv
+    return self.s.addListener(Ping, handler, **kw)
+
+  def test_no_listeners (self):
+    """ Events aren't created when nobody is listening """
+    Ping.created = 0
+    self.assertEqual(self.s.raiseEvent(Ping, 1), None)
+    self.assertEqual(Ping.created, 0)
+    self._add("a")
+    e = self.s.raiseEvent(Ping, 1)
+    self.assertEqual((Ping.created, e.value, e.source), (1, 1, self.s))
+
+  def test_order_and_returns (self):
+    """ Priorities, once, halt and remove all work """
+    self._add("low", priority=-1)
+    self._add("once", once=True, priority=1)
+    self._add("remove", rv=EventRemove, priority=2)
+    self._add("high", priority=3)
+    self.s.raiseEvent(Ping)
+    self.assertEqual(self.got, ["high", "remove", "once", "low"])
+    del self.got[:]
+    self._add("halt", rv=EventHalt, priority=0)
+    e = self.s.raiseEvent(Ping())
+    self.assertEqual(self.got, ["high", "halt"])
+    self.assertTrue(e.halt)
+
+  def test_modify_while_raising (self):
+    """ Listeners added while raising are only called next time """
+    def add (event):
+      self.got.append("add")
+      self._add("new")
+      return EventRemove
+    self.s.addListener(Ping, add)
+    self.s.raiseEvent(Ping)
+    self.assertEqual(self.got, ["add"])
+    self.s.raiseEvent(Ping)
+    self.assertEqual(self.got, ["add", "new"])
+
+  def test_remove (self):
+    """ Removed listeners aren't called """
+    l = self._add("a")
+    self._add("b")
+    self.s.raiseEvent(Ping)
+    self.s.removeListener(l)
+    self.s.raiseEvent(Ping)
+    self.assertEqual(self.got, ["a", "b", "b"])
+    self.s.clearHandlers()
+    self.s.raiseEvent(Ping)
+    self.assertEqual(self.got, ["a", "b", "b"])
+
+  def test_invoke (self):
+    """ Custom _invoke() methods are still used """
+    self.s.addListener(Wrapped, self.got.append)
+    self.s.raiseEvent(Wrapped)
+    self.assertEqual(self.got, ["wrapped"])
+
+  def test_undefined (self):
+    """ Undefined events can't be raised """
+    self.assertRaises(ReventError, self.s.raiseEvent, Other())
+    self.assertRaises(ReventError, self.s.raiseEvent, Other())
+    self.s._eventMixin_addEvent(Other)
+    self.s.raiseEvent(Other())
+
+  def test_batch (self):
+    """ Batch listeners get lists of events when flushed """
+    flushes = []
+    batches = []
+    l = self.s.add_batch_listener(batches.append, Ping,
+                                  schedule=flushes.append)
+    self._add("halt", rv=EventHalt, priority=1)
+    self.s.raiseEvent(Ping, 0)
+    self.assertEqual(flushes, [])
+    self.s.removeListener(self.s._eventMixin_handlers[Ping][0][3])
+    for i in range(3):
+      self.s.raiseEvent(Ping, i)
+    self.assertEqual(len(flushes), 1)
+    flushes.pop()()
+    self.assertEqual([[e.value for e in b] for b in batches], [[0,1,2]])
+    self.s.raiseEvent(Ping, 3)
+    flushes.pop()()
+    self.assertEqual(batches[-1][0].value, 3)
+    self.s.removeListener(l)
+    self.s.raiseEvent(Ping, 4)
+    self.assertEqual(flushes, [])
+
+    def _handle_Ping (events):
+      batches.append(events)
+    self.s.add_batch_listener(_handle_Ping, schedule=lambda f: f())
+    self.s.raiseEvent(Ping, 5)
+    self.assertEqual(batches[-1][0].value, 5)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 James McCauley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import sys
+import os.path
+import random
+
+sys.path.append(os.path.dirname(__file__) + "/../../..")
+
+from pox.openflow.libopenflow_01 import *
+from pox.openflow.flow_table import *
+from pox.lib.packet import *
+from pox.lib.addresses import EthAddr, IPAddr
+from tests.unit.openflow.match_fixtures import macs, host_ips, random_match
+
+try:
+  import numpy
+  from pox.openflow.batch_classifier import BatchClassifier, extract_fields
+  from pox.openflow.batch_classifier import FIELDS
+except ImportError:
+  numpy = None
+
+def _random_match (r):
+  m = random_match(r)
+  if m.in_port is None and r.random() < 0.9:
+    m.dl_type = 0x800
+    m.nw_src = r.choice(host_ips) # Leave some packets unmatched
+  return m
+
+
+def _random_frame (r):
+  """
+  Returns raw bytes for a random (and sometimes odd) frame
+  """
+  ip = lambda: IPAddr(r.choice(host_ips))
+  kind = r.choice(["udp", "tcp", "tcp_opts", "icmp", "frag", "arp", "llc",
+                   "short"])
+  if kind == "short":
+    return "\x00\x00\x00\x00\x00\x01\x00\x00\x00\x00\x00\x02\x08\x00\x45"
+  if kind == "arp":
+    p = arp(opcode=r.choice([1, 2]), hwsrc=r.choice(macs),
+            protosrc=ip(), protodst=ip())
+    t = ethernet.ARP_TYPE
+  elif kind == "llc":
+    p = "\xaa\xaa\x03\x00\x00\x00\x08\x00" + "x" * 30
+    t = len(p)
+  else:
+    if kind == "udp":
+      l4 = udp(srcport=1234, dstport=r.choice([53, 80]), payload="hi")
+      proto = ipv4.UDP_PROTOCOL
+    elif kind == "icmp":
+      l4 = icmp(type=r.choice([0, 8]), code=0, payload="ping")
+      proto = ipv4.ICMP_PROTOCOL
+    else:
+      l4 = tcp(srcport=1234, dstport=r.choice([53, 80]), off=5,
+               payload="hello")
+      if kind == "tcp_opts":
+        l4.options = [tcp_opt(tcp_opt.MSS, 1460)]
+        l4.off = 6
+      proto = ipv4.TCP_PROTOCOL
+    p = ipv4(srcip=ip(), dstip=ip(), protocol=proto, payload=l4,
+             tos=r.choice([0, 0x10]))
+    if kind == "frag":
+      p.frag = 10
+    t = ethernet.IP_TYPE
+  if r.random() < 0.3 and kind != "llc":
+    p = vlan(id=7, pcp=2, eth_type=t, payload=p)
+    t = ethernet.VLAN_TYPE
+  return ethernet(src=r.choice(macs), dst=r.choice(macs), type=t,
+                  payload=p).pack()
+
+
+@unittest.skipUnless(numpy, "requires NumPy")
+class BatchClassifierTest (unittest.TestCase):
+  def test_extract_fields (self):
+    """ Fields are the same as from ofp_match.from_packet() """
+    r = random.Random(1)
+    frames = [_random_frame(r) for i in range(300)]
+    in_ports = [r.randint(1, 3) for f in frames]
+    cols = extract_fields(frames, in_ports)
+    for i,f in enumerate(frames):
+      m = ofp_match.from_packet(f, in_ports[i], spec_frags=True)
+      for row,field in enumerate(FIELDS):
+        v = getattr(m, field)
+        if v is None:
+          v = -1
+        elif isinstance(v, EthAddr):
+          v = int(v.toRaw().encode("hex"), 16)
+        elif isinstance(v, IPAddr):
+          v = v.toUnsigned()
+        self.assertEqual(cols[row,i], v, (field, repr(f)))
+
+  def test_classify (self):
+    """ Results agree with FlowTable.entry_for_packet() """
+    r = random.Random(2)
+    table = FlowTable()
+    classifier = BatchClassifier(table)
+    for i in range(200):
+      table.add_entry(TableEntry(priority=r.choice([1, 5, 10]), cookie=i,
+                                 match=_random_match(r)))
+
+    def check ():
+      frames = [_random_frame(r) for i in range(300)]
+      in_ports = [r.randint(1, 4) for f in frames]
+      found = classifier.classify(frames, in_ports)
+      for i,f in enumerate(frames):
+        e = table.entry_for_packet(f, in_ports[i])
+        self.assertEqual(e, None if found[i] < 0
+                         else classifier.entries[found[i]])
+      return found
+
+    found = check()
+    self.assertTrue((found >= 0).any() and (found < 0).any())
+
+    # The table is recompiled after changes
+    table.remove_matching_entries(ofp_match(dl_type=0x800))
+    check()
+    table.add_entry(TableEntry(priority=3, match=ofp_match()))
+    self.assertTrue((check() >= 0).all())
+
+
+if __name__ == '__main__':
+  unittest.main()
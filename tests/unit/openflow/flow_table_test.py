@@ -29,6 +29,8 @@ from pox.openflow.libopenflow_01 import *
 from pox.openflow.flow_table import *
 from pox.openflow import *
 from pox.openflow.topology import *
+from tests.unit.openflow.match_fixtures import macs, ips, host_ips
+from tests.unit.openflow.match_fixtures import random_match
 
 class TableEntryTest(unittest.TestCase):
   def test_create(self):
@@ -111,6 +113,121 @@ class FlowTableTest(unittest.TestCase):
       t.remove_expired_entries(now=time)
       self.assertEqual(sorted([e.cookie for e in t.entries]), remaining)
 
+  def test_expiry_index(self):
+    """ test that removed, re-added and touched entries expire correctly """
+    t = FlowTable()
+    removed = []
+    def handler (event):
+      if event.removed: removed.append((event.reason, event.removed))
+    t.addListenerByName("FlowTableModification", handler)
+    e1 = TableEntry(now=0, cookie=1, idle_timeout=5)
+    e2 = TableEntry(now=0, cookie=2, hard_timeout=8)
+    t.add_entry(e1)
+    t.add_entry(e2)
+    t.remove_entry(e2)
+    t.add_entry(e2)
+    for now in range(1, 8):
+      e1.touch_packet(1, now=now)
+      t.remove_expired_entries(now=now)
+    self.assertEqual(len(t), 2)
+    self.assertEqual(removed[1:], [])
+    t.remove_expired_entries(now=9)
+    self.assertEqual(removed[1:], [(OFPRR_HARD_TIMEOUT, [e2])])
+    t.remove_expired_entries(now=13)
+    self.assertEqual(removed[2:], [(OFPRR_IDLE_TIMEOUT, [e1])])
+    self.assertEqual(t._expiry_seqs, {})
+
+  def test_indexed_entry_for_packet(self):
+    """ test that the indexed classifier agrees with the linear scan """
+    import random
+    r = random.Random(42)
+
+    def random_packet():
+      tp = r.choice([udp, tcp])(srcport=1234, dstport=r.choice([53, 80]))
+      if isinstance(tp, tcp): tp.off = 5
+      ip = ipv4(srcip=IPAddr(r.choice(host_ips)),
+                dstip=IPAddr(r.choice(host_ips)),
+                protocol=ipv4.UDP_PROTOCOL if isinstance(tp, udp)
+                         else ipv4.TCP_PROTOCOL, payload=tp)
+      return ethernet(src=r.choice(macs), dst=r.choice(macs),
+                      type=ethernet.IP_TYPE, payload=ip)
+
+    linear = FlowTable()
+    indexed = FlowTable(indexed=True)
+    for i in range(200):
+      m = random_match(r)
+      prio = r.choice([1, 5, 10])
+      linear.add_entry(TableEntry(priority=prio, cookie=i, match=m))
+      indexed.add_entry(TableEntry(priority=prio, cookie=i, match=m))
+
+    def check():
+      for _ in range(300):
+        packet = random_packet()
+        in_port = r.randint(1, 3)
+        a = linear.entry_for_packet(packet, in_port)
+        b = indexed.entry_for_packet(packet, in_port)
+        self.assertEqual(a and a.cookie, b and b.cookie)
+
+    check()
+    for m in (ofp_match(dl_type=0x800, nw_src="10.0.0.0/24"),
+              ofp_match(in_port=2)):
+      removed = linear.remove_matching_entries(m)
+      indexed.remove_matching_entries(m)
+      self.assertTrue(removed)
+      check()
+    for e in list(linear.entries[::3]):
+      linear.remove_entry(e)
+    for e in list(indexed.entries[::3]):
+      indexed.remove_entry(e)
+    self.assertEqual(len(indexed._classifier), len(indexed))
+    check()
+
+  def test_strict_and_overlap(self):
+    """ test that the strict and overlap indexes agree with a scan """
+    import random
+    r = random.Random(7)
+    t = FlowTable()
+    for i in range(300):
+      t.add_entry(TableEntry(priority=r.choice([1, 5]), cookie=i,
+                             match=random_match(r)))
+
+    def check():
+      found = 0
+      for i in range(300):
+        if i % 3:
+          m = random_match(r)
+          prio = r.choice([1, 5])
+        else:
+          e = r.choice(t.entries)
+          m = e.match.clone()
+          prio = e.priority
+        strict = [e.cookie for e in t.entries
+                  if e.is_matched_by(m, priority=prio, strict=True)]
+        self.assertEqual(sorted(strict),
+            sorted(e.cookie for e in t.matching_entries(m, prio, True)))
+        new = TableEntry(priority=prio, match=m)
+        overlap = any(e.is_matched_by(m) or new.is_matched_by(e.match)
+                      for e in t.entries
+                      if e.effective_priority == new.effective_priority)
+        self.assertEqual(t.check_for_overlapping_entry(new), overlap)
+        found += overlap
+      self.assertTrue(0 < found < 300)
+
+    check()
+    for e in list(t.entries[::2]):
+      t.remove_entry(e)
+    t.remove_matching_entries(ofp_match(in_port=2))
+    check()
+
+    # An entry with host bits beyond its prefix
+    t = FlowTable()
+    t.add_entry(TableEntry(priority=1,
+                           match=ofp_match(dl_type=0x800,
+                                           nw_src=("10.0.0.5", 24))))
+    new = TableEntry(priority=1,
+                     match=ofp_match(dl_type=0x800, nw_src="10.0.0.0/24"))
+    self.assertTrue(t.check_for_overlapping_entry(new))
+
   # def test_check_for_overlap_entries(self):
 
 
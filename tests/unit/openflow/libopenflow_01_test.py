@@ -22,6 +22,7 @@ from copy import copy
 sys.path.append(os.path.dirname(__file__) + "/../../..")
 
 from pox.openflow.libopenflow_01 import *
+import pox.openflow.libopenflow_01 as of
 from pox.datapaths.switch import *
 
 def extract_num(buf, start, length):
@@ -135,6 +136,72 @@ class ofp_match_test(unittest.TestCase):
     assertMatch(create(nw_src="10.0.0.0/25"), create(nw_src="10.0.0.127"))
     assertNoMatch(create(nw_src="10.0.0.0/25"), create(nw_src="10.0.0.128"))
 
+  def test_from_packet_raw(self):
+    """ ofp_match: from_packet on raw bytes agrees with parsed packets """
+    from pox.lib.packet import (ethernet, vlan, llc, ipv4, tcp, tcp_opt,
+                                udp, icmp, arp)
+    src = EthAddr("00:00:00:00:00:01")
+    dst = EthAddr("00:00:00:00:00:02")
+    def ip(proto, payload, **kw):
+      return ipv4(srcip=IPAddr("10.0.0.1"), dstip=IPAddr("10.0.0.2"),
+                  protocol=proto, tos=0x10, payload=payload, **kw)
+    def eth(t, payload):
+      return ethernet(src=src, dst=dst, type=t, payload=payload).pack()
+
+    t = tcp(srcport=1234, dstport=80, payload=b'data')
+    topt = tcp(srcport=1234, dstport=80, payload=b'data',
+               options=[tcp_opt(tcp_opt.MSS, 1460)])
+    sack = tcp(srcport=1234, dstport=80, payload=b'data',
+               options=[tcp_opt(tcp_opt.SACK, [(1,2)])])
+    u = udp(srcport=1000, dstport=2000, payload=b'x' * 8)
+    i = icmp(type=8, code=0, payload=b'ping')
+    packets = [
+      eth(ethernet.IP_TYPE, ip(ipv4.TCP_PROTOCOL, t)),
+      eth(ethernet.IP_TYPE, ip(ipv4.TCP_PROTOCOL, topt)),
+      eth(ethernet.IP_TYPE, ip(ipv4.TCP_PROTOCOL, sack)),
+      eth(ethernet.IP_TYPE, ip(ipv4.UDP_PROTOCOL, u)),
+      eth(ethernet.IP_TYPE, ip(ipv4.ICMP_PROTOCOL, i)),
+      eth(ethernet.IP_TYPE, ip(ipv4.UDP_PROTOCOL, u, flags=ipv4.MF_FLAG)),
+      eth(ethernet.IP_TYPE, ip(ipv4.UDP_PROTOCOL, u, frag=10)),
+      eth(ethernet.IP_TYPE, ip(99, b'zzzz')),
+      eth(ethernet.VLAN_TYPE, vlan(id=7, pcp=3, eth_type=ethernet.IP_TYPE,
+                                   payload=ip(ipv4.UDP_PROTOCOL, u))),
+      eth(ethernet.VLAN_TYPE, vlan(id=7, eth_type=ethernet.VLAN_TYPE,
+                                   payload=vlan(id=8))),
+      eth(ethernet.ARP_TYPE, arp(opcode=arp.REQUEST, hwsrc=src,
+                                 protosrc=IPAddr("10.0.0.1"),
+                                 protodst=IPAddr("10.0.0.2"))),
+      eth(ethernet.ARP_TYPE, arp(opcode=1000)),
+      eth(0x1234, b'opaque'),
+      eth(50, llc(dsap=0xaa, ssap=0xaa, control=3, oui=b'\0\0\0',
+                  eth_type=ethernet.IP_TYPE,
+                  payload=ip(ipv4.UDP_PROTOCOL, u))),
+    ]
+    # Bad IP version and a bad ARP hardware type
+    raw = bytearray(packets[0])
+    raw[14] = 0x65
+    packets.append(bytes(raw))
+    raw = bytearray(packets[10])
+    raw[15] = 9
+    packets.append(bytes(raw))
+
+    fast = 0
+    for raw in packets:
+      for n in range(len(raw), 0, -1):
+        data = raw[:n]
+        for spec_frags in (False, True):
+          try:
+            slow = ofp_match.from_packet(ethernet(data), 3,
+                                         spec_frags=spec_frags)
+          except Exception:
+            continue
+          m = ofp_match.from_packet(data, 3, spec_frags=spec_frags)
+          self.assertEqual(m, slow, "%s bytes of %s: %s != %s" %
+                           (n, raw.encode("hex"), m.show(), slow.show()))
+          if n == len(raw) and of._match_fields_from_raw(data) is not None:
+            fast += 1
+    self.assertTrue(fast > 20)
+
 class ofp_command_test(unittest.TestCase):
   # custom map of POX class to header type, for validation
   ofp_type = {
@@ -194,6 +261,12 @@ class ofp_command_test(unittest.TestCase):
     unpacked = type(o)()
     unpacked.unpack(pack)
     self.assertEqual(o, unpacked, "pack_unpacked -- original != unpacked\n===Original:\n%s\n===Repacked:%s\n" % (show(o), show(unpacked)))
+    # unpacking from (an offset into) a memoryview should work the same
+    view = memoryview(bytearray(b"\xff\xff" + pack))
+    offset,unpacked_view = type(o).unpack_new(view, 2)
+    self.assertEqual(offset, len(pack) + 2)
+    self.assertEqual(o, unpacked_view, "pack_unpacked -- original != unpacked from memoryview\n===Original:\n%s\n===Unpacked:%s\n" % (show(o), show(unpacked_view)))
+    self.assertEqual(unpacked_view.pack(), pack)
     return unpacked
 
   def test_header_pack_unpack(self):
@@ -312,6 +385,42 @@ class ofp_command_test(unittest.TestCase):
             for (check_attr,val) in attrs.iteritems():
               self.assertEqual(getattr(unpacked, check_attr), val)
 
+  def test_pack_unpack_codecs(self):
+    """ generated field codecs pack and unpack every field """
+    m = ofp_match(in_port=2, dl_type=0x0800, nw_proto=17, nw_tos=4,
+                  nw_src="10.1.0.0/16", nw_dst="10.0.0.2", tp_dst=53,
+                  dl_vlan_pcp=None)
+    packed = m.pack()
+    self.assertEqual(packed, struct.pack("!LH6s6sHBxHBBxxLLHH",
+        m.wildcards, 2, EMPTY_ETH.toRaw(), EMPTY_ETH.toRaw(), 0, 0,
+        0x0800, 4, 17, IPAddr("10.1.0.0").toUnsigned(),
+        IPAddr("10.0.0.2").toUnsigned(), 0, 53))
+    unpacked = ofp_match()
+    self.assertEqual(unpacked.unpack(packed), len(packed))
+    self.assertEqual(unpacked, m)
+
+    # Fields whose prerequisites are missing still pack as zero
+    bad = ofp_match(dl_type=0x86dd, nw_proto=6, nw_src=1, tp_src=80)
+    self.assertEqual(bad.pack()[24:], b"\0" * 16)
+
+    fm = ofp_flow_mod(xid=7, cookie=0x1122334455667788, idle_timeout=3,
+                      hard_timeout=4, priority=5, out_port=6, flags=1,
+                      buffer_id=9, match=m)
+    self._test_pack_unpack(fm, 7, OFPT_FLOW_MOD)
+    fr = ofp_flow_removed(xid=8, match=ofp_match(in_port=1),
+                          cookie=fm.cookie, priority=5, reason=2,
+                          duration_sec=10, duration_nsec=11, idle_timeout=3,
+                          packet_count=1<<40, byte_count=1<<50)
+    unpacked = self._test_pack_unpack(fr, 8, OFPT_FLOW_REMOVED)
+    self.assertEqual(unpacked.byte_count, 1<<50)
+    pi = ofp_packet_in(xid=9, buffer_id=3, in_port=4, reason=1, data=b"abc")
+    unpacked = self._test_pack_unpack(pi, 9, OFPT_PACKET_IN)
+    self.assertEqual((unpacked.buffer_id, unpacked.in_port, unpacked.data),
+                     (3, 4, b"abc"))
+
+    self.assertRaises(UnderrunError, ofp_flow_removed.unpack_new,
+                      fr.pack()[:-1])
+
 class ofp_action_test(unittest.TestCase):
   def assert_packed_action(self, cls, packed, a_type, length):
     self.assertEqual(extract_num(packed, 0,2), a_type, "Action %s: expected type %d (but is %d)" % (cls, a_type, extract_num(packed, 0,2)))
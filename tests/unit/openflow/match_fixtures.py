@@ -0,0 +1,46 @@
+# Copyright 2013 James McCauley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Random matches for testing flow table lookups against a linear scan
+"""
+
+from pox.openflow.libopenflow_01 import ofp_match, OFP_VLAN_NONE
+from pox.lib.addresses import EthAddr
+
+macs = [EthAddr("00:00:00:00:00:0%i" % (i,)) for i in range(1,4)]
+
+# The first few are usable as packet addresses.  The last has host bits
+# set beyond its prefix.
+host_ips = ["10.0.0.1", "10.0.0.2", "10.0.1.1"]
+ips = host_ips + ["10.0.0.0/24", "10.0.0.0/8", ("10.0.0.5", 24)]
+
+
+def random_match (r):
+  """
+  Returns a random match using the given random.Random
+  """
+  m = ofp_match()
+  if r.random() < 0.5: m.in_port = r.randint(1, 3)
+  if r.random() < 0.4: m.dl_src = r.choice(macs)
+  if r.random() < 0.4: m.dl_dst = r.choice(macs)
+  if r.random() < 0.2: m.dl_vlan = r.choice([OFP_VLAN_NONE, 7])
+  if r.random() < 0.7: m.dl_type = r.choice([0x800, 0x800, 0x806])
+  if r.random() < 0.4: m.nw_src = r.choice(ips)
+  if r.random() < 0.4: m.nw_dst = r.choice(ips)
+  if r.random() < 0.4: m.nw_proto = r.choice([1, 6, 17])
+  if r.random() < 0.1: m.nw_tos = r.choice([0, 0x10])
+  if r.random() < 0.3: m.tp_src = r.choice([0, 8, 1234])
+  if r.random() < 0.3: m.tp_dst = r.choice([0, 53, 80])
+  return m
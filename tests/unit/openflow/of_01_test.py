@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 James McCauley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import sys
+import os.path
+import socket
+from errno import EAGAIN
+
+sys.path.append(os.path.dirname(__file__) + "/../../..")
+import pox.openflow.libopenflow_01 as of
+import pox.openflow.of_01 as of_01
+from pox.openflow.of_01 import Connection
+from pox.lib.packet.ethernet import ethernet
+from pox.lib.addresses import EthAddr
+
+
+class ChunkSocket (object):
+  """
+  A fake socket which hands out pre-set chunks of data
+  """
+  def __init__ (self, chunks):
+    self.chunks = list(chunks)
+    self.sent = []
+
+  def send (self, data):
+    self.sent.append(data)
+    return len(data)
+
+  def recv_into (self, buffer, nbytes):
+    if not self.chunks: return 0
+    d = self.chunks.pop(0)
+    assert len(d) <= nbytes
+    buffer[0:len(d)] = d
+    return len(d)
+
+
+class BlockingSocket (ChunkSocket):
+  """
+  A fake socket whose send buffer can be closed off
+  """
+  def __init__ (self):
+    ChunkSocket.__init__(self, [])
+    self.blocked = False
+
+  def send (self, data):
+    if self.blocked:
+      raise socket.error(EAGAIN, "Resource temporarily unavailable")
+    return ChunkSocket.send(self, data)
+
+
+class ConnectionReadTest (unittest.TestCase):
+  def setUp (self):
+    # Without a deferred sender, Connection.send() writes immediately
+    self._old_sender = of_01.deferredSender
+    of_01.deferredSender = None
+
+  def tearDown (self):
+    of_01.deferredSender = self._old_sender
+
+  def _read_all (self, chunks):
+    con = Connection(ChunkSocket(chunks))
+    got = []
+    con.handlers = [lambda con, msg: got.append(msg)] * len(con.unpackers)
+    while con.read(): pass
+    return con, got
+
+  def test_split_messages (self):
+    msgs = [of.ofp_echo_request(body=b'x' * n, xid=n) for n in range(0, 60, 7)]
+    msgs.append(of.ofp_packet_out(data=b'y' * 20000, xid=99))
+    data = b''.join(m.pack() for m in msgs)
+    # Deliberately awkward chunk boundaries (mid-header and mid-body)
+    chunks = []
+    i = 0
+    for size in [3, 5, 1, 11, 64, 4000, 4096]:
+      chunks.append(data[i:i+size])
+      i += size
+    while i < len(data):
+      chunks.append(data[i:i+3000])
+      i += 3000
+    con, got = self._read_all(chunks)
+    self.assertEqual(got, msgs)
+    for m in got:
+      self.assertTrue(all(type(getattr(m, a)) is not memoryview
+                          for a in ('body', 'data') if hasattr(m, a)))
+    self.assertEqual(con._rstart, 0)
+    self.assertEqual(con._rend, 0)
+
+  def test_read_size_grows (self):
+    data = b''.join(of.ofp_echo_request(body=b'z' * 1000).pack()
+                    for _ in range(200))
+    chunks = []
+    i = 0
+    size = Connection._min_read
+    while i < len(data):
+      chunks.append(data[i:i+size])
+      i += size
+      size = min(size * 2, Connection._max_read)
+    con, got = self._read_all(chunks)
+    self.assertEqual(len(got), 200)
+    self.assertEqual(con._read_size, Connection._max_read)
+
+
+class ConnectionSendTest (unittest.TestCase):
+  def setUp (self):
+    self._old_sender = of_01.deferredSender
+    of_01.deferredSender = None
+    # Record requests for write readiness instead of passing them on
+    self.modified = []
+    of_01.core.scheduler.modifyFD = lambda *args: self.modified.append(args)
+
+  def tearDown (self):
+    of_01.deferredSender = self._old_sender
+    del of_01.core.scheduler.modifyFD
+
+  def test_coalesce (self):
+    sock = BlockingSocket()
+    con = Connection(sock)
+    self.assertEqual(len(sock.sent), 1) # Hello
+    sock.blocked = True
+    msgs = [of.ofp_flow_mod(xid=i) for i in range(10)]
+    for m in msgs:
+      con.send(m)
+    self.assertEqual(con._send_queued, sum(len(m) for m in msgs))
+    self.assertEqual(self.modified, [(con, True, True)])
+    sock.blocked = False
+    self.assertTrue(con.flush())
+    self.assertEqual(self.modified[1:], [(con, True, False)])
+    self.assertEqual(len(sock.sent), 2)
+    self.assertEqual(sock.sent[1], b''.join(m.pack() for m in msgs))
+    self.assertEqual(con._send_queued, 0)
+
+  def test_watermarks (self):
+    sock = BlockingSocket()
+    con = Connection(sock)
+    con.send_high_water = 1000
+    con.send_low_water = 500
+    events = []
+    con.addListenerByName("SendBufferFull", events.append)
+    con.addListenerByName("SendBufferDrained", events.append)
+    sock.blocked = True
+    for i in range(20):
+      con.send(of.ofp_packet_out(data=b'x' * 100))
+    self.assertEqual([type(e).__name__ for e in events], ["SendBufferFull"])
+    self.assertTrue(con.send_buffer_full)
+    sock.blocked = False
+    con.flush()
+    self.assertEqual([type(e).__name__ for e in events],
+                     ["SendBufferFull", "SendBufferDrained"])
+    self.assertFalse(con.send_buffer_full)
+
+  def test_disconnect_flushes (self):
+    sock = BlockingSocket()
+    con = Connection(sock)
+    sock.blocked = True
+    msg = of.ofp_error(xid=5)
+    con.send(msg)
+    sock.blocked = False
+    con.disconnect()
+    self.assertEqual(sock.sent[1:], [msg.pack()])
+    self.assertEqual(con._send_queued, 0)
+
+
+class QuietNexus (object):
+  def raiseEventNoErrors (self, *args, **kw):
+    return None
+
+
+class PacketInLimiterTest (unittest.TestCase):
+  def setUp (self):
+    self._old_sender = of_01.deferredSender
+    of_01.deferredSender = None
+    self.sock = ChunkSocket([])
+    self.con = Connection(self.sock)
+    self.con.dpid = 1
+    self.con.ofnexus = QuietNexus()
+    self.got = []
+    self.con.addListenerByName("PacketIn",
+                               lambda e: self.got.append(e.ofp.xid))
+
+  def tearDown (self):
+    of_01.deferredSender = self._old_sender
+    of_01.packet_in_limiter = None
+
+  def _packet_ins (self, xids, src = "00:00:00:00:00:01"):
+    for xid in xids:
+      e = ethernet(src=EthAddr(src), dst=EthAddr("00:00:00:00:00:02"))
+      msg = of.ofp_packet_in(xid=xid, in_port=1, data=e.pack())
+      of_01.DefaultOpenFlowHandlers.handle_PACKET_IN(self.con, msg)
+
+  def test_drop (self):
+    l = of_01.packet_in_limiter = of_01.PacketInLimiter(rate=0.001,
+                                                        burst=3)
+    self._packet_ins(range(5))
+    self.assertEqual(self.got, [0, 1, 2])
+    self.assertEqual(l.counters[1], {"admitted":3, "dropped":2})
+
+  def test_global (self):
+    l = of_01.packet_in_limiter = of_01.PacketInLimiter(rate=0.001,
+        global_rate=0.001, burst=2)
+    l._global.tokens = 1
+    self._packet_ins(range(3))
+    self.assertEqual(self.got, [0])
+    # The connection's token wasn't used up
+    self.assertEqual(int(l._buckets[self.con].tokens), 1)
+
+  def test_queue (self):
+    l = of_01.packet_in_limiter = of_01.PacketInLimiter(rate=0.001,
+        burst=2, policy="queue", queue_limit=3)
+    l._drain_scheduled = True # We'll drain by hand
+    self._packet_ins(range(6))
+    self.assertEqual(self.got, [0, 1])
+    self.assertEqual(l.counters[1],
+                     {"admitted":2, "queued":3, "dropped":1})
+    l._buckets[self.con].tokens = 2
+    l._drain()
+    self.assertEqual(self.got, [0, 1, 2, 3])
+    # Later packet-ins wait their turn behind queued ones
+    l._buckets[self.con].tokens = 1
+    self._packet_ins([6])
+    self.assertEqual(self.got, [0, 1, 2, 3])
+    l._drain_scheduled = True
+    l._drain()
+    self.assertEqual(self.got, [0, 1, 2, 3, 4])
+    self.assertEqual([m.xid for m in l._queues[self.con]], [6])
+
+  def test_mac_rate (self):
+    l = of_01.packet_in_limiter = of_01.PacketInLimiter(mac_rate=2)
+    self._packet_ins(range(4))
+    self._packet_ins([4], src="00:00:00:00:00:03")
+    self.assertEqual(self.got, [0, 1, 4])
+    self.assertEqual(l.counters[1]["blocked"], 1)
+    fm = of.ofp_flow_mod()
+    fm.unpack(self.sock.sent[-1])
+    self.assertEqual((fm.match.dl_src, fm.match.in_port, fm.actions),
+                     (EthAddr("00:00:00:00:00:01"), 1, []))
+    self.assertEqual(fm.hard_timeout, 10)
+
+  def test_mac_rate_short (self):
+    l = of_01.packet_in_limiter = of_01.PacketInLimiter(mac_rate=2)
+    # Too short to have a source MAC, so not limited by it
+    for xid,data in enumerate(["", "\x01" * 7, "\x02" * 11] * 3):
+      msg = of.ofp_packet_in(xid=xid, in_port=1, data=data)
+      of_01.DefaultOpenFlowHandlers.handle_PACKET_IN(self.con, msg)
+    self.assertEqual(self.got, range(9))
+    self.assertEqual(l.counters[1]["blocked"], 0)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 James McCauley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import sys
+import os.path
+import Queue
+
+sys.path.append(os.path.dirname(__file__) + "/../../..")
+
+from pox.openflow.offload import PacketInOffload
+import pox.openflow.libopenflow_01 as of
+from pox.lib.packet import ethernet, ipv4, udp
+from pox.lib.addresses import EthAddr, IPAddr
+
+
+def flood (dpid, ofp, packet):
+  if packet.dst.is_multicast: return None
+  msg = of.ofp_packet_out(data = ofp)
+  msg.actions.append(of.ofp_action_output(port = of.OFPP_FLOOD))
+  return [msg]
+
+def tag (dpid, ofp, packet):
+  return [of.ofp_barrier_request(xid = ofp.xid)]
+
+
+class OffloadTest (unittest.TestCase):
+  def setUp (self):
+    self.results = Queue.Queue()
+    self.pool = PacketInOffload(2, deliver=lambda *r: self.results.put(r))
+
+  def tearDown (self):
+    self.pool.stop()
+
+  def _packet_in (self, xid, dst = "00:00:00:00:00:02"):
+    e = ethernet(src=EthAddr("00:00:00:00:00:01"), dst=EthAddr(dst))
+    return of.ofp_packet_in(xid=xid, in_port=3, data=e.pack(),
+                            buffer_id=None)
+
+  def test_offload (self):
+    """ Workers run the handlers and return packed messages in order """
+    for q in self.pool._queues:
+      q.put((None, flood))
+      q.put((None, tag))
+    self.pool.submit(1, self._packet_in(10, dst="ff:ff:ff:ff:ff:ff"))
+    for xid in range(11, 15):
+      self.pool.submit(1, self._packet_in(xid))
+
+    # The broadcast is only tagged
+    dpid,data = self.results.get(timeout=5)
+    self.assertEqual(dpid, 1)
+    b = of.ofp_barrier_request()
+    b.unpack(data)
+    self.assertEqual((len(data), b.xid), (8, 10))
+
+    for xid in range(11, 15):
+      dpid,data = self.results.get(timeout=5)
+      po = of.ofp_packet_out()
+      offset,length = po.unpack(data)
+      self.assertEqual(po.in_port, 3)
+      self.assertEqual(po.actions[0].port, of.OFPP_FLOOD)
+      b.unpack(data[offset:])
+      self.assertEqual(b.xid, xid)
+
+
+
+class FlowSpreadTest (unittest.TestCase):
+  def test_by_flow (self):
+    """ Flows between the same MACs can go to different workers """
+    pool = PacketInOffload.__new__(PacketInOffload)
+    pool.by_flow = True
+    pool.submitted = 0
+    pool._queues = [Queue.Queue() for i in range(4)]
+    host = EthAddr("00:00:00:00:00:01")
+    gateway = EthAddr("00:00:00:00:00:fe")
+
+    def packet_in (port, reply = False):
+      u = udp(srcport=port, dstport=53, payload="x")
+      ip = ipv4(srcip=IPAddr("10.0.0.1"), dstip=IPAddr("8.8.8.8"),
+                protocol=ipv4.UDP_PROTOCOL, payload=u)
+      e = ethernet(src=host, dst=gateway, type=ethernet.IP_TYPE, payload=ip)
+      if reply:
+        u.srcport,u.dstport = u.dstport,u.srcport
+        ip.srcip,ip.dstip = ip.dstip,ip.srcip
+        e.src,e.dst = e.dst,e.src
+      return of.ofp_packet_in(in_port=1, data=e.pack())
+
+    def worker (msg):
+      pool.submit(1, msg)
+      for i,q in enumerate(pool._queues):
+        if not q.empty():
+          q.get()
+          return i
+
+    workers = [worker(packet_in(port)) for port in range(1000, 1020)]
+    self.assertTrue(len(set(workers)) > 1)
+    # Both directions of a flow go to the same one
+    for port,w in zip(range(1000, 1020), workers):
+      self.assertEqual(worker(packet_in(port, reply=True)), w)
+
+
+if __name__ == '__main__':
+  unittest.main()
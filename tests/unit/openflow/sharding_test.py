@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 James McCauley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import sys
+import os.path
+import socket
+import threading
+import json
+
+sys.path.append(os.path.dirname(__file__) + "/../../..")
+
+from pox.core import core
+from pox.openflow.sharding import _worker_argv, Coordinator, Worker
+from pox.openflow.discovery import Link
+
+
+class ShardingTest (unittest.TestCase):
+  def test_worker_argv (self):
+    """ Workers run everything but the sharding component """
+    argv = ["pox.py", "--verbose", "openflow.sharding", "--workers=4",
+            "forwarding.l2_learning", "--transparent", "host_tracker"]
+    self.assertEqual(_worker_argv(argv, 2, "/tmp/s"),
+        ["pox.py", "--verbose", "openflow.sharding:worker", "--shard=2",
+         "--coordinator=/tmp/s", "forwarding.l2_learning", "--transparent",
+         "host_tracker"])
+    argv = ["pox.py", "forwarding.hub", "pox.openflow.sharding"]
+    self.assertEqual(_worker_argv(argv, 1, "/tmp/s"),
+        ["pox.py", "forwarding.hub", "openflow.sharding:worker", "--shard=1",
+         "--coordinator=/tmp/s"])
+
+  def test_switches (self):
+    """ The coordinator tracks which shard has each switch """
+    c = Coordinator.__new__(Coordinator)
+    c.switches = {}
+    events = []
+    c.addListenerByName("ShardEvent", events.append)
+    c.forward("ConnectionUp", {"dpid":1}, shard=1)
+    c.forward("ConnectionUp", {"dpid":2})
+    # Reconnected to another shard before the old one noticed
+    c.forward("ConnectionUp", {"dpid":1}, shard=2)
+    c.forward("ConnectionDown", {"dpid":1}, shard=1)
+    self.assertEqual(c.switches, {1:2, 2:0})
+    self.assertEqual([(e.shard,e.name) for e in events],
+                     [(1,"ConnectionUp"), (0,"ConnectionUp"),
+                      (2,"ConnectionUp"), (1,"ConnectionDown")])
+
+  def test_remote_links (self):
+    """ Links seen by shards without their originator go to discovery """
+    class FakeDiscovery (object):
+      Link = Link
+      def __init__ (self):
+        self.seen = []
+        self.deleted = []
+      def link_seen (self, link):
+        self.seen.append(link)
+      def delete_switch_links (self, dpid):
+        self.deleted.append(dpid)
+    discovery = FakeDiscovery()
+    c = Coordinator.__new__(Coordinator)
+    c.switches = {}
+    events = []
+    c.addListenerByName("ShardEvent", events.append)
+    core.components["openflow_discovery"] = discovery
+    try:
+      c.forward("ConnectionUp", {"dpid":1}, shard=1)
+      c.forward("RemoteLink", {"link":[2, 3, 1, 4]}, shard=1)
+      c.forward("ConnectionDown", {"dpid":1}, shard=1)
+    finally:
+      del core.components["openflow_discovery"]
+    self.assertEqual(discovery.seen, [Link(2, 3, 1, 4)])
+    self.assertEqual(discovery.deleted, [1])
+    self.assertEqual([e.name for e in events],
+                     ["ConnectionUp", "ConnectionDown"])
+
+  def _worker (self):
+    w = Worker.__new__(Worker)
+    w.shard = 1
+    w._lock = threading.Lock()
+    w._out = b''
+    w._want_write = False
+    w._lost = False
+    w._sock,other = socket.socketpair()
+    w._sock.setblocking(0)
+    self.modified = []
+    core.scheduler.modifyFD = lambda *args: self.modified.append(args)
+    return w,other
+
+  def tearDown (self):
+    if 'modifyFD' in core.scheduler.__dict__:
+      del core.scheduler.modifyFD
+
+  def test_queued_sends (self):
+    """ Forwarding doesn't block when the coordinator isn't reading """
+    w,other = self._worker()
+    count = 0
+    while not w._out:
+      w.forward("Big", {"data":"x" * 10000, "count":count})
+      count += 1
+    self.assertEqual(self.modified, [(w._sock, True, True)])
+    lines = []
+    data = ''
+    while True:
+      data += other.recv(65536)
+      lines = data.split('\n')
+      w._flush()
+      if len(lines) > count: break
+    self.assertEqual(self.modified[1:], [(w._sock, True, False)])
+    self.assertEqual([json.loads(l)["data"]["count"] for l in lines[:-1]],
+                     range(count))
+    w._sock.close()
+    other.close()
+
+  def test_lost_coordinator (self):
+    """ Events are dropped once the coordinator is gone """
+    w,other = self._worker()
+    other.close()
+    for i in range(3):
+      w.forward("ConnectionUp", {"dpid":i})
+    self.assertTrue(w._lost)
+    self.assertEqual(w._out, b'')
+    w._sock.close()
+
+
+if __name__ == '__main__':
+  unittest.main()
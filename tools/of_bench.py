@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+# Copyright 2013 James McCauley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Rough throughput benchmark for libopenflow_01 packing/unpacking
+
+Run from the POX directory.  Prints thousands of operations per second
+for packing and unpacking some common messages.
+"""
+
+import sys
+import os
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import pox.openflow.libopenflow_01 as of
+from pox.lib.addresses import EthAddr, IPAddr
+
+
+def make_messages ():
+  fm = of.ofp_flow_mod(xid=1, idle_timeout=10, hard_timeout=30,
+                       buffer_id=12345)
+  fm.match = of.ofp_match(in_port=1, dl_type=0x800,
+                          dl_src=EthAddr("00:00:00:00:00:01"),
+                          dl_dst=EthAddr("00:00:00:00:00:02"),
+                          nw_proto=6, nw_src=IPAddr("10.0.0.1"),
+                          nw_dst=IPAddr("10.0.0.2"), tp_src=1234, tp_dst=80)
+  fm.actions.append(of.ofp_action_output(port=2))
+
+  pi = of.ofp_packet_in(xid=2, buffer_id=77, in_port=3, data=b'x' * 128,
+                        reason=of.OFPR_NO_MATCH)
+
+  po = of.ofp_packet_out(xid=3, buffer_id=88, in_port=3,
+                         action=of.ofp_action_output(port=of.OFPP_FLOOD))
+
+  return [('flow_mod', fm), ('packet_in', pi), ('packet_out', po)]
+
+
+def bench (func, seconds):
+  n = 1000
+  while True:
+    t = timeit.timeit(func, number=n)
+    if t >= seconds / 4: break
+    n *= 4
+  return n / t / 1000.0
+
+
+def main (seconds = 1.0):
+  for name,msg in make_messages():
+    raw = msg.pack()
+    cls = type(msg)
+    packs = bench(msg.pack, seconds)
+    unpacks = bench(lambda: cls.unpack_new(raw), seconds)
+    print("%-12s pack: %8.1fk/s   unpack: %8.1fk/s" % (name, packs, unpacks))
+
+
+if __name__ == '__main__':
+  main(*[float(x) for x in sys.argv[1:2]])
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+# Copyright 2013 James McCauley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Rough throughput benchmark for revent dispatch
+
+Run from the POX directory.  Prints thousands of events raised per second
+with a few listeners.
+"""
+
+import sys
+import os
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from pox.lib.revent import Event, EventMixin
+
+
+class Ping (Event):
+  def __init__ (self, value = None):
+    Event.__init__(self)
+    self.value = value
+
+
+class Source (EventMixin):
+  _eventMixin_events = set([Ping])
+
+
+def main (count = 200000, listeners = 3):
+  s = Source()
+  for i in range(listeners):
+    s.addListener(Ping, lambda event: None)
+  start = time.time()
+  for i in xrange(count):
+    s.raiseEvent(Ping, i)
+  rate = count / (time.time() - start)
+  print("%s listeners: %8.1fk raises/s" % (listeners, rate / 1000))
+
+
+if __name__ == '__main__':
+  main(*[int(x) for x in sys.argv[1:3]])